@@ -1,56 +1,64 @@
+import sys
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import MinMaxScaler
 from sklearn.model_selection import TimeSeriesSplit
 from sklearn.ensemble import RandomForestClassifier
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import LSTM, Dense
 from sklearn.metrics import accuracy_score
 
+sys.path.append('../alpaca_stuff')
+from bar_aggregation import daily_bars
+from indicators import sma
+from window_dataset import StreamingMinMaxScaler, window_view
+
+LOOKBACK = 20  # Days of history the LSTM sees per sample
+
 # Load your data
 df = pd.read_csv('data/bars/AAPL_6mo_hr.csv')
 
 # Convert timestamp to datetime and set it as index
 df['timestamp'] = pd.to_datetime(df['timestamp'])
 df.set_index('timestamp', inplace=True)
+df.sort_index(inplace=True)
 
-# Resample data to daily
-agg_dict = {
-    'open': 'first',
-    'high': 'max',
-    'low': 'min',
-    'close': 'last',
-    'volume': 'sum',
-    'trade_count': 'sum',
-    'vwap': 'mean'  # This is a simplification, normally VWAP needs weighted averaging
+# Resample data to daily, VWAP is weighted by volume
+bar_names = {
+    'o': 'open',
+    'h': 'high',
+    'l': 'low',
+    'c': 'close',
+    'v': 'volume',
+    'vw': 'vwap',
+    'n': 'trade_count',
 }
-daily_df = df.resample('D').agg(agg_dict).dropna()
+daily_df = daily_bars(df, names=bar_names).dropna()
 
 # Feature Engineering
 # Example: Add moving average
-daily_df['moving_avg_10'] = daily_df['close'].rolling(window=10).mean()
+daily_df['moving_avg_10'] = sma(daily_df['close'].to_numpy(), 10)
+daily_df = daily_df.dropna()
 
 # Target Variable
 daily_df['Target'] = np.where(daily_df['close'].shift(-1) > daily_df['close'], 1, 0)
 
 # Select features
 features = ['open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap', 'moving_avg_10']
-X = daily_df[features]
-y = daily_df['Target']
+X = daily_df[features].to_numpy(dtype=np.float32)
+y = daily_df['Target'].to_numpy()
 
-# Normalize the features
-scaler = MinMaxScaler()
-X_scaled = scaler.fit_transform(X)
+# Every LOOKBACK day window as a view of X, labeled by its last day
+windows = window_view(X, LOOKBACK)
+labels = y[LOOKBACK - 1:]
 
 # Splitting into training and testing sets using TimeSeriesSplit
 tscv = TimeSeriesSplit(n_splits=10)
-for train_index, test_index in tscv.split(X_scaled):
-    X_train, X_test = X_scaled[train_index], X_scaled[test_index]
-    y_train, y_test = y.iloc[train_index], y.iloc[test_index]
+for train_index, test_index in tscv.split(windows):
+    y_train, y_test = labels[train_index], labels[test_index]
 
-# Reshape input for LSTM
-X_train = X_train.reshape((X_train.shape[0], 1, X_train.shape[1]))
-X_test = X_test.reshape((X_test.shape[0], 1, X_test.shape[1]))
+# Normalize with the days the last fold trains on only, so nothing of the test period leaks in
+scaler = StreamingMinMaxScaler().partial_fit(X[:train_index[-1] + LOOKBACK])
+X_train, X_test = scaler.transform(windows[train_index]), scaler.transform(windows[test_index])
 
 # LSTM Model
 lstm_model = Sequential()
@@ -63,11 +71,11 @@ lstm_model.fit(X_train, y_train, epochs=100, batch_size=32, verbose=1, shuffle=F
 
 # Random Forest Model
 rf_model = RandomForestClassifier(n_estimators=100, random_state=42)
-rf_model.fit(X_train.reshape(X_train.shape[0], X_train.shape[2]), y_train)
+rf_model.fit(X_train[:, -1, :], y_train)  # The forest only sees the last day of each window
 
 # Making predictions
 lstm_predictions = lstm_model.predict(X_test)
-rf_predictions = rf_model.predict(X_test.reshape(X_test.shape[0], X_test.shape[2]))
+rf_predictions = rf_model.predict(X_test[:, -1, :])
 
 # Evaluating models
 lstm_accuracy = accuracy_score(y_test, np.round(lstm_predictions))
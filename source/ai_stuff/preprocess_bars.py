@@ -1,12 +1,22 @@
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 
+sys.path.append('../alpaca_stuff')
+from bar_store import read_bars
+from bar_aggregation import DAY_NS, aggregate_bars, daily_bars, day_keys
+
+BAR_NS = 5 * 60 * 10**9
+BAR_COLUMNS = ['o', 'h', 'l', 'c', 'v', 'vw']
+
 # ----- Bars Processing Functions -----
 
 
 def process_bars_data(ticker):
     """Processes bars data for a given ticker and combines it by day."""
-    bars_df = pd.read_csv(f'../../data/bars/{ticker}/2y_5m.csv')
+    bars_df = read_bars(ticker)
 
     # Convert to datetime, set timezone to UTC and then convert to US/Eastern
     bars_df['t'] = pd.to_datetime(bars_df['t'], utc=True)
@@ -17,15 +27,8 @@ def process_bars_data(ticker):
     # Fill in missing values
     bars_df = bars_df.resample('5T').asfreq().interpolate(method='linear').reset_index()
 
-    # Resample to daily frequency
-    daily_df = bars_df.resample('D', on='t').agg({
-        'o': 'first',    # Open price (first of the day)
-        'h': 'max',      # High price (max of the day)
-        'l': 'min',      # Low price (min of the day)
-        'c': 'last',     # Close price (last of the day)
-        'v': 'sum',      # Volume (sum of the day)
-        'vw': 'mean',    # Volume Weighted Average Price (average of the day)
-    })
+    # Roll up to daily open/high/low/close, total volume and volume weighted VWAP in one pass
+    daily_df = daily_bars(bars_df, time_col='t', names={col: col for col in BAR_COLUMNS})
 
     # Calculating percent change for the close price
     daily_df['percent_change'] = daily_df['c'].pct_change().astype(float) * 100
@@ -43,6 +46,117 @@ def process_bars_data(ticker):
     return daily_df
 
 
+def load_bars_arrays(tickers):
+    """Loads the bars of many tickers into flat arrays keyed by a per-ticker code, sorted by (code, t)."""
+    frames = [read_bars(ticker, columns=['t'] + BAR_COLUMNS, as_numpy=True) for ticker in tickers]
+    codes = np.concatenate([np.full(len(f['t']), i, dtype=np.int64) for i, f in enumerate(frames)])
+    arrays = {col: np.concatenate([f[col] for f in frames]).astype(np.int64 if col == 't' else np.float64)
+              for col in ['t'] + BAR_COLUMNS}
+    return codes, arrays
+
+
+def fill_5min_gaps(codes, arrays):
+    """
+    Vectorized equivalent of resample('5T').asfreq().interpolate() for many tickers at once:
+    builds each ticker's regular 5 minute grid and linearly interpolates every column onto it.
+    """
+    n = len(codes)
+    first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    last = np.r_[first[1:], n] - 1
+    t = arrays['t']
+
+    # Regular grid per ticker from its first to its last bar
+    steps = (t[last] - t[first]) // BAR_NS + 1
+    grid_codes = np.repeat(codes[first], steps)
+    grid_offsets = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+    grid_t = np.repeat(t[first], steps) + grid_offsets * BAR_NS
+
+    # A single sorted key over (code, bar index) lets one searchsorted find every bracket
+    base = t.min() if n else 0
+    span = (t.max() - base) // BAR_NS + 2 if n else 1
+    src_key = codes * span + (t - base) // BAR_NS
+    grid_key = grid_codes * span + (grid_t - base) // BAR_NS
+    left = np.searchsorted(src_key, grid_key, side='right') - 1
+    right = np.minimum(left + 1, n - 1)
+    gap = src_key[right] - src_key[left]
+    weight = np.where((grid_key == src_key[left]) | (gap == 0), 0.0, (grid_key - src_key[left]) / np.maximum(gap, 1))
+
+    filled = {'t': grid_t}
+    for col in BAR_COLUMNS:
+        values = arrays[col]
+        filled[col] = values[left] + weight * (values[right] - values[left])
+    return grid_codes, filled
+
+
+def _process_bars_chunk(tickers):
+    """Gap fill, daily roll-up, percent change and target for a chunk of tickers in one pass."""
+    codes, arrays = load_bars_arrays(tickers)
+    if len(codes) == 0:
+        return pd.DataFrame()
+    grid_codes, filled = fill_5min_gaps(codes, arrays)
+
+    # Trading days are US/Eastern calendar days, the grid is sorted by (code, t) so every
+    # (code, day) pair is one contiguous run for the fused aggregation kernel
+    days = day_keys(filled['t'], tz='US/Eastern')
+    first_day_number = days.min()
+    span = days.max() - first_day_number + 1
+    agg = aggregate_bars(grid_codes * span + (days - first_day_number),
+                         *(filled[col] for col in ['o', 'h', 'l', 'c', 'v']), vw=filled['vw'])
+
+    daily_df = pd.DataFrame({col: agg[col] for col in BAR_COLUMNS})
+    daily_df['code'] = agg['key'] // span
+    daily_df['day'] = agg['key'] % span + first_day_number
+
+    # Percent change of the close within each ticker
+    close = daily_df['c'].to_numpy()
+    first_day = np.r_[True, daily_df['code'].to_numpy()[1:] != daily_df['code'].to_numpy()[:-1]]
+    previous = np.r_[np.nan, close[:-1]]
+    percent_change = np.where(first_day, np.nan, (close / previous - 1) * 100)
+    daily_df['percent_change'] = percent_change
+    daily_df['target'] = np.select([percent_change > 1, percent_change < -1], [1, -1], default=0)
+    daily_df = daily_df[~first_day]
+
+    daily_df['symbol'] = np.asarray(tickers, dtype=object)[daily_df['code'].to_numpy()]
+    daily_df['t'] = pd.to_datetime(daily_df['day'].to_numpy() * DAY_NS).tz_localize('US/Eastern')
+    return daily_df.set_index(['symbol', 't'])[BAR_COLUMNS + ['percent_change', 'target']]
+
+
+def process_bars_data_batch(tickers, n_jobs=None, chunk_size=50):
+    """
+    Batched version of process_bars_data for many tickers.
+    Tickers are processed vectorized in chunks, and chunks are spread over processes so only a
+    chunk of raw bars is in memory per worker. Returns a frame indexed by (symbol, t).
+    """
+    chunks = [tickers[i:i + chunk_size] for i in range(0, len(tickers), chunk_size)]
+    if n_jobs == 1 or len(chunks) <= 1:
+        results = [_process_bars_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_process_bars_chunk, chunks))
+    results = [r for r in results if not r.empty]
+    return pd.concat(results) if results else pd.DataFrame()
+
+
+def benchmark_process_bars(tickers, n_jobs=None, chunk_size=50):
+    """Times the per-ticker loop against the batched path and checks that they agree."""
+    start = time.perf_counter()
+    loop_results = {ticker: process_bars_data(ticker) for ticker in tickers}
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_df = process_bars_data_batch(tickers, n_jobs=n_jobs, chunk_size=chunk_size)
+    batch_time = time.perf_counter() - start
+
+    max_diff = 0.0
+    for ticker, expected in loop_results.items():
+        got = batch_df.loc[ticker]
+        max_diff = max(max_diff, float(np.nanmax(np.abs(got[BAR_COLUMNS].to_numpy() - expected[BAR_COLUMNS].to_numpy()))))
+
+    print(f"Per-ticker loop: {loop_time:.2f}s, batched: {batch_time:.2f}s ({loop_time / batch_time:.1f}x)")
+    print(f"Max absolute difference: {max_diff:.3g}")
+    return loop_time, batch_time
+
+
 if __name__ == "__main__":
     output_path = "../../data/training_data/blah.csv"
     df = process_bars_data('AAT')
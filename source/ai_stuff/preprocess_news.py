@@ -1,31 +1,64 @@
+import sys
+import numpy as np
 import pandas as pd
-from pandas.tseries.offsets import BDay
 from preprocess_bars import process_bars_data  # Make sure process_bars.py is in the same directory or in the Python path
 import os
-# ----- News Processing Functions -----
-# Aggregate news articles by day, combine weekends
-def aggregate_news_by_day(ticker):
-    df = pd.read_csv(f'../../data/news/{ticker}/TickerNewsSummary.csv')
-
-    # Ensure 'created_at' is in datetime format and convert to US/Eastern timezone
-    df['created_at'] = pd.to_datetime(df['created_at']).dt.tz_convert('US/Eastern')
 
-    # Adjust weekends: If the day is Saturday or Sunday, shift it to the following Monday
-    df['adjusted_date'] = df['created_at'].apply(lambda x: x + BDay(1) if x.dayofweek in [5, 6] else x)
+sys.path.append('../alpaca_stuff')
+from trading_calendar import next_session
+from data_manifest import list_tickers, rebuild_news, top_tickers
 
-    # Extract just the date part for grouping
-    df['adjusted_date'] = df['adjusted_date'].dt.date
+# ----- News Processing Functions -----
 
-    # Ensure that 'headline' columns are of type string
+def concat_by_group(strings, starts, ends, sep=' '):
+    """
+    Joins runs of strings (starts/ends inclusive) with sep. Everything is joined once and each run
+    is sliced back out by character offsets, so the cost is linear in the total text.
+    """
+    strings = list(strings)
+    joined = sep.join(strings)
+    offsets = np.r_[0, np.cumsum(np.fromiter(map(len, strings), dtype=np.int64, count=len(strings)) + len(sep))]
+    begin = offsets[starts]
+    end = offsets[np.asarray(ends) + 1] - len(sep)
+    return [joined[b:e] for b, e in zip(begin, end)]
+
+
+def aggregate_news_by_day_batch(tickers):
+    """
+    Aligns every article of every ticker to its trading session and concatenates the headlines per
+    (symbol, session) in one vectorized pass. Articles after the close, on weekends or on holidays
+    count towards the next session.
+    """
+    frames = []
+    for ticker in tickers:
+        df = pd.read_csv(f'../../data/news/{ticker}/TickerNewsSummary.csv', usecols=['created_at', 'headline'])
+        df['symbol'] = ticker
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+
+    df['created_at'] = pd.to_datetime(df['created_at'], utc=True)
+    df['adjusted_date'] = next_session(df['created_at'])
     df['headline'] = df['headline'].astype(str)
 
-    # Group by the adjusted date and concatenate all headlines into a single string for each date
-    aggregated_df = df.groupby(['adjusted_date']).agg({'headline': lambda x: ' '.join(x)})
+    # Sort so each (symbol, session) is a contiguous run, keeping articles in time order inside a run
+    df = df.sort_values(['symbol', 'adjusted_date', 'created_at'], kind='stable').reset_index(drop=True)
+    symbol_codes = pd.factorize(df['symbol'])[0]
+    day_codes = df['adjusted_date'].to_numpy().astype(np.int64)
+    new_run = np.r_[True, (symbol_codes[1:] != symbol_codes[:-1]) | (day_codes[1:] != day_codes[:-1])]
+    starts = np.flatnonzero(new_run)
+    ends = np.r_[starts[1:], len(df)] - 1
+
+    return pd.DataFrame({
+        'symbol': df['symbol'].to_numpy()[starts],
+        'adjusted_date': df['adjusted_date'].to_numpy()[starts],
+        'headline': concat_by_group(df['headline'], starts, ends),
+    })
 
-    # Reset index to turn 'adjusted_date' back into a column
-    aggregated_df = aggregated_df.reset_index()
 
-    return aggregated_df
+# Aggregate news articles by trading day
+def aggregate_news_by_day(ticker):
+    aggregated_df = aggregate_news_by_day_batch([ticker])
+    return aggregated_df[['adjusted_date', 'headline']]
 
 def ensure_timezone(df, timezone='US/Eastern'):
     """Ensure the index of the DataFrame is in the specified timezone."""
@@ -63,37 +96,10 @@ def merge_news_and_bars_data(ticker):
 
 #Find the top 20 tickers with the most news articles
 def find_top_20_csv_files():
-    root_directory = '../../data/news'
-
-    def count_csv_lines(file_path):
-        """Counts the number of lines in a CSV file using pandas."""
-        return len(pd.read_csv(file_path))
-
-    def extract_ticker_symbol(file_path):
-        """Extracts the ticker symbol from a CSV file path."""
-        parts = file_path.split(os.path.sep)
-        return parts[-2] if len(parts) >= 2 else "Unknown"
-
-    # Find and process all CSV files
-    csv_files = []
-    for root, dirs, files in os.walk(root_directory):
-        for file in files:
-            if file.endswith('.csv'):
-                file_path = os.path.join(root, file)
-                try:
-                    lines_in_csv = count_csv_lines(file_path)
-                    ticker = extract_ticker_symbol(file_path)
-                    csv_files.append((ticker, file_path, lines_in_csv))
-                except pd.errors.EmptyDataError:
-                    print(f"Skipping empty file: {file_path}")
-
-    # Sort the CSV files by line count in descending order
-    csv_files.sort(key=lambda x: x[2], reverse=True)
-
-    # Collect the top 20 tickers
-    top_20_tickers = [ticker for ticker, _, _ in csv_files[:20]]
-
-    return top_20_tickers
+    # Row counts come from the manifest, scan the news tree once if it has never been indexed
+    if not list_tickers('news'):
+        rebuild_news('../../data/news')
+    return top_tickers('news', 20, by='rows')
 
 # ----- Example Usage -----
 
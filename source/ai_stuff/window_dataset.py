@@ -0,0 +1,264 @@
+import sys
+import json
+import os
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+sys.path.append('../alpaca_stuff')
+from bar_store import read_bars
+
+WINDOW_ROOT = os.environ.get('WINDOW_ROOT', '../../data/training_data/windows')
+FEATURES = ['o', 'h', 'l', 'c', 'v', 'vw', 'n']
+
+
+def window_view(x, lookback):
+    """
+    Every run of `lookback` consecutive rows of x (n, features) as a read-only (n - lookback + 1,
+    lookback, features) view. No data is copied, window i starts at row i.
+    """
+    return sliding_window_view(x, lookback, axis=0).transpose(0, 2, 1)
+
+
+def next_close_up(c):
+    """1 where the next bar closes higher, as in ai_attempt.py. The last bar has no label (-1)."""
+    y = np.full(len(c), -1, dtype=np.int8)
+    y[:-1] = c[1:] > c[:-1]
+    return y
+
+
+# ----- Streaming scalers -----
+
+class StreamingMinMaxScaler:
+    """MinMaxScaler fitted chunk by chunk with partial_fit; two fitted scalers merge exactly."""
+
+    def __init__(self, feature_range=(0.0, 1.0)):
+        self.feature_range = feature_range
+        self.min = None
+        self.max = None
+        self.count = 0
+
+    def partial_fit(self, x):
+        if len(x):
+            lo, hi = np.nanmin(x, axis=0), np.nanmax(x, axis=0)
+            self.min = lo if self.min is None else np.fmin(self.min, lo)
+            self.max = hi if self.max is None else np.fmax(self.max, hi)
+            self.count += len(x)
+        return self
+
+    def merge(self, other):
+        merged = StreamingMinMaxScaler(self.feature_range)
+        for scaler in (self, other):
+            if scaler.count:
+                merged.min = scaler.min if merged.min is None else np.fmin(merged.min, scaler.min)
+                merged.max = scaler.max if merged.max is None else np.fmax(merged.max, scaler.max)
+                merged.count += scaler.count
+        return merged
+
+    def transform(self, x):
+        low, high = self.feature_range
+        span = self.max - self.min
+        scale = (high - low) / np.where(span > 0, span, 1.0)
+        return ((x - self.min) * scale + low).astype(np.float32, copy=False)
+
+
+class StandardStreamingScaler:
+    """StandardScaler fitted chunk by chunk, combining chunk moments with Chan's parallel update."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def _combine(self, count, mean, m2):
+        if not count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def partial_fit(self, x):
+        if len(x):
+            x = np.asarray(x, dtype=np.float64)
+            mean = x.mean(axis=0)
+            self._combine(len(x), mean, ((x - mean) ** 2).sum(axis=0))
+        return self
+
+    def merge(self, other):
+        merged = StandardStreamingScaler()
+        for scaler in (self, other):
+            merged._combine(scaler.count, scaler.mean, scaler.m2)
+        return merged
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def transform(self, x):
+        std = self.std
+        return ((x - self.mean) / np.where(std > 0, std, 1.0)).astype(np.float32, copy=False)
+
+
+SCALERS = {'minmax': StreamingMinMaxScaler, 'standard': StandardStreamingScaler}
+
+
+# ----- Window store -----
+
+def build_window_store(tickers, name, features=FEATURES, root=WINDOW_ROOT, bar_root=None):
+    """
+    Writes the features of every ticker, one after the other, into memory-mapped .npy files under
+    root/name (x float32 (rows, features), t int64 ns, y int8 labels) plus an index of each
+    ticker's row range. Tickers are read and written one at a time, so memory use is one ticker's
+    bars whatever the number of tickers.
+    """
+    kwargs = {} if bar_root is None else {'root': bar_root}
+    # First pass reads only the timestamps to size the files
+    lengths = {ticker: len(read_bars(ticker, columns=['t'], as_numpy=True, **kwargs)['t']) for ticker in tickers}
+    lengths = {ticker: n for ticker, n in lengths.items() if n}
+    total = sum(lengths.values())
+
+    directory = os.path.join(root, name)
+    os.makedirs(directory, exist_ok=True)
+    x = np.lib.format.open_memmap(os.path.join(directory, 'x.npy'), mode='w+', dtype=np.float32,
+                                  shape=(total, len(features)))
+    t = np.lib.format.open_memmap(os.path.join(directory, 't.npy'), mode='w+', dtype=np.int64, shape=(total,))
+    y = np.lib.format.open_memmap(os.path.join(directory, 'y.npy'), mode='w+', dtype=np.int8, shape=(total,))
+
+    index, row = {}, 0
+    for ticker, n in lengths.items():
+        bars = read_bars(ticker, as_numpy=True, **kwargs)
+        for j, feature in enumerate(features):
+            x[row:row + n, j] = bars[feature]
+        t[row:row + n] = bars['t']
+        y[row:row + n] = next_close_up(bars['c'])
+        index[ticker] = (row, row + n)
+        row += n
+    for array in (x, t, y):
+        array.flush()
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump({'features': list(features), 'tickers': index}, f)
+    return WindowDataset(name, root=root)
+
+
+class WindowDataset:
+    """
+    Sliding windows over a window store. The windows are a strided view of the memory-mapped
+    feature file and a window is addressed by its first row, so the lookback length costs no
+    memory; a batch is the only thing ever copied, gathered, scaled and labeled on request.
+    Windows never cross from one ticker into the next and are labeled by their last bar.
+    """
+
+    def __init__(self, name, lookback=64, root=WINDOW_ROOT):
+        directory = os.path.join(root, name)
+        with open(os.path.join(directory, 'index.json')) as f:
+            meta = json.load(f)
+        self.features = meta['features']
+        self.tickers = {ticker: tuple(bounds) for ticker, bounds in meta['tickers'].items()}
+        self.x = np.load(os.path.join(directory, 'x.npy'), mmap_mode='r')
+        self.t = np.load(os.path.join(directory, 't.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(directory, 'y.npy'), mmap_mode='r')
+        self.set_lookback(lookback)
+
+    def set_lookback(self, lookback):
+        self.lookback = lookback
+        if len(self.x) >= lookback:
+            self.windows = window_view(self.x, lookback)
+        else:
+            self.windows = np.empty((0, lookback, len(self.features)), dtype=np.float32)
+        # First rows of every window that stays inside one ticker and has a label at its end
+        starts = [np.arange(lo, hi - lookback + 1) for lo, hi in self.tickers.values() if hi - lo >= lookback]
+        starts = np.concatenate(starts) if starts else np.empty(0, dtype=np.int64)
+        self.starts = starts[self.y[starts + lookback - 1] >= 0]
+        self.end_t = self.t[self.starts + lookback - 1]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def fold_cutoffs(self, n_splits=5):
+        """
+        n_splits times cutting the windows into n_splits + 1 equal parts by end time, like
+        TimeSeriesSplit but across every ticker: fold k trains on the windows ending before cutoff k
+        and tests on the ones ending between cutoff k and the next (or the end).
+        """
+        return np.quantile(self.end_t, np.arange(1, n_splits + 1) / (n_splits + 1), method='lower')
+
+    def fold(self, k, cutoffs):
+        """(train, test) window indexes of fold k."""
+        train = np.flatnonzero(self.end_t < cutoffs[k])
+        test = self.end_t >= cutoffs[k]
+        if k + 1 < len(cutoffs):
+            test &= self.end_t < cutoffs[k + 1]
+        return train, np.flatnonzero(test)
+
+    def fit_scalers(self, cutoffs, kind='minmax', chunk_rows=1 << 20):
+        """
+        One scaler per fold fitted on the rows that fold trains on (every row before its cutoff, so
+        nothing of the test period leaks in). A single chunked pass over the feature file fits one
+        scaler per period between cutoffs, and fold k's scaler merges periods 0..k.
+        """
+        segments = [SCALERS[kind]() for _ in cutoffs]
+        for lo in range(0, len(self.x), chunk_rows):
+            x, t = np.asarray(self.x[lo:lo + chunk_rows]), np.asarray(self.t[lo:lo + chunk_rows])
+            segment = np.searchsorted(cutoffs, t, side='right')
+            for s in np.unique(segment[segment < len(cutoffs)]):
+                segments[s].partial_fit(x[segment == s])
+        scalers, merged = [], SCALERS[kind]()
+        for scaler in segments:
+            merged = merged.merge(scaler)
+            scalers.append(merged)
+        return scalers
+
+    def batch(self, indexes, scaler=None):
+        """Windows (len(indexes), lookback, features) float32 and their labels."""
+        starts = self.starts[indexes]
+        x = self.windows[starts]
+        if scaler is not None:
+            x = scaler.transform(x)
+        return np.ascontiguousarray(x, dtype=np.float32), self.y[starts + self.lookback - 1].astype(np.float32)
+
+    def batches(self, indexes, batch_size=256, scaler=None, shuffle=False, seed=None):
+        """Yields (x, y) batches of the given windows, mixing tickers when shuffled."""
+        indexes = np.asarray(indexes)
+        if shuffle:
+            indexes = np.random.default_rng(seed).permutation(indexes)
+        else:
+            # In file order the gathers read the memory map sequentially
+            indexes = np.sort(indexes)
+        for lo in range(0, len(indexes), batch_size):
+            yield self.batch(indexes[lo:lo + batch_size], scaler)
+
+    def tf_dataset(self, indexes, batch_size=256, scaler=None, shuffle=False, seed=None):
+        """The batches as a tf.data.Dataset, e.g. for model.fit(). Each epoch runs the generator again."""
+        import tensorflow as tf
+        signature = (tf.TensorSpec((None, self.lookback, len(self.features)), tf.float32),
+                     tf.TensorSpec((None,), tf.float32))
+        return tf.data.Dataset.from_generator(
+            lambda: self.batches(indexes, batch_size, scaler, shuffle, seed),
+            output_signature=signature).prefetch(2)
+
+
+if __name__ == "__main__":
+    import resource
+    from asset_universe import universe_symbols
+
+    tickers = sys.argv[1:] or universe_symbols()[0:20]
+    start = time.perf_counter()
+    dataset = build_window_store(tickers, 'demo')
+    print(f"Stored {dataset.x.shape[0]:,} bars of {len(dataset.tickers)} tickers "
+          f"in {time.perf_counter() - start:.1f}s")
+    for lookback in (16, 64, 256):
+        dataset.set_lookback(lookback)
+        cutoffs = dataset.fold_cutoffs(5)
+        scalers = dataset.fit_scalers(cutoffs)
+        train, test = dataset.fold(4, cutoffs)
+        start = time.perf_counter()
+        n = sum(len(xb) for xb, _ in dataset.batches(train, 512, scalers[4], shuffle=True, seed=0))
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"lookback {lookback}: {len(dataset):,} windows, fold 4 trains on {n:,} "
+              f"({n * lookback * len(dataset.features) * 4 / 2**30:.1f} GiB if materialized) "
+              f"in {time.perf_counter() - start:.1f}s, peak RSS {peak:.0f} MiB")
@@ -1,3 +1,4 @@
+import os
 from alpaca.data.historical import CryptoHistoricalDataClient
 from alpaca.data.requests import CryptoLatestQuoteRequest
 from alpaca.data.requests import CryptoBarsRequest
@@ -6,6 +7,8 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from api_keys import paper_key, paper_secret
 from alpaca.data.live import CryptoDataStream
+from live_pipeline import StreamPipeline, MacdVwapSignal
+from market_replay import STREAM_LOG_ROOT, MessageRecorder
 
 # # no keys required for crypto data
 # client = CryptoHistoricalDataClient()
@@ -27,11 +30,14 @@ from alpaca.data.live import CryptoDataStream
 
 wss_client = CryptoDataStream(paper_key, paper_secret)
 
-# async handler
-async def quote_data_handler(data):
-    # quote data will arrive here
-    print(data)
-
-wss_client.subscribe_quotes(quote_data_handler, "BTC/USD")
-
-wss_client.run()
\ No newline at end of file
+# Quotes and trades go through bounded queues into 1 minute bars, MACD/VWAP signals are printed
+# Every message is also appended to a stream log for replay (python market_replay.py --log ...)
+pipeline = StreamPipeline(MacdVwapSignal(), timeframe='1Min', on_signal=print)
+recorder = MessageRecorder(os.path.join(STREAM_LOG_ROOT, f"crypto_{datetime.now():%Y-%m-%d}.log"), forward=pipeline)
+recorder.subscribe(wss_client, "BTC/USD", "ETH/USD")
+
+try:
+    wss_client.run()
+finally:
+    recorder.close()
+    print(pipeline.report())
@@ -7,8 +7,10 @@ import pandas as pd
 from dateutil.relativedelta import relativedelta
 from tqdm import tqdm
 from api_keys import paper_key, paper_secret
-from bt_stuff import AlpacaStockData, MyStrategy, FractionalSizer, BuyDipsStrategy
+from asset_universe import universe_symbols
+from bt_stuff import AlpacaStockData, MyStrategy, FractionalSizer, BuyDipsStrategy, collect_analysis
 from helper_functions import time_it
+from results_store import ResultsStore, run_key
 
 starting_cash = 1000.0
 start_time = datetime.now() - relativedelta(years=2)
@@ -49,93 +51,83 @@ def get_stock_bars_for_bt(symbols):
 
 
 
-def analyze_bt_results(results):
+def record_bt_results(results, symbol, timeframe='1Min', data_version=None, store=None):
+    """
+    Stores every strategy of a cerebro.run() (plain strategies or optstrategy OptReturns) in the
+    results store, with the figures collect_analysis flattens and the strategy's full parameters.
+    data_version names the data the runs saw (see bar_resampler.data_version). Returns the run keys.
+    """
+    store = store or ResultsStore()
+    data_version = data_version or 'unversioned'
+    runs = []
     for run in results:
-        for strat in run:
-
-            print(f"The Starting Portfolio Value: {strat.broker.startingcash}")
-            print(f"The Final Portfolio Value: {strat.broker.getvalue()}")
-            print(f"The Final PnL: {strat.broker.getvalue() - strat.broker.startingcash}")
-
-
-            trade_analysis = strat.analyzers.getbyname('ta').get_analysis()
-
-            print("\nTrade Analysis:")
-            print(f"Total Trades: {trade_analysis.total.total}")
-            print(f"Total Closed Trades: {trade_analysis.total.closed}")
-            print(f"Total Won Trades: {trade_analysis.won.total}")
-            print(f"Total Lost Trades: {trade_analysis.lost.total}")
-            print(f"Winning Streak: {trade_analysis.streak.won.longest}")
-            print(f"Losing Streak: {trade_analysis.streak.lost.longest}")
-            print(f"Profit/Loss Total: {trade_analysis.pnl.net.total:.2f}")
-            print(f"Average P/L per Trade: {trade_analysis.pnl.net.average:.2f}")
-
-            sharpe_ratio = strat.analyzers.sharpe.get_analysis()
-
-            print("\nSharpe Ratio:")
-            print(f"Sharpe Ratio: {sharpe_ratio['sharperatio']:.2f}")
-
-            drawdown = strat.analyzers.drawdown.get_analysis()
-
-            print("\nDrawdown:")
-            print(f"Max Drawdown Length: {drawdown.max.len}")
-            print(f"Max Drawdown: {drawdown.max.drawdown:.2f}%")
-            print(f"Max Money Down: {drawdown.max.moneydown:.2f}")
-            print(f"Current Drawdown: {drawdown.drawdown:.2f}%")
-            print(f"Current Money Down: {drawdown.moneydown:.2f}")
-
-            returns = strat.analyzers.returns.get_analysis()
-
-            print("\nReturns:")
-            print(f"Total Returns (rtot): {returns['rtot']:.4f}")
-            print(f"Average Daily Return (ravg): {returns['ravg']:.6f}")
-            print(f"Normalized Return (rnorm): {returns['rnorm']:.2f}")
-            print(f"Normalized Return Annualized (rnorm100): {returns['rnorm100']:.2f}%")
-
-
-def opt_bt_results(results):
-    optimized_results = []
-
-    for opt_run in results:  # Each opt_run is a list of OptReturn objects for a parameter combination
-        for opt_return in opt_run:
-            try:
-                # Accessing analyzer results
-                trade_analysis = opt_return.analyzers.ta.get_analysis()
-                sharpe_ratio = opt_return.analyzers.sharpe.get_analysis()
-
-                # Extracting parameter values
-                params = {param: getattr(opt_return.params, param) for param in opt_return.params._getkeys()}
-
-                # Handle None values in Sharpe Ratio
-                sharpe_ratio_value = sharpe_ratio['sharperatio']
-                if sharpe_ratio_value is None:
-                    sharpe_ratio_value = float(-1)  # Assign a very low value for sorting
-
-                # Store parameter combination and corresponding results
-                result = {
-                    'params': params,
-                    'total_trades': trade_analysis.total.total,
-                    'sharpe_ratio': sharpe_ratio_value,
-                }
-                optimized_results.append(result)
-
-            except Exception as e:
-                print(e)
-
-    # Sort results based on a chosen metric, e.g., Sharpe Ratio
-    optimized_results.sort(key=lambda x: x['sharpe_ratio'], reverse=True)
-
-    # Print the best result after sorting
-    if optimized_results and optimized_results[0]['sharpe_ratio'] != float('-inf'):
-        best_result = optimized_results[0]
-        print("Best Parameter Set:")
-        for key, value in best_result['params'].items():
-            print(f"{key}: {value}")
-        print(f"Sharpe Ratio: {best_result['sharpe_ratio']}")
-        print(f"Total Trades: {best_result['total_trades']}")
-    else:
+        for strat in (run if isinstance(run, (list, tuple)) else [run]):
+            name = getattr(strat, 'strategycls', type(strat)).__name__
+            params = {param: getattr(strat.params, param) for param in strat.params._getkeys()}
+            metrics = collect_analysis(strat)
+            # Only a plain run still has its broker, OptReturns keep the analyzers alone
+            cash = strat.broker.startingcash if hasattr(strat, 'broker') else starting_cash
+            if hasattr(strat, 'broker'):
+                metrics.update(start_value=cash, final_value=strat.broker.getvalue(),
+                               pnl=strat.broker.getvalue() - cash)
+            runs.append({'run_key': run_key(name, symbol, timeframe, params, data_version, cash), 'strategy': name,
+                         'symbol': symbol, 'timeframe': timeframe, 'data_version': data_version,
+                         'starting_cash': cash, 'params': params, 'metrics': metrics, 'engine': 'backtrader'})
+    store.record_many(runs)
+    return [run['run_key'] for run in runs]
+
+
+def analyze_bt_results(results, symbol, timeframe='1Min', data_version=None, store=None):
+    store = store or ResultsStore()
+    keys = record_bt_results(results, symbol, timeframe, data_version, store)
+    for _, r in store.load(keys=keys).iterrows():
+        print(f"The Starting Portfolio Value: {r['start_value']}")
+        print(f"The Final Portfolio Value: {r['final_value']}")
+        print(f"The Final PnL: {r['pnl']}")
+
+        print("\nTrade Analysis:")
+        print(f"Total Trades: {r['total_trades']}")
+        print(f"Total Closed Trades: {r['closed_trades']}")
+        print(f"Total Won Trades: {r['won_trades']}")
+        print(f"Total Lost Trades: {r['lost_trades']}")
+        print(f"Winning Streak: {r['winning_streak']}")
+        print(f"Losing Streak: {r['losing_streak']}")
+        print(f"Profit/Loss Total: {r['pnl_net_total']:.2f}")
+        print(f"Average P/L per Trade: {r['pnl_net_average']:.2f}")
+
+        print("\nSharpe Ratio:")
+        print(f"Sharpe Ratio: {r['sharpe_ratio']}")
+
+        print("\nDrawdown:")
+        print(f"Max Drawdown Length: {r['max_drawdown_len']}")
+        print(f"Max Drawdown: {r['max_drawdown']:.2f}%")
+        print(f"Max Money Down: {r['max_moneydown']:.2f}")
+        print(f"Current Drawdown: {r['drawdown']:.2f}%")
+        print(f"Current Money Down: {r['moneydown']:.2f}")
+
+        print("\nReturns:")
+        print(f"Total Returns (rtot): {r['rtot']}")
+        print(f"Average Daily Return (ravg): {r['ravg']}")
+        print(f"Normalized Return (rnorm): {r['rnorm']}")
+        print(f"Normalized Return Annualized (rnorm100): {r['rnorm100']}%")
+    return keys
+
+
+def opt_bt_results(results, symbol, timeframe='1Min', data_version=None, store=None):
+    store = store or ResultsStore()
+    keys = record_bt_results(results, symbol, timeframe, data_version, store)
+    # Runs without a Sharpe ratio sort last
+    best = store.best('sharpe_ratio', 1, keys=keys)
+    if best.empty or pd.isna(best['sharpe_ratio'].iloc[0]):
         print("No valid Sharpe Ratio results found.")
-
+        return keys
+    best_result = best.iloc[0]
+    print("Best Parameter Set:")
+    for key in results[0][0].params._getkeys():
+        print(f"{key}: {best_result[key]}")
+    print(f"Sharpe Ratio: {best_result['sharpe_ratio']}")
+    print(f"Total Trades: {best_result['total_trades']}")
+    return keys
 
 
 def analyze_simple_results(results):
@@ -177,7 +169,7 @@ def build_simple_cerebro(strategy):
 #symbols = ["O", "MSFT", "DIS", "NVDA", 'MAR', 'BLDR', 'META']
 
 # Load tickers from a CSV file
-tickers = pd.read_csv("../../data/shortable_assets.csv")['symbol'].tolist()
+tickers = universe_symbols()
 
 # Create a tqdm progress bar
 progress_bar = tqdm(total=len(tickers), desc="Fetching Bars")
@@ -235,4 +227,4 @@ progress_bar.close()
 # cerebro.addsizer(FractionalSizer)
 #
 # results = cerebro.run(maxcpus=1)
-# opt_bt_results(results)
\ No newline at end of file
+# opt_bt_results(results, symbol)
\ No newline at end of file
@@ -0,0 +1,238 @@
+import argparse
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+import requests
+from helper_functions import load_api_keys
+
+paper_key, paper_secret = load_api_keys()
+
+# Point at mock_alpaca_server.py with ALPACA_TRADING_URL=http://127.0.0.1:8765
+ALPACA_TRADING_URL = os.environ.get('ALPACA_TRADING_URL', 'https://paper-api.alpaca.markets')
+# One Parquet file per distinct asset list, named by version, plus the changes against the previous one
+UNIVERSE_ROOT = os.environ.get('UNIVERSE_ROOT', '../../data/universe')
+# Still written on every refresh for scripts and tools that read the CSV
+ASSETS_CSV = '../../data/shortable_assets.csv'
+
+ASSET_COLUMNS = ['id', 'asset_class', 'exchange', 'symbol', 'name', 'status', 'tradable', 'marginable',
+                 'shortable', 'easy_to_borrow', 'fractionable', 'maintenance_margin_requirement']
+FLAGS = ['tradable', 'marginable', 'shortable', 'easy_to_borrow', 'fractionable']
+# Fields compared between snapshots, a difference in any of them is a 'changed' symbol
+TRACKED = ['status', 'exchange', 'name', *FLAGS, 'maintenance_margin_requirement']
+
+
+def assets_frame(records):
+    """
+    The asset list (JSON dicts from /v2/assets or alpaca-py Asset models) as a frame with
+    ASSET_COLUMNS, typed flags and one row per symbol, sorted by symbol.
+    """
+    rows = [r if isinstance(r, dict) else r.model_dump() if hasattr(r, 'model_dump') else vars(r)
+            for r in records]
+    df = pd.DataFrame(rows)
+    if 'asset_class' not in df and 'class' in df:
+        df = df.rename(columns={'class': 'asset_class'})  # The REST API's name for it
+    df = df.reindex(columns=ASSET_COLUMNS)
+    for column in ('id', 'asset_class', 'exchange', 'status'):
+        # Enums of alpaca-py models print as e.g. AssetClass.US_EQUITY, the API sends the value
+        df[column] = [getattr(v, 'value', v) for v in df[column]]
+        df[column] = df[column].astype(str)
+    for flag in FLAGS:
+        df[flag] = df[flag].fillna(False).astype(bool)
+    df['maintenance_margin_requirement'] = pd.to_numeric(df['maintenance_margin_requirement'], errors='coerce')
+    return df.drop_duplicates('symbol').sort_values('symbol', ignore_index=True)
+
+
+def shortable_mask(df):
+    """The filter get_alpaca_shortable_assets applied, as one boolean mask."""
+    return (df['tradable'] & (df['status'] == 'active') & df['shortable'] & df['fractionable']
+            & (df['asset_class'] == 'us_equity')).to_numpy()
+
+
+def content_hash(df):
+    return hashlib.blake2b(pd.util.hash_pandas_object(df[ASSET_COLUMNS], index=False).to_numpy().tobytes(),
+                           digest_size=8).hexdigest()
+
+
+def diff_assets(old, new):
+    """
+    Symbol level changes from old to new: one row per added, removed or changed symbol with the
+    tracked fields that differ and whether the symbol is in the shortable universe before/after.
+    """
+    old = old.set_index('symbol')
+    new = new.set_index('symbol')
+    symbols = old.index.union(new.index)
+    a, b = old.reindex(symbols), new.reindex(symbols)
+    in_old, in_new = symbols.isin(old.index), symbols.isin(new.index)
+
+    differs = pd.DataFrame({f: (a[f] != b[f]) & ~(a[f].isna() & b[f].isna()) for f in TRACKED}, index=symbols)
+    changed = in_old & in_new & differs.to_numpy().any(axis=1)
+    change = np.select([~in_old, ~in_new, changed], ['added', 'removed', 'changed'], default='')
+    keep = change != ''
+    fields = [','.join(np.array(TRACKED)[row]) for row in differs.to_numpy()[keep]]
+    was = np.zeros(len(symbols), dtype=bool)
+    now = np.zeros(len(symbols), dtype=bool)
+    was[in_old] = shortable_mask(a[in_old].reset_index())
+    now[in_new] = shortable_mask(b[in_new].reset_index())
+    return pd.DataFrame({
+        'symbol': symbols[keep],
+        'change': change[keep],
+        'fields': [f if c == 'changed' else '' for f, c in zip(fields, change[keep])],
+        'was_shortable': was[keep],
+        'is_shortable': now[keep],
+    })
+
+
+def fetch_assets(base_url=ALPACA_TRADING_URL, key=paper_key, secret=paper_secret, status='active',
+                 asset_class='us_equity', timeout=60):
+    """GET /v2/assets as a frame (see assets_frame)."""
+    response = requests.get(f"{base_url}/v2/assets", params={'status': status, 'asset_class': asset_class},
+                            headers={'APCA-API-KEY-ID': key, 'APCA-API-SECRET-KEY': secret}, timeout=timeout)
+    response.raise_for_status()
+    return assets_frame(response.json())
+
+
+class UniverseStore:
+    """
+    Versioned asset list snapshots. refresh() fetches the asset list and, only when its content
+    differs from the newest snapshot, stores it with the changes against that snapshot. Loaded
+    snapshots stay in memory, so the current universe is served from the process after the first
+    read; asking again only lists the directory to see whether a newer version appeared.
+    """
+
+    def __init__(self, root=UNIVERSE_ROOT):
+        self.root = root
+        self._frames = {}
+
+    def _path(self, kind, version):
+        return os.path.join(self.root, f"{kind}_{version}.parquet")
+
+    def versions(self):
+        """Snapshot versions, oldest first. A version is the UTC time it was taken plus a content hash."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[len('assets_'):-len('.parquet')] for name in os.listdir(self.root)
+                      if name.startswith('assets_') and name.endswith('.parquet'))
+
+    def latest_version(self):
+        versions = self.versions()
+        return versions[-1] if versions else None
+
+    def load(self, version=None):
+        """The full asset list of a snapshot (the newest by default), or None without snapshots."""
+        version = version or self.latest_version()
+        if version is None:
+            return None
+        if version not in self._frames:
+            self._frames[version] = pd.read_parquet(self._path('assets', version))
+        return self._frames[version]
+
+    def changes(self, version=None):
+        """The changes stored with a snapshot, against the one before it."""
+        version = version or self.latest_version()
+        path = self._path('changes', version) if version else None
+        return pd.read_parquet(path) if path and os.path.exists(path) else None
+
+    def save(self, df):
+        """Stores df as a new snapshot unless it equals the newest one. Returns (version, changes)."""
+        df = assets_frame(df.to_dict('records')) if not df.columns.equals(pd.Index(ASSET_COLUMNS)) else df
+        digest = content_hash(df)
+        previous = self.latest_version()
+        if previous is not None and previous.endswith(digest):
+            return previous, diff_assets(df, df)
+
+        old = self.load(previous) if previous else df.iloc[:0]
+        changes = diff_assets(old, df)
+        version = f"{pd.Timestamp.now(tz='UTC'):%Y%m%dT%H%M%S%f}-{digest}"
+        os.makedirs(self.root, exist_ok=True)
+        # Changes first: a snapshot without its changes file is never visible as the newest version
+        changes.to_parquet(self._path('changes', version), index=False)
+        tmp = self._path('assets', version) + '.tmp'
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, self._path('assets', version))
+        self._frames[version] = df
+        return version, changes
+
+    def refresh(self, fetch=fetch_assets, csv_path=ASSETS_CSV, **kwargs):
+        """Fetches the asset list, snapshots it if it changed and rewrites the shortable CSV. Returns (version, changes)."""
+        version, changes = self.save(fetch(**kwargs))
+        if csv_path and (len(changes) or not os.path.exists(csv_path)):
+            self.universe(version).reset_index(drop=True).to_csv(csv_path)
+        return version, changes
+
+    def universe(self, version=None, shortable=True):
+        """Assets of a snapshot, restricted to the shortable universe by default."""
+        df = self.load(version)
+        if df is None:
+            return None
+        return df[shortable_mask(df)] if shortable else df
+
+    def changed_since(self, version, shortable=True):
+        """
+        Net changes between an earlier snapshot and the newest one, e.g. for a downloader that only
+        wants to touch symbols that entered, left or changed in the universe since its last run.
+        With shortable, only symbols in the shortable universe on either side are returned.
+        """
+        latest = self.latest_version()
+        if latest is None:
+            return diff_assets(pd.DataFrame(columns=ASSET_COLUMNS), pd.DataFrame(columns=ASSET_COLUMNS))
+        changes = diff_assets(self.load(version), self.load(latest))
+        if shortable:
+            changes = changes[changes['was_shortable'] | changes['is_shortable']].reset_index(drop=True)
+        return changes
+
+
+_default_store = None
+
+
+def default_store():
+    """The process wide UniverseStore with the default root."""
+    global _default_store
+    if _default_store is None:
+        _default_store = UniverseStore()
+    return _default_store
+
+
+def current_assets(shortable=True, csv_path=ASSETS_CSV):
+    """The current universe from the newest snapshot, or from the CSV where no snapshot was taken yet."""
+    store = default_store()
+    df = store.universe(shortable=shortable)
+    if df is None:
+        if not shortable:
+            # The CSV only ever held the shortable universe
+            raise FileNotFoundError(f"No asset snapshot under {store.root} for the full asset list, "
+                                    f"run asset_universe.py to take one")
+        df = pd.read_csv(csv_path, index_col=0)
+    return df
+
+
+def universe_symbols(shortable=True, changed_since=None):
+    """
+    Symbols of the current universe. With changed_since (a snapshot version) only the symbols
+    added to or changed within the universe after that snapshot; symbols that left it are not
+    returned, so downloaders do not start fetching what was just dropped.
+    """
+    if changed_since is not None:
+        changes = default_store().changed_since(changed_since, shortable)
+        keep = changes['change'] != 'removed'
+        if shortable:
+            keep &= changes['is_shortable']
+        return changes.loc[keep, 'symbol'].tolist()
+    return current_assets(shortable)['symbol'].tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot the Alpaca asset list and show what changed")
+    parser.add_argument('--base-url', default=ALPACA_TRADING_URL)
+    parser.add_argument('--since', help="Also show the net changes since this snapshot version")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = default_store()
+    version, changes = store.refresh(base_url=args.base_url)
+    print(f"Snapshot {version} in {time.perf_counter() - start:.2f}s: {len(store.load(version))} assets, "
+          f"{len(store.universe(version))} shortable")
+    print(changes['change'].value_counts().to_string() if len(changes) else "No changes")
+    if args.since:
+        print(store.changed_since(args.since).to_string())
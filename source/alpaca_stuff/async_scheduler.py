@@ -0,0 +1,138 @@
+import asyncio
+import time
+import numpy as np
+from tqdm.asyncio import tqdm
+
+
+class RateLimitPacer:
+    """
+    Paces requests from the X-RateLimit-Remaining / X-RateLimit-Reset response headers
+    instead of sleeping a fixed amount after every page. Shared by all workers of a session.
+    """
+
+    def __init__(self, reserve=10):
+        self.reserve = reserve  # Start spreading requests out once this few are left in the window
+        self.remaining = None
+        self.reset = None
+        self._lock = asyncio.Lock()
+
+    def update(self, headers):
+        """Records the rate limit state reported by a response."""
+        try:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        # Responses of concurrent requests can arrive out of order, keep the most pessimistic view of a window
+        if self.reset is None or reset > self.reset:
+            self.reset, self.remaining = reset, remaining
+        elif reset == self.reset:
+            self.remaining = min(self.remaining, remaining)
+
+    async def wait(self):
+        """Sleeps as long as needed to spread the remaining requests over the rest of the window."""
+        async with self._lock:
+            if self.remaining is None:
+                return
+
+            now = time.time()
+            if self.reset <= now:
+                # The window has rolled over, the next response will tell us the new budget
+                self.remaining = None
+                return
+
+            if self.remaining <= 0:
+                await asyncio.sleep(self.reset - now)
+                self.remaining = None
+                return
+
+            if self.remaining <= self.reserve:
+                await asyncio.sleep((self.reset - now) / self.remaining)
+            self.remaining -= 1
+
+
+class SchedulerStats:
+    """Per-item latency and throughput collected by run_worker_pool."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.units = {}
+        self.errors = {}
+        self.started = time.perf_counter()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def record(self, item, latency, units):
+        self.latencies[item] = latency
+        self.units[item] = units or 0
+
+    def summary(self):
+        latencies = np.array(list(self.latencies.values())) if self.latencies else np.zeros(1)
+        total_units = sum(self.units.values())
+        return {
+            'items': len(self.latencies),
+            'errors': len(self.errors),
+            'elapsed_s': self.elapsed,
+            'items_per_s': len(self.latencies) / self.elapsed if self.elapsed else 0.0,
+            'units': total_units,
+            'units_per_s': total_units / self.elapsed if self.elapsed else 0.0,
+            'latency_p50_s': float(np.percentile(latencies, 50)),
+            'latency_p95_s': float(np.percentile(latencies, 95)),
+            'latency_max_s': float(latencies.max()),
+        }
+
+    def print_report(self, unit_name='units', slowest=5):
+        s = self.summary()
+        print(f"\nProcessed {s['items']} items ({s['errors']} errors) in {s['elapsed_s']:.1f}s")
+        print(f"Throughput: {s['items_per_s']:.2f} items/s, {s['units_per_s']:.1f} {unit_name}/s")
+        print(f"Latency p50/p95/max: {s['latency_p50_s']:.2f}s / {s['latency_p95_s']:.2f}s / {s['latency_max_s']:.2f}s")
+        for item, latency in sorted(self.latencies.items(), key=lambda x: x[1], reverse=True)[:slowest]:
+            print(f"  {item}: {latency:.2f}s, {self.units[item]} {unit_name}")
+
+
+async def run_worker_pool(items, handler, n_workers=10, queue_size=None, desc="Processing", key=None):
+    """
+    Runs `await handler(item)` for every item on n_workers persistent workers.
+    The queue is bounded so the producer only stays a little ahead of the workers, and a slow
+    item only holds up its own worker. The handler may return a unit count (bars, articles) for
+    throughput reporting, and key(item) names the item in the stats. Returns a SchedulerStats.
+    """
+    key = key or str
+    queue = asyncio.Queue(maxsize=queue_size or 2 * n_workers)
+    stats = SchedulerStats()
+    progress = tqdm(total=len(items), desc=desc)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            start = time.perf_counter()
+            try:
+                units = await handler(item)
+                stats.record(key(item), time.perf_counter() - start, units)
+            except Exception as e:
+                stats.errors[key(item)] = e
+                print(f"Error processing {key(item)}: {e}")
+            finally:
+                progress.update(1)
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(n_workers)]
+    try:
+        for item in items:
+            await queue.put(item)  # Blocks while the queue is full
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+        progress.close()
+        stats.finished = time.perf_counter()
+    return stats
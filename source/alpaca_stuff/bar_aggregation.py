@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+DAY_NS = 24 * 3600 * 10**9
+
+# Default column names of the Alpaca bar format, see bar_store.BAR_SCHEMA
+BAR_NAMES = {'o': 'o', 'h': 'h', 'l': 'l', 'c': 'c', 'v': 'v', 'vw': 'vw', 'n': 'n'}
+
+
+def group_bounds(keys):
+    """Start and end (inclusive) positions of each run of equal keys in a sorted key array."""
+    keys = np.asarray(keys)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=np.int64)
+    ends = np.r_[starts[1:], len(keys)] - 1
+    return starts, ends
+
+
+def aggregate_bars(keys, o, h, l, c, v, vw=None, n=None):
+    """
+    Fused OHLCV roll-up over contiguous runs of equal keys (for example day numbers of sorted bars).
+    Open/close are picked at the run boundaries and high/low/volume use ufunc.reduceat, so there is
+    no hashing group-by and no per-group Python. VWAP is the true sum(vw * v) / sum(v); runs without
+    any volume fall back to the plain mean of vw. Returns a dict of arrays, one entry per run.
+    """
+    starts, ends = group_bounds(keys)
+    out = {'key': np.asarray(keys)[starts]}
+    if len(starts) == 0:
+        for name in ('o', 'h', 'l', 'c', 'v', 'vw', 'n'):
+            out[name] = np.array([], dtype=np.float64)
+        return out
+
+    v = np.asarray(v, dtype=np.float64)
+    out['o'] = np.asarray(o)[starts]
+    out['h'] = np.maximum.reduceat(np.asarray(h), starts)
+    out['l'] = np.minimum.reduceat(np.asarray(l), starts)
+    out['c'] = np.asarray(c)[ends]
+    out['v'] = np.add.reduceat(v, starts)
+
+    if vw is not None:
+        vw = np.asarray(vw, dtype=np.float64)
+        weighted = np.add.reduceat(vw * v, starts)
+        mean_vw = np.add.reduceat(vw, starts) / (ends - starts + 1)
+        has_volume = out['v'] > 0
+        out['vw'] = np.where(has_volume, weighted / np.where(has_volume, out['v'], 1.0), mean_vw)
+    if n is not None:
+        out['n'] = np.add.reduceat(np.asarray(n), starts)
+    return out
+
+
+def day_keys(t, tz=None):
+    """Calendar day number of each timestamp, in tz when given (DatetimeIndex/Series or int64 ns UTC)."""
+    index = pd.DatetimeIndex(t)
+    if tz is not None:
+        index = (index.tz_localize('UTC') if index.tz is None else index).tz_convert(tz)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.as_unit('ns').asi8 // DAY_NS
+
+
+def daily_bars(df, time_col=None, tz=None, names=None):
+    """
+    Rolls time-sorted intraday bars up to days with aggregate_bars. Uses df[time_col] or the index
+    for time, and days are taken in tz (or the timestamps' own zone). names maps o/h/l/c/v/vw/n to
+    the frame's columns, missing ones are skipped. Returns a frame indexed by day start.
+    """
+    names = {role: col for role, col in (names or BAR_NAMES).items() if col in df.columns}
+    times = pd.DatetimeIndex(df[time_col] if time_col is not None else df.index)
+    out_tz = tz or times.tz
+    keys = day_keys(times, tz)
+
+    agg = aggregate_bars(keys, *(df[names[r]].to_numpy() for r in ('o', 'h', 'l', 'c', 'v')),
+                         vw=df[names['vw']].to_numpy() if 'vw' in names else None,
+                         n=df[names['n']].to_numpy() if 'n' in names else None)
+
+    index = pd.DatetimeIndex(agg['key'] * DAY_NS, name=time_col or times.name)
+    if out_tz is not None:
+        index = index.tz_localize(out_tz)
+    return pd.DataFrame({col: agg[role] for role, col in names.items()}, index=index)
@@ -0,0 +1,223 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from bar_store import (BAR_STORE_ROOT, BAR_SCHEMA, _write_partition, list_partitions, month_keys, partition_path,
+                       read_bars, timeframe_to_ns, to_ns)
+from bar_aggregation import DAY_NS, aggregate_bars, group_bounds
+from data_manifest import MANIFEST_PATH, partition_info, record_bar_partitions, remove_file, ticker_info
+from trading_calendar import MARKET_TZ
+
+# Derived timeframes live next to the base store, one bar store tree per timeframe
+BAR_CACHE_ROOT = os.environ.get('BAR_CACHE_ROOT', '../../data/bar_cache')
+BASE_TIMEFRAME = '5Min'
+DERIVED_TIMEFRAMES = ['15Min', '1Hour', '1Day']
+
+
+def local_ns(t, tz=MARKET_TZ):
+    """Wall clock time in tz of int64 ns UTC timestamps, as int64 ns."""
+    index = pd.DatetimeIndex(np.asarray(t, dtype=np.int64)).tz_localize('UTC').tz_convert(tz)
+    return index.tz_localize(None).as_unit('ns').asi8
+
+
+def resample_bars(bars, timeframe, tz=MARKET_TZ):
+    """
+    Rolls time-sorted bars (frame or dict of arrays in the bar store format) up to timeframe. Buckets
+    follow the wall clock in tz, so '1Day' is a trading day and not a UTC day. Each bucket is labelled
+    with its start time as int64 ns UTC. Returns a frame in the bar store format.
+    """
+    bucket_ns = timeframe_to_ns(timeframe)
+    if DAY_NS % bucket_ns:
+        raise ValueError(f"{timeframe} does not divide a day evenly")
+
+    t = np.asarray(bars['t'], dtype=np.int64)
+    local = local_ns(t, tz)
+    keys = local // bucket_ns
+    agg = aggregate_bars(keys, bars['o'], bars['h'], bars['l'], bars['c'], bars['v'], vw=bars['vw'], n=bars['n'])
+
+    # Bucket start in UTC. Localizing the wall clock start is exact across DST changes, and the
+    # rare ambiguous start falls back to the UTC offset of the bucket's first bar.
+    starts, _ = group_bounds(keys)
+    labels = pd.DatetimeIndex(agg['key'] * bucket_ns).tz_localize(tz, ambiguous='NaT', nonexistent='shift_forward')
+    fallback = agg['key'] * bucket_ns + (t - local)[starts]
+    labels = np.where(labels.isna(), fallback, labels.as_unit('ns').asi8)
+
+    columns = {'t': labels, **{col: agg[col] for col in BAR_SCHEMA if col != 't'}}
+    return pd.DataFrame({col: np.asarray(values).astype(BAR_SCHEMA[col]) for col, values in columns.items()})
+
+
+class BarResampler:
+    """
+    Serves bars in any timeframe from the 5 minute base store. Derived timeframes are built once and
+    kept in a bar store tree per timeframe under cache_root. Each derived month is rebuilt only when
+    a base partition it was built from has been written since (from the manifest timestamps), so
+    appending new bars only redoes the latest month. A small LRU of whole frames keeps hot
+    symbols in memory.
+    """
+
+    def __init__(self, base_root=BAR_STORE_ROOT, cache_root=BAR_CACHE_ROOT, tz=MARKET_TZ, max_cached=32,
+                 manifest_path=MANIFEST_PATH):
+        self.base_root = base_root
+        self.cache_root = cache_root
+        self.tz = tz
+        self.max_cached = max_cached
+        self.manifest_path = manifest_path
+        self._memory = OrderedDict()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'partitions_built': 0,
+                      'partitions_removed': 0, 'evictions': 0}
+
+    def _dataset(self, timeframe):
+        return 'bars' if timeframe == BASE_TIMEFRAME else f"bars_{timeframe}"
+
+    def _root(self, timeframe):
+        return self.base_root if timeframe == BASE_TIMEFRAME else os.path.join(self.cache_root, timeframe)
+
+    def _base_partitions(self, ticker):
+        base = partition_info('bars', ticker, self.manifest_path)
+        if not base and list_partitions(ticker, self.base_root):
+            # Base bars written before the manifest existed
+            record_bar_partitions(ticker, self.base_root, self.manifest_path)
+            base = partition_info('bars', ticker, self.manifest_path)
+        return base
+
+    def stale_partitions(self, ticker, timeframe):
+        """Derived months to (re)build and derived months whose base bars are gone."""
+        # Newest write among the base partitions feeding each local month
+        sources = {}
+        for info in self._base_partitions(ticker).values():
+            if not info['rows']:
+                continue
+            first, last = month_keys(local_ns([info['min_t'], info['max_t']], self.tz))
+            for month in pd.period_range(first, last, freq='M').strftime('%Y-%m'):
+                sources[month] = max(sources.get(month, 0.0), info['updated_at'])
+
+        derived = partition_info(self._dataset(timeframe), ticker, self.manifest_path)
+        build = [m for m, updated in sorted(sources.items())
+                 if m not in derived or derived[m]['updated_at'] < updated]
+        remove = [m for m in derived if m not in sources]
+        return build, remove
+
+    def refresh(self, ticker, timeframe):
+        """Brings a derived timeframe up to date with the base store. Returns the number of months rebuilt."""
+        if timeframe == BASE_TIMEFRAME:
+            return 0
+        dataset, root = self._dataset(timeframe), self._root(timeframe)
+        build, remove = self.stale_partitions(ticker, timeframe)
+
+        for month in build:
+            # A local month can start or end a few hours into the neighbouring UTC partitions
+            start = pd.Timestamp(f"{month}-01").tz_localize(self.tz)
+            end = (start + pd.offsets.MonthBegin(1)).as_unit('ns') - pd.Timedelta(1, 'ns')
+            bars = read_bars(ticker, start, end, as_numpy=True, root=self.base_root)
+            if len(bars['t']):
+                os.makedirs(os.path.join(root, ticker), exist_ok=True)
+                _write_partition(resample_bars(bars, timeframe, self.tz), ticker, month, root, dataset,
+                                 self.manifest_path)
+            else:
+                remove.append(month)
+
+        for month in remove:
+            path = partition_path(ticker, month, root)
+            if os.path.exists(path):
+                os.remove(path)
+            remove_file(dataset, ticker, month, self.manifest_path)
+
+        self.stats['partitions_built'] += len(build)
+        self.stats['partitions_removed'] += len(remove)
+        return len(build)
+
+    def get_bars(self, ticker, timeframe='1Day', start=None, end=None, as_numpy=False):
+        """
+        Bars of ticker in timeframe between start and end (inclusive), in the read_bars format.
+        Derived bars are refreshed first if the base store moved on since they were built.
+        """
+        rebuilt = self.refresh(ticker, timeframe)
+        version = tuple((m, info['updated_at'])
+                        for m, info in partition_info(self._dataset(timeframe), ticker, self.manifest_path).items())
+
+        key = (ticker, timeframe)
+        cached = self._memory.get(key)
+        if cached is not None and cached[0] == version:
+            self.stats['memory_hits'] += 1
+            self._memory.move_to_end(key)
+            df = cached[1]
+        else:
+            self.stats['misses' if rebuilt else 'disk_hits'] += 1
+            df = read_bars(ticker, root=self._root(timeframe))
+            self._memory[key] = (version, df)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_cached:
+                self._memory.popitem(last=False)
+                self.stats['evictions'] += 1
+
+        if start is not None or end is not None:
+            t = df['t'].to_numpy()
+            lo = np.searchsorted(t, to_ns(start), 'left') if start is not None else 0
+            hi = np.searchsorted(t, to_ns(end), 'right') if end is not None else len(t)
+            df = df.iloc[lo:hi].reset_index(drop=True)
+        if as_numpy:
+            return {col: df[col].to_numpy() for col in df.columns}
+        return df
+
+    def read_range(self, ticker, timeframe, start=None, end=None, refresh=True):
+        """
+        Bars of ticker in timeframe between start and end as a dict of arrays, read straight from the
+        partitions that overlap the range and not kept in memory. For walking a long history in
+        chunks, where refresh=False skips the staleness check after the first chunk.
+        """
+        if refresh:
+            self.refresh(ticker, timeframe)
+        return read_bars(ticker, start, end, as_numpy=True, root=self._root(timeframe))
+
+    def months(self, ticker, timeframe):
+        """Month keys stored for ticker in timeframe (local months for derived timeframes)."""
+        self.refresh(ticker, timeframe)
+        return list_partitions(ticker, self._root(timeframe))
+
+    def data_version(self, ticker, timeframe=BASE_TIMEFRAME):
+        """
+        Checksum of every stored file behind ticker's bars in timeframe, from the manifest. It changes
+        whenever those bars are rewritten, so results keyed on it go stale with the data. None without bars.
+        """
+        if timeframe == BASE_TIMEFRAME:
+            self._base_partitions(ticker)
+        else:
+            self.refresh(ticker, timeframe)
+        info = ticker_info(self._dataset(timeframe), ticker, self.manifest_path)
+        return info['checksum'] if info and info['rows'] else None
+
+    def build_all(self, tickers, timeframes=DERIVED_TIMEFRAMES):
+        """Refreshes every derived timeframe of the given tickers."""
+        return sum(self.refresh(ticker, timeframe) for ticker in tickers for timeframe in timeframes)
+
+    def hit_rate(self):
+        lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+        return (self.stats['memory_hits'] + self.stats['disk_hits']) / lookups if lookups else 0.0
+
+
+_default_resampler = None
+
+
+def default_resampler():
+    """The process wide BarResampler with the default roots."""
+    global _default_resampler
+    if _default_resampler is None:
+        _default_resampler = BarResampler()
+    return _default_resampler
+
+
+def get_bars(ticker, timeframe='1Day', start=None, end=None, as_numpy=False):
+    """get_bars on the process wide BarResampler."""
+    return default_resampler().get_bars(ticker, timeframe, start, end, as_numpy)
+
+
+def data_version(ticker, timeframe=BASE_TIMEFRAME):
+    """data_version on the process wide BarResampler."""
+    return default_resampler().data_version(ticker, timeframe)
+
+
+if __name__ == "__main__":
+    from bar_store import list_tickers
+    resampler = BarResampler()
+    print(f"Rebuilt {resampler.build_all(list_tickers())} partitions")
+    print(resampler.stats)
@@ -0,0 +1,289 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute
+import pyarrow.parquet as pq
+from tqdm import tqdm
+from data_manifest import MANIFEST_PATH, record_file
+
+# Root of the columnar bar store, laid out as <root>/<TICKER>/<YYYY-MM>.parquet
+BAR_STORE_ROOT = os.environ.get('BAR_STORE_ROOT', '../../data/bar_store')
+# Legacy per-ticker CSV tree written by the old downloaders
+CSV_ROOT = '../../data/bars'
+
+# Stored column types. 't' is the bar open time in nanoseconds since the epoch (UTC)
+BAR_SCHEMA = {
+    't': 'int64',
+    'o': 'float64',
+    'h': 'float64',
+    'l': 'float64',
+    'c': 'float64',
+    'v': 'int64',
+    'n': 'int64',
+    'vw': 'float64',
+}
+
+
+def to_ns(value):
+    """Converts a timestamp-like value (int ns, str, datetime) to int64 nanoseconds since the epoch (UTC)."""
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize('UTC')
+    return int(ts.value)
+
+
+def to_bar_frame(data):
+    """Converts Alpaca bar dicts (or a DataFrame of them) into a typed frame sorted and de-duplicated on 't'."""
+    df = pd.DataFrame(data)
+    if df.empty:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in BAR_SCHEMA.items()})
+
+    if not pd.api.types.is_integer_dtype(df['t']):
+        df['t'] = pd.to_datetime(df['t'], utc=True).dt.as_unit('ns').astype('int64')
+
+    for col, dtype in BAR_SCHEMA.items():
+        if col not in df:
+            df[col] = 0
+        if dtype == 'int64':
+            df[col] = pd.to_numeric(df[col]).fillna(0)
+        df[col] = df[col].astype(dtype)
+
+    df = df[list(BAR_SCHEMA)]
+    df = df.drop_duplicates('t', keep='last').sort_values('t', kind='stable')
+    return df.reset_index(drop=True)
+
+
+def month_keys(t):
+    """Returns the 'YYYY-MM' partition key for each int64 ns timestamp."""
+    months = np.asarray(t, dtype='int64').astype('datetime64[ns]').astype('datetime64[M]')
+    return np.datetime_as_string(months, unit='M')
+
+
+def ticker_dir(ticker, root=BAR_STORE_ROOT):
+    return os.path.join(root, ticker)
+
+
+def partition_path(ticker, month, root=BAR_STORE_ROOT):
+    return os.path.join(root, ticker, f"{month}.parquet")
+
+
+def list_partitions(ticker, root=BAR_STORE_ROOT):
+    """Lists the month keys stored for a ticker, oldest first."""
+    directory = ticker_dir(ticker, root)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(f[:-len('.parquet')] for f in os.listdir(directory) if f.endswith('.parquet'))
+
+
+def list_tickers(root=BAR_STORE_ROOT):
+    """Lists all tickers that have at least one stored partition."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root) if list_partitions(name, root))
+
+
+def _write_partition(df, ticker, month, root=BAR_STORE_ROOT, dataset='bars', manifest_path=MANIFEST_PATH):
+    # Write to a temporary file first so a crash never leaves a half written partition behind
+    path = partition_path(ticker, month, root)
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False, compression='zstd')
+    os.replace(tmp_path, path)
+    # Keep the manifest in step so metadata queries never have to open the partitions (None skips it)
+    if manifest_path is not None:
+        t = df['t'].to_numpy()
+        record_file(dataset, ticker, month, path, len(df), t.min() if len(t) else None, t.max() if len(t) else None,
+                    manifest_path)
+
+
+def write_bars(ticker, data, root=BAR_STORE_ROOT, manifest_path=MANIFEST_PATH):
+    """Writes bars for a ticker, merging them into any existing month partitions. Returns the months written."""
+    df = to_bar_frame(data)
+    if df.empty:
+        return []
+
+    os.makedirs(ticker_dir(ticker, root), exist_ok=True)
+    keys = month_keys(df['t'].to_numpy())
+    # Rows are sorted on 't', so each month is one contiguous run
+    boundaries = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(df)]))
+
+    written = []
+    for start, end in zip(starts, ends):
+        month = keys[start]
+        _merge_partition(ticker, month, df.iloc[start:end], root, manifest_path)
+        written.append(month)
+    return written
+
+
+def _merge_partition(ticker, month, part, root=BAR_STORE_ROOT, manifest_path=MANIFEST_PATH):
+    # Fold new rows into the month partition, new rows win on duplicate timestamps
+    path = partition_path(ticker, month, root)
+    if os.path.exists(path):
+        part = to_bar_frame(pd.concat([pd.read_parquet(path), part], ignore_index=True))
+    _write_partition(part, ticker, month, root, manifest_path=manifest_path)
+
+
+def page_to_columns(bars):
+    """Converts one page of Alpaca bar dicts straight into typed NumPy column arrays, sorted on 't'."""
+    n = len(bars)
+    columns = {'t': pd.to_datetime([b['t'] for b in bars], utc=True).as_unit('ns').asi8}
+    for col, dtype in BAR_SCHEMA.items():
+        if col != 't':
+            columns[col] = np.fromiter((b.get(col, 0) for b in bars), dtype=dtype, count=n)
+    order = np.argsort(columns['t'], kind='stable')
+    return {col: values[order] for col, values in columns.items()}
+
+
+class BarStoreWriter:
+    """
+    Streams pages of bars for one ticker into the store. Completed months are written as soon as
+    a page moves past them, so memory stays bounded by roughly one page plus one open month.
+    """
+
+    def __init__(self, ticker, root=BAR_STORE_ROOT, max_buffer_rows=10000, manifest_path=MANIFEST_PATH):
+        self.ticker = ticker
+        self.root = root
+        self.manifest_path = manifest_path
+        self.max_buffer_rows = max_buffer_rows
+        self.rows = 0
+        self._month = None
+        self._buffer = []
+
+    def append(self, bars):
+        """Appends one page of bar dicts (or a dict of column arrays). Returns the number of rows added."""
+        columns = bars if isinstance(bars, dict) else page_to_columns(bars)
+        n = len(columns['t'])
+        if n == 0:
+            return 0
+
+        os.makedirs(ticker_dir(self.ticker, self.root), exist_ok=True)
+        keys = month_keys(columns['t'])
+        boundaries = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [n]))
+
+        for start, end in zip(starts, ends):
+            month = keys[start]
+            if month != self._month:
+                # Pages arrive in time order, so the buffered month is complete
+                self.flush()
+                self._month = month
+            self._buffer.append({col: values[start:end] for col, values in columns.items()})
+            if sum(len(chunk['t']) for chunk in self._buffer) >= self.max_buffer_rows:
+                self.flush()
+
+        self.rows += n
+        return n
+
+    def flush(self):
+        """Writes the buffered rows of the open month to disk."""
+        if not self._buffer:
+            return
+        part = pd.DataFrame({col: np.concatenate([chunk[col] for chunk in self._buffer]) for col in BAR_SCHEMA})
+        _merge_partition(self.ticker, self._month, to_bar_frame(part), self.root, self.manifest_path)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        return self.rows
+
+
+def read_bars(ticker, start=None, end=None, columns=None, as_numpy=False, root=BAR_STORE_ROOT):
+    """
+    Reads stored bars for a ticker between start and end (inclusive).
+    Returns a DataFrame with int64 ns 't', or a dict of NumPy arrays when as_numpy is True.
+    """
+    months = list_partitions(ticker, root)
+    start_ns = to_ns(start) if start is not None else None
+    end_ns = to_ns(end) if end is not None else None
+
+    # Only open the partitions that overlap the requested range
+    if start_ns is not None:
+        months = [m for m in months if m >= month_keys([start_ns])[0]]
+    if end_ns is not None:
+        months = [m for m in months if m <= month_keys([end_ns])[0]]
+
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(['t'] + list(columns)))
+
+    tables = [pq.ParquetFile(partition_path(ticker, m, root)).read(columns=read_columns, use_threads=False)
+              for m in months]
+    if tables:
+        df = pa.concat_tables(tables).to_pandas()
+    else:
+        df = pd.DataFrame({col: pd.Series(dtype=BAR_SCHEMA[col]) for col in (read_columns or BAR_SCHEMA)})
+
+    if start_ns is not None:
+        df = df[df['t'] >= start_ns]
+    if end_ns is not None:
+        df = df[df['t'] <= end_ns]
+    if columns is not None:
+        df = df[list(columns)]
+    df = df.reset_index(drop=True)
+
+    if as_numpy:
+        return {col: df[col].to_numpy() for col in df.columns}
+    return df
+
+
+def last_timestamp(ticker, root=BAR_STORE_ROOT):
+    """Returns the newest stored bar time for a ticker in int64 ns, or None if nothing is stored."""
+    months = list_partitions(ticker, root)
+    if not months:
+        return None
+    t = pq.ParquetFile(partition_path(ticker, months[-1], root)).read(columns=['t'], use_threads=False)['t']
+    return int(pa.compute.max(t).as_py())
+
+
+def timeframe_to_ns(timeframe):
+    """Converts an Alpaca timeframe string such as '5Min', '1Hour' or '1Day' to nanoseconds."""
+    units = {'Min': 'min', 'T': 'min', 'Hour': 'h', 'H': 'h', 'Day': 'D', 'D': 'D'}
+    match = re.fullmatch(r'(\d*)(Min|T|Hour|H|Day|D)', timeframe)
+    if match is None:
+        raise ValueError(f"Unsupported timeframe: {timeframe}")
+    amount, unit = match.groups()
+    return int(pd.Timedelta(int(amount or 1), unit=units[unit]).value)
+
+
+def next_bar_start(ticker, timeframe, default_start, root=BAR_STORE_ROOT):
+    """
+    Returns the ISO start time for an incremental request: one bar after the newest stored bar,
+    or default_start when nothing is stored. Returns None when the ticker is already current.
+    """
+    last_t = last_timestamp(ticker, root)
+    if last_t is None:
+        return default_start
+
+    bar_ns = timeframe_to_ns(timeframe)
+    start_ns = last_t + bar_ns
+    # The bar starting at start_ns has not closed yet, so there is nothing new to fetch
+    if start_ns + bar_ns > pd.Timestamp.now(tz='UTC').value:
+        return None
+    return pd.Timestamp(start_ns, tz='UTC').isoformat()
+
+
+def migrate_csv_tree(csv_root=CSV_ROOT, root=BAR_STORE_ROOT, file_name="2y_5m.csv", manifest_path=MANIFEST_PATH):
+    """One-time conversion of the legacy data/bars/<TICKER>/2y_5m.csv tree into the bar store."""
+    tickers = sorted(name for name in os.listdir(csv_root)
+                     if os.path.exists(os.path.join(csv_root, name, file_name)))
+    migrated = 0
+    for ticker in tqdm(tickers, desc="Migrating bars"):
+        try:
+            df = pd.read_csv(os.path.join(csv_root, ticker, file_name))
+            write_bars(ticker, df, root, manifest_path)
+            migrated += 1
+        except pd.errors.EmptyDataError:
+            print(f"Skipping empty file for {ticker}")
+        except Exception as e:
+            print(f"Error migrating {ticker}: {e}")
+    return migrated
+
+
+if __name__ == "__main__":
+    migrate_csv_tree()
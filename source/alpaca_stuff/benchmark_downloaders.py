@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import pandas as pd
+from bar_store import CSV_ROOT, list_tickers
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DOWNLOADERS = {
+    'threads (get_alpaca_bars.py)': 'get_alpaca_bars.py',
+    'asyncio (get_alpaca_bars_aiohttp.py)': 'get_alpaca_bars_aiohttp.py',
+}
+
+
+def mock_stats(base_url, reset=False):
+    request = urllib.request.Request(f"{base_url}/stats", method='POST' if reset else 'GET')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def start_mock_server(port, latency, rate_limit, window):
+    """Starts mock_alpaca_server.py in its own process and waits until it answers."""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'mock_alpaca_server.py'), '--port', str(port),
+         '--latency', str(latency), '--rate-limit', str(rate_limit), '--window', str(window)],
+        cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            mock_stats(base_url)
+            return process, base_url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock server did not start")
+
+
+def run_downloader(script, symbols, base_url):
+    """Runs one downloader against the mock server in a scratch tree and measures it."""
+    with tempfile.TemporaryDirectory() as workdir:
+        # Mirror the repo layout, the downloaders read ../../data/shortable_assets.csv relative to their cwd
+        cwd = os.path.join(workdir, 'source', 'alpaca_stuff')
+        os.makedirs(os.path.join(cwd, 'cache'))
+        os.makedirs(os.path.join(workdir, 'data'))
+        pd.DataFrame({'symbol': symbols}).to_csv(os.path.join(workdir, 'data', 'shortable_assets.csv'))
+
+        env = dict(os.environ,
+                   ALPACA_DATA_URL=base_url,
+                   BAR_STORE_ROOT=os.path.join(workdir, 'data', 'bar_store'),
+                   DATA_MANIFEST=os.path.join(workdir, 'data', 'manifest.sqlite'),
+                   UNIVERSE_ROOT=os.path.join(workdir, 'data', 'universe'),
+                   PYTHONPATH=HERE,
+                   APCA_API_KEY_ID='mock',
+                   APCA_API_SECRET_KEY='mock')
+
+        mock_stats(base_url, reset=True)
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(HERE, script)], cwd=cwd, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        stats = mock_stats(base_url)
+        stored = len(list_tickers(env['BAR_STORE_ROOT']))
+
+    return {
+        'exit_code': os.waitstatus_to_exitcode(status),
+        'elapsed_s': elapsed,
+        'requests': stats['requests'],
+        'requests_per_s': stats['requests'] / elapsed,
+        'rate_limited': stats['rate_limited'],
+        'bars': stats['bars'],
+        'bars_per_s': stats['bars'] / elapsed,
+        'peak_rss_mb': usage.ru_maxrss / 1024,  # ru_maxrss is in KiB on Linux
+        'tickers_stored': stored,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bar downloaders against the local mock API")
+    parser.add_argument('--symbols', type=int, default=20, help="Number of symbols to download")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help="Mock response latency in seconds")
+    parser.add_argument('--rate-limit', type=int, default=200, help="Mock requests per window")
+    parser.add_argument('--window', type=int, default=60, help="Mock rate limit window in seconds")
+    args = parser.parse_args()
+
+    symbols = list_tickers(os.path.join(HERE, '..', '..', 'data', 'bar_store'))
+    if not symbols:
+        csv_root = os.path.join(HERE, CSV_ROOT)
+        symbols = sorted(s for s in os.listdir(csv_root) if os.path.isdir(os.path.join(csv_root, s)))
+    symbols = symbols[:args.symbols]
+
+    server, base_url = start_mock_server(args.port, args.latency, args.rate_limit, args.window)
+    try:
+        # Warm the mock's data cache so the first downloader does not pay for loading it
+        urllib.request.urlopen(f"{base_url}/v2/stocks/{symbols[0]}/bars?limit=1").read()
+        results = {name: run_downloader(script, symbols, base_url) for name, script in DOWNLOADERS.items()}
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"\n{len(symbols)} symbols, latency {args.latency}s, {args.rate_limit} requests / {args.window}s")
+    print(pd.DataFrame(results).T.to_string(float_format=lambda x: f"{x:,.1f}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+import numpy as np
 import backtrader as bt
 from helper_functions import time_it
 
@@ -24,6 +28,94 @@ class AlpacaStockData(bt.feeds.PandasData):
     )
 
 
+# Days from 0001-01-01 (backtrader's date numbers) to 1970-01-01
+EPOCH_ORDINAL = 719163
+FEED_LINES = ('datetime', 'open', 'high', 'low', 'close', 'volume', 'openinterest', 'vwap')
+
+
+def date_numbers(t):
+    """
+    bt.date2num for int64 ns UTC timestamps. The day/hour/minute/second/microsecond parts are split
+    with NumPy and summed with math.fsum in the same way, so the floats are identical.
+    """
+    t = np.asarray(t, dtype=np.int64)
+    days, ns = np.divmod(t, 86400 * 10**9)
+    us = ns // 1000
+    seconds, us = np.divmod(us, 10**6)
+    minutes, seconds = np.divmod(seconds, 60)
+    hours, minutes = np.divmod(minutes, 60)
+    parts = zip((days + EPOCH_ORDINAL).astype(np.float64).tolist(), (hours / 24.0).tolist(), (minutes / 1440.0).tolist(),
+                (seconds / 86400.0).tolist(), (us / 86400e6).tolist())
+    return np.array([math.fsum(p) for p in parts], dtype=np.float64)
+
+
+class BarBuffers:
+    """
+    A symbol's bars converted once into backtrader's line buffers (array('d') per line). Any number of
+    ArrayStockData feeds, in any number of Cerebro instances, can be built from the same BarBuffers.
+    """
+
+    def __init__(self, t, o, h, l, c, v, vw):
+        columns = {
+            'datetime': date_numbers(t),
+            'open': o,
+            'high': h,
+            'low': l,
+            'close': c,
+            'volume': v,
+            'openinterest': np.full(len(t), np.nan),  # not in the data, left empty like PandasData does
+            'vwap': vw,
+        }
+        self.lines = {name: array('d', np.ascontiguousarray(values, dtype=np.float64).tobytes())
+                      for name, values in columns.items()}
+
+    @classmethod
+    def from_bars(cls, bars):
+        """From a dict of t/o/h/l/c/v/vw arrays, as bar_store.read_bars(as_numpy=True) returns."""
+        return cls(*(bars[col] for col in ('t', 'o', 'h', 'l', 'c', 'v', 'vw')))
+
+    def __len__(self):
+        return len(self.lines['datetime'])
+
+
+class ArrayStockData(bt.feeds.DataBase):
+    """
+    AlpacaStockData without the DataFrame: preload copies whole line buffers from a BarBuffers
+    (one memcpy per line) instead of loading the bars one row at a time.
+    """
+
+    lines = ('vwap',)
+
+    params = (
+        ('buffers', None),
+    )
+
+    def start(self):
+        super(ArrayStockData, self).start()
+        self._idx = -1
+
+    def _bounds(self):
+        # fromdate/todate as positions in the buffers
+        dt = self.p.buffers.lines['datetime']
+        return bisect_left(dt, self.fromdate), bisect_right(dt, self.todate)
+
+    def preload(self):
+        lo, hi = self._bounds()
+        for name in FEED_LINES:
+            getattr(self.lines, name).array = self.p.buffers.lines[name][lo:hi]
+        self.home()
+
+    def _load(self):
+        # Bar by bar path for runs without preload
+        lo, hi = self._bounds()
+        self._idx = max(self._idx + 1, lo)
+        if self._idx >= hi:
+            return False
+        for name in FEED_LINES:
+            getattr(self.lines, name)[0] = self.p.buffers.lines[name][self._idx]
+        return True
+
+
 # Strategy class
 class MyStrategy(bt.Strategy):
     params = (
@@ -33,10 +125,12 @@ class MyStrategy(bt.Strategy):
         ('macd_fast', 12),  # Period for the fast moving average
         ('macd_slow', 26),  # Period for the slow moving average
         ('macd_signal', 9),  # Period for the signal line
+        ('long_only', False),  # Exit and trailing stop cancel each other and no stop is placed after a sell
     )
 
     def __init__(self):
         self.order = None
+        self.stop_order = None
         self.macd = bt.indicators.MACD(
             self.data.close,
             period_me1=self.p.macd_fast,
@@ -52,13 +146,13 @@ class MyStrategy(bt.Strategy):
         else:
             if self.macd.macd[0] < self.macd.signal[0] and \
                     self.data.close[0] < self.data.vwap[0] * self.p.exit_multiplier:
-                self.order = self.sell()
+                self.order = self.sell(oco=self.stop_order if self.p.long_only else None)
 
     def notify_order(self, order):
         if order.status in [order.Completed]:
             if order.isbuy():
-                self.sell(exectype=bt.Order.StopTrail, trailpercent=self.p.stop_loss)
-            elif order.issell():
+                self.stop_order = self.sell(exectype=bt.Order.StopTrail, trailpercent=self.p.stop_loss)
+            elif order.issell() and not self.p.long_only:
                 self.buy(exectype=bt.Order.StopTrail, trailpercent=self.p.stop_loss)
 
 
@@ -101,3 +195,66 @@ class FractionalSizer(bt.Sizer):
         else:
             # Return default for sell situation
             return self.broker.getposition(data).size
+
+
+def strategy_params(strategy, params):
+    """The strategy's backtrader defaults updated with params."""
+    return {**dict(strategy.params._getitems()), **params}
+
+
+class EquityCurve(bt.Analyzer):
+    """Account value at the end of every bar. get_analysis() returns (int64 ns times, values)."""
+
+    def start(self):
+        self.times = array('d')
+        self.values = array('d')
+
+    def next(self):
+        self.times.append(self.data.datetime[0])
+        self.values.append(self.strategy.broker.getvalue())
+
+    def get_analysis(self):
+        # Date numbers are days since 0001-01-01, bars sit on whole seconds
+        seconds = np.round((np.frombuffer(self.times) - EPOCH_ORDINAL) * 86400.0).astype(np.int64)
+        return seconds * 10**9, np.frombuffer(self.values).copy()
+
+
+def _lookup(analysis, *keys, default=None):
+    # Analyzer results are nested AutoOrderedDicts that miss keys when e.g. no trade was closed
+    for key in keys:
+        if analysis is None or key not in analysis:
+            return default
+        analysis = analysis[key]
+    return analysis
+
+
+def collect_analysis(strat):
+    """
+    Flattens the ta/sharpe/drawdown/returns analyzers of a finished strategy (or OptReturn)
+    into a dict with the same figures analyze_bt_results prints.
+    """
+    trade_analysis = strat.analyzers.ta.get_analysis()
+    sharpe_ratio = strat.analyzers.sharpe.get_analysis()
+    drawdown = strat.analyzers.drawdown.get_analysis()
+    returns = strat.analyzers.returns.get_analysis()
+
+    return {
+        'total_trades': _lookup(trade_analysis, 'total', 'total', default=0),
+        'closed_trades': _lookup(trade_analysis, 'total', 'closed', default=0),
+        'won_trades': _lookup(trade_analysis, 'won', 'total', default=0),
+        'lost_trades': _lookup(trade_analysis, 'lost', 'total', default=0),
+        'winning_streak': _lookup(trade_analysis, 'streak', 'won', 'longest', default=0),
+        'losing_streak': _lookup(trade_analysis, 'streak', 'lost', 'longest', default=0),
+        'pnl_net_total': _lookup(trade_analysis, 'pnl', 'net', 'total', default=0.0),
+        'pnl_net_average': _lookup(trade_analysis, 'pnl', 'net', 'average', default=0.0),
+        'sharpe_ratio': sharpe_ratio.get('sharperatio'),
+        'max_drawdown_len': _lookup(drawdown, 'max', 'len', default=0),
+        'max_drawdown': _lookup(drawdown, 'max', 'drawdown', default=0.0),
+        'max_moneydown': _lookup(drawdown, 'max', 'moneydown', default=0.0),
+        'drawdown': drawdown.get('drawdown', 0.0),
+        'moneydown': drawdown.get('moneydown', 0.0),
+        'rtot': returns.get('rtot'),
+        'ravg': returns.get('ravg'),
+        'rnorm': returns.get('rnorm'),
+        'rnorm100': returns.get('rnorm100'),
+    }
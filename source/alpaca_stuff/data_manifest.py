@@ -0,0 +1,159 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+import pandas as pd
+import pyarrow.parquet as pq
+
+# One manifest for every dataset (bars, news, ...), one row per stored file
+MANIFEST_PATH = os.environ.get('DATA_MANIFEST', '../../data/manifest.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    dataset TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    partition TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    min_t INTEGER,
+    max_t INTEGER,
+    bytes INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (dataset, ticker, partition)
+);
+CREATE VIEW IF NOT EXISTS tickers AS
+    SELECT dataset, ticker, SUM(rows) AS rows, MIN(min_t) AS min_t, MAX(max_t) AS max_t,
+           SUM(bytes) AS bytes, COUNT(*) AS partitions, MAX(updated_at) AS updated_at
+    FROM files GROUP BY dataset, ticker;
+"""
+
+
+def connect(path=MANIFEST_PATH):
+    """Opens the manifest, creating it if needed. Each caller gets its own connection so threads are safe."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record_file(dataset, ticker, partition, file_path, rows, min_t, max_t, path=MANIFEST_PATH):
+    """Records (or replaces) the entry of one file after it has been written."""
+    entry = (dataset, ticker, partition, int(rows),
+             None if min_t is None else int(min_t), None if max_t is None else int(max_t),
+             os.path.getsize(file_path), file_checksum(file_path), time.time())
+    with closing(connect(path)) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", entry)
+
+
+def remove_dataset(dataset, path=MANIFEST_PATH):
+    with closing(connect(path)) as conn, conn:
+        conn.execute("DELETE FROM files WHERE dataset = ?", (dataset,))
+
+
+def remove_file(dataset, ticker, partition, path=MANIFEST_PATH):
+    with closing(connect(path)) as conn, conn:
+        conn.execute("DELETE FROM files WHERE dataset = ? AND ticker = ? AND partition = ?", (dataset, ticker, partition))
+
+
+def partition_info(dataset, ticker, path=MANIFEST_PATH):
+    """{partition: {'rows', 'min_t', 'max_t', 'updated_at'}} for every recorded file of a ticker."""
+    with closing(connect(path)) as conn:
+        rows = conn.execute("SELECT partition, rows, min_t, max_t, updated_at FROM files "
+                            "WHERE dataset = ? AND ticker = ? ORDER BY partition", (dataset, ticker)).fetchall()
+    return {p: dict(zip(('rows', 'min_t', 'max_t', 'updated_at'), rest)) for p, *rest in rows}
+
+
+def ticker_info(dataset, ticker, path=MANIFEST_PATH):
+    """
+    Row count, min/max timestamp (int64 ns), byte size, partition count and a checksum combining the
+    checksums of all the ticker's files. Returns None for an unknown ticker.
+    """
+    with closing(connect(path)) as conn:
+        row = conn.execute("SELECT rows, min_t, max_t, bytes, partitions FROM tickers WHERE dataset = ? AND ticker = ?",
+                           (dataset, ticker)).fetchone()
+        if row is None:
+            return None
+        checksums = conn.execute("SELECT checksum FROM files WHERE dataset = ? AND ticker = ? ORDER BY partition",
+                                 (dataset, ticker)).fetchall()
+    combined = hashlib.blake2b(''.join(c for c, in checksums).encode(), digest_size=16).hexdigest()
+    return dict(zip(('rows', 'min_t', 'max_t', 'bytes', 'partitions'), row), checksum=combined)
+
+
+def dataset_summary(dataset, path=MANIFEST_PATH):
+    """All tickers of a dataset with their row count, time range, size and partition count."""
+    with closing(connect(path)) as conn:
+        return pd.read_sql_query("SELECT * FROM tickers WHERE dataset = ? ORDER BY ticker", conn, params=(dataset,))
+
+
+def list_tickers(dataset, path=MANIFEST_PATH):
+    with closing(connect(path)) as conn:
+        return [t for t, in conn.execute("SELECT ticker FROM tickers WHERE dataset = ? ORDER BY ticker", (dataset,))]
+
+
+def top_tickers(dataset, n=20, by='rows', path=MANIFEST_PATH):
+    """The n tickers with the most coverage by rows, bytes or time span."""
+    order = {'rows': 'rows', 'bytes': 'bytes', 'span': 'max_t - min_t'}[by]
+    with closing(connect(path)) as conn:
+        return [t for t, in conn.execute(
+            f"SELECT ticker FROM tickers WHERE dataset = ? ORDER BY {order} DESC, ticker LIMIT ?", (dataset, n))]
+
+
+def record_bar_partitions(ticker, root=None, path=MANIFEST_PATH, dataset='bars'):
+    """Records every stored partition of one ticker, reading only the Parquet footers."""
+    # bar_store records into this module on every write, so import it lazily to avoid a cycle
+    from bar_store import BAR_STORE_ROOT, list_partitions, partition_path
+    root = root or BAR_STORE_ROOT
+    for month in list_partitions(ticker, root):
+        file_path = partition_path(ticker, month, root)
+        metadata = pq.ParquetFile(file_path).metadata
+        t_index = metadata.schema.names.index('t')
+        stats = [metadata.row_group(i).column(t_index).statistics for i in range(metadata.num_row_groups)]
+        stats = [s for s in stats if s is not None and s.has_min_max]
+        record_file(dataset, ticker, month, file_path, metadata.num_rows,
+                    min((s.min for s in stats), default=None), max((s.max for s in stats), default=None), path)
+
+
+def rebuild_bars(root=None, path=MANIFEST_PATH):
+    """Rebuilds the 'bars' entries from the bar store."""
+    from bar_store import BAR_STORE_ROOT, list_tickers as store_tickers
+    root = root or BAR_STORE_ROOT
+    remove_dataset('bars', path)
+    for ticker in store_tickers(root):
+        record_bar_partitions(ticker, root, path)
+
+
+def rebuild_news(news_root='../../data/news', path=MANIFEST_PATH):
+    """Rebuilds the 'news' entries from the per-ticker TickerNewsSummary.csv files (one full scan)."""
+    remove_dataset('news', path)
+    if not os.path.isdir(news_root):
+        return
+    for ticker in sorted(os.listdir(news_root)):
+        file_path = os.path.join(news_root, ticker, "TickerNewsSummary.csv")
+        if not os.path.exists(file_path):
+            continue
+        try:
+            created_at = pd.to_datetime(pd.read_csv(file_path, usecols=['created_at'])['created_at'], utc=True)
+        except (pd.errors.EmptyDataError, ValueError):
+            print(f"Skipping unreadable file: {file_path}")
+            continue
+        t = created_at.dt.as_unit('ns').astype('int64')
+        record_file('news', ticker, 'TickerNewsSummary', file_path, len(t),
+                    t.min() if len(t) else None, t.max() if len(t) else None, path)
+
+
+if __name__ == "__main__":
+    rebuild_bars()
+    rebuild_news()
+    print(dataset_summary('bars').describe())
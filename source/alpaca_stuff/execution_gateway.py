@@ -0,0 +1,376 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+import aiohttp
+from aiohttp import ClientSession, TCPConnector
+from aiolimiter import AsyncLimiter
+from async_scheduler import RateLimitPacer
+from live_pipeline import LatencyHistogram
+from helper_functions import load_api_keys
+
+paper_key, paper_secret = load_api_keys()
+
+# Point at mock_alpaca_server.py with ALPACA_TRADING_URL=http://127.0.0.1:8765
+ALPACA_TRADING_URL = os.environ.get('ALPACA_TRADING_URL', 'https://paper-api.alpaca.markets')
+TERMINAL_STATUSES = ('filled', 'canceled', 'expired', 'rejected')
+GATEWAY_STAGES = ['signal_to_submit', 'submit_to_ack', 'ack_to_fill', 'signal_to_fill']
+
+
+class OrderTicket:
+    """
+    One order from the gateway's point of view. accepted resolves with the order JSON once the API
+    took it, done resolves with the final order JSON once trade_updates report a terminal status.
+    """
+
+    def __init__(self, request, signal_time=None):
+        loop = asyncio.get_running_loop()
+        self.request = request
+        self.client_order_id = request['client_order_id']
+        self.symbol = request['symbol']
+        self.id = None
+        self.status = 'queued'
+        self.order = None
+        self.error = None
+        self.times = {'signal': signal_time or time.perf_counter(), 'queued': time.perf_counter()}
+        self.accepted = loop.create_future()
+        self.done = loop.create_future()
+
+    def fail(self, error):
+        self.status, self.error = 'failed', error
+        for future in (self.accepted, self.done):
+            if not future.done():
+                future.set_exception(error)
+                # Nobody may be waiting on a ticket placed from a signal callback
+                future.exception()
+
+
+class ExecutionGateway:
+    """
+    Async order layer for the Alpaca trading API. Orders go onto an internal queue and are sent by
+    max_connections dispatchers over one keep-alive connection pool, paced by the rate limit headers
+    (RateLimitPacer) and an AsyncLimiter. The API has no bulk order endpoint, so a burst of signals
+    is batched by draining the queue over all connections at once. Order state comes from the
+    trade_updates websocket instead of polling, identical position/order reads that overlap share
+    one request and a short-lived cache, and every order records signal -> submit -> ack -> fill
+    latency.
+    """
+
+    def __init__(self, key=paper_key, secret=paper_secret, base_url=ALPACA_TRADING_URL, max_connections=4,
+                 rate_limit=200, rate_window=60, cache_ttl=0.5, stream=True, start_timeout=10.0):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'APCA-API-KEY-ID': key, 'APCA-API-SECRET-KEY': secret}
+        self.key, self.secret = key, secret
+        self.max_connections = max_connections
+        self.rate_limiter = AsyncLimiter(rate_limit, rate_window)
+        self.pacer = RateLimitPacer()
+        self.cache_ttl = cache_ttl
+        self.use_stream = stream
+        self.start_timeout = start_timeout
+        self.session = None
+        self.queue = asyncio.Queue()
+        self.tickets = {}
+        self.positions = {}  # symbol -> qty, kept current from fills
+        self.latency = {stage: LatencyHistogram() for stage in GATEWAY_STAGES}
+        self.counts = {'submitted': 0, 'accepted': 0, 'rejected': 0, 'failed': 0, 'filled': 0, 'canceled': 0,
+                       'rate_limited': 0, 'requests': 0, 'coalesced': 0, 'cached': 0, 'updates': 0,
+                       'update_errors': 0}
+        self._inflight = {}
+        self._cache = {}
+        self._tasks = []
+        self._stream_ready = None
+
+    # ----- Lifecycle -----
+
+    async def start(self):
+        """
+        Opens the connection pool, starts the dispatchers and the trade_updates listener. Raises (and
+        closes again) when the stream rejects the keys or is not listening within start_timeout seconds.
+        """
+        self.session = ClientSession(connector=TCPConnector(limit_per_host=self.max_connections,
+                                                            keepalive_timeout=60))
+        self._tasks = [asyncio.create_task(self._dispatcher()) for _ in range(self.max_connections)]
+        if self.use_stream:
+            self._stream_ready = asyncio.get_running_loop().create_future()
+            self._tasks.append(asyncio.create_task(self._listen_trade_updates()))
+            try:
+                await asyncio.wait_for(asyncio.shield(self._stream_ready), self.start_timeout)
+            except BaseException as e:
+                await self.close()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise asyncio.TimeoutError(f"trade_updates not listening after {self.start_timeout}s") from None
+                raise
+        return self
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # ----- HTTP -----
+
+    async def _request(self, method, path, **kwargs):
+        """One API call with pacing, retried while the API answers 429. Returns (status, body)."""
+        while True:
+            await self.pacer.wait()
+            async with self.rate_limiter:
+                self.counts['requests'] += 1
+                async with self.session.request(method, f"{self.base_url}{path}", headers=self.headers,
+                                                **kwargs) as response:
+                    self.pacer.update(response.headers)
+                    body = await response.json() if response.status != 204 else None
+            if response.status != 429:
+                return response.status, body
+            # Nothing was accepted, so retrying an order here cannot duplicate it
+            self.counts['rate_limited'] += 1
+            reset = response.headers.get('X-RateLimit-Reset')
+            await asyncio.sleep(max(int(reset) - time.time(), 0.1) if reset else 1.0)
+
+    async def _get(self, path, params=None):
+        # Overlapping identical reads share one request, and the result is reused for cache_ttl seconds
+        key = (path, tuple(sorted((params or {}).items())))
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+            self.counts['cached'] += 1
+            return cached[1]
+        if key in self._inflight:
+            self.counts['coalesced'] += 1
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            status, body = await self._request('GET', path, params=params)
+            if status >= 400:
+                raise aiohttp.ClientResponseError(None, (), status=status, message=str(body))
+            self._cache[key] = (time.monotonic(), body)
+            future.set_result(body)
+            return body
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def invalidate(self):
+        """Drops cached reads, done on every trade update since positions and orders just changed."""
+        self._cache.clear()
+
+    async def get_positions(self):
+        return await self._get('/v2/positions')
+
+    async def get_position(self, symbol):
+        return await self._get(f"/v2/positions/{symbol}")
+
+    async def get_orders(self, status='open'):
+        return await self._get('/v2/orders', {'status': status})
+
+    async def get_order(self, order_id):
+        return await self._get(f"/v2/orders/{order_id}")
+
+    async def get_account(self):
+        return await self._get('/v2/account')
+
+    # ----- Orders -----
+
+    def submit(self, symbol, side, qty=None, notional=None, order_type='market', limit_price=None,
+               time_in_force='day', signal_time=None):
+        """
+        Queues an order and returns its OrderTicket right away (await ticket.accepted / ticket.done).
+        signal_time is the time.perf_counter() of the signal that caused it, for latency.
+        """
+        request = {'symbol': symbol, 'side': side, 'type': order_type, 'time_in_force': time_in_force,
+                   'client_order_id': str(uuid.uuid4())}
+        if qty is not None:
+            request['qty'] = str(qty)
+        if notional is not None:
+            request['notional'] = str(notional)
+        if limit_price is not None:
+            request['limit_price'] = str(limit_price)
+        ticket = OrderTicket(request, signal_time)
+        self.tickets[ticket.client_order_id] = ticket
+        self.queue.put_nowait(ticket)
+        return ticket
+
+    async def cancel(self, ticket):
+        """Cancel a placed order. A ticket still in the queue is waited on until the API takes it."""
+        if ticket.id is None:
+            # Raises the ticket's error if the order was rejected, shielded so a cancelled
+            # caller leaves the ticket's own future alone
+            await asyncio.shield(ticket.accepted)
+        status, body = await self._request('DELETE', f"/v2/orders/{ticket.id}")
+        return status == 204
+
+    async def _dispatcher(self):
+        while True:
+            ticket = await self.queue.get()
+            try:
+                await self._send(ticket)
+            except Exception as e:
+                self.counts['failed'] += 1
+                ticket.fail(e)
+                self.tickets.pop(ticket.client_order_id, None)
+            finally:
+                self.queue.task_done()
+
+    async def _send(self, ticket):
+        ticket.times['sent'] = time.perf_counter()
+        self.latency['signal_to_submit'].record(ticket.times['sent'] - ticket.times['signal'])
+        self.counts['submitted'] += 1
+        status, body = await self._request('POST', '/v2/orders', json=ticket.request)
+        ticket.times['acked'] = time.perf_counter()
+        self.latency['submit_to_ack'].record(ticket.times['acked'] - ticket.times['sent'])
+
+        if status >= 400:
+            self.counts['rejected'] += 1
+            ticket.fail(aiohttp.ClientResponseError(None, (), status=status, message=str(body)))
+            self.tickets.pop(ticket.client_order_id, None)
+            return
+        self.counts['accepted'] += 1
+        ticket.id = body['id']
+        if ticket.order is None:
+            # The websocket may already have reported a later state
+            ticket.order, ticket.status = body, body['status']
+        if not ticket.accepted.done():
+            ticket.accepted.set_result(body)
+        if not self.use_stream:
+            # Without trade updates there is nothing later to wait for, done carries the acknowledged order
+            self._finish(ticket, body)
+
+    # ----- Trade updates -----
+
+    def _stream_url(self):
+        return self.base_url.replace('https://', 'wss://').replace('http://', 'ws://') + '/stream'
+
+    async def _listen_trade_updates(self):
+        """Follows trade_updates and reconnects when the socket drops, until the keys are rejected."""
+        while True:
+            try:
+                async with self.session.ws_connect(self._stream_url(), heartbeat=20) as ws:
+                    await ws.send_json({'action': 'auth', 'key': self.key, 'secret': self.secret})
+                    await ws.send_json({'action': 'listen', 'data': {'streams': ['trade_updates']}})
+                    async for message in ws:
+                        if message.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                            continue
+                        try:
+                            body = json.loads(message.data)
+                            stream, data = body.get('stream'), body.get('data') or {}
+                            if stream == 'authorization' and data.get('status') != 'authorized':
+                                # Reconnecting with the same keys cannot help
+                                self._stream_failed(PermissionError(f"trade_updates authorization failed: {data}"))
+                                return
+                            if stream == 'listening' and not self._stream_ready.done():
+                                self._stream_ready.set_result(True)
+                            elif stream == 'trade_updates':
+                                self.on_trade_update(data)
+                        except Exception as e:
+                            # One bad message must not take the listener, and every open ticket, down with it
+                            self.counts['update_errors'] += 1
+                            print(f"Error handling trade update {message.data!r}: {e!r}")
+            except Exception as e:
+                if not self._stream_ready.done():
+                    self._stream_failed(e)
+                    return
+                print(f"Trade updates disconnected: {e!r}")
+            await asyncio.sleep(1.0)
+
+    def _stream_failed(self, error):
+        # Fails start() if it is still waiting, otherwise the open tickets, whose fills can no longer arrive
+        print(f"Trade updates stopped: {error}")
+        if not self._stream_ready.done():
+            self._stream_ready.set_exception(error)
+            self._stream_ready.exception()
+            return
+        for ticket in list(self.tickets.values()):
+            if not ticket.done.done():
+                self.counts['failed'] += 1
+                ticket.fail(error)
+        self.tickets.clear()
+
+    def on_trade_update(self, update):
+        """Applies one trade_updates event to the ticket and the position book."""
+        self.counts['updates'] += 1
+        self.invalidate()
+        order = update['order']
+        if 'position_qty' in update:
+            self.positions[order['symbol']] = float(update['position_qty'])
+        ticket = self.tickets.get(order.get('client_order_id'))
+        if ticket is None:
+            return  # Placed outside this gateway
+        ticket.id = order['id']
+        ticket.order, ticket.status = order, order['status']
+        if order['status'] in TERMINAL_STATUSES:
+            self._finish(ticket, order)
+
+    def _finish(self, ticket, order):
+        if ticket.done.done():
+            return
+        now = time.perf_counter()
+        if order['status'] == 'filled':
+            self.counts['filled'] += 1
+            self.latency['signal_to_fill'].record(now - ticket.times['signal'])
+            if 'acked' in ticket.times:
+                self.latency['ack_to_fill'].record(now - ticket.times['acked'])
+        elif order['status'] == 'canceled':
+            self.counts['canceled'] += 1
+        ticket.times['done'] = now
+        if not ticket.accepted.done():
+            ticket.accepted.set_result(order)
+        ticket.done.set_result(order)
+        # Keep the ticket table from growing for the life of the process
+        self.tickets.pop(ticket.client_order_id, None)
+
+    # ----- Signals -----
+
+    def order_signal(self, signal, notional=100.0):
+        """
+        Turns a StreamPipeline signal into an order: 'buy' spends notional dollars, 'sell' closes the
+        position held according to the fills seen so far. Usable as StreamPipeline(on_signal=...).
+        """
+        if signal['side'] == 'buy':
+            return self.submit(signal['symbol'], 'buy', notional=notional, signal_time=signal.get('signalled'))
+        held = self.positions.get(signal['symbol'], 0.0)
+        if held > 0:
+            return self.submit(signal['symbol'], 'sell', qty=held, signal_time=signal.get('signalled'))
+        return None
+
+    async def wait_idle(self):
+        """Waits until every queued order has been sent."""
+        await self.queue.join()
+
+    def report(self):
+        return {
+            'counts': dict(self.counts),
+            'open_tickets': len(self.tickets),
+            'latency': {stage: hist.summary() for stage, hist in self.latency.items()},
+        }
+
+
+async def _demo(base_url, symbols, n_orders):
+    async with ExecutionGateway(base_url=base_url) as gateway:
+        tickets = [gateway.submit(symbols[i % len(symbols)], 'buy', notional=100) for i in range(n_orders)]
+        # Many strategy tasks asking for positions at once cost one request
+        await asyncio.gather(*(gateway.get_positions() for _ in range(50)))
+        await asyncio.gather(*(ticket.done for ticket in tickets), return_exceptions=True)
+        print(await gateway.get_positions())
+        report = gateway.report()
+    print(report['counts'])
+    for stage, s in report['latency'].items():
+        print(f"  {stage}: n={s['count']} p50={s['p50_s'] * 1e3:.1f}ms p95={s['p95_s'] * 1e3:.1f}ms "
+              f"max={s['max_s'] * 1e3:.1f}ms")
+
+
+if __name__ == "__main__":
+    # Against the mock: python mock_alpaca_server.py & python execution_gateway.py
+    asyncio.run(_demo(os.environ.get('ALPACA_TRADING_URL', 'http://127.0.0.1:8765'), ['AAPL', 'MSFT'], 20))
@@ -0,0 +1,330 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+import pandas as pd
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from tqdm import tqdm
+from asset_universe import universe_symbols
+from async_scheduler import SchedulerStats
+from data_manifest import MANIFEST_PATH, record_file
+
+FINANCIALS_ROOT = os.environ.get('FINANCIALS_ROOT', '../../data/financials')
+# When each ticker was last checked, its newest stored quarter and its next earnings date
+FINANCIALS_STATE = os.environ.get('FINANCIALS_STATE', '../../data/financials_state.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS freshness (
+    ticker TEXT PRIMARY KEY,
+    latest_quarter TEXT,
+    quarters INTEGER NOT NULL,
+    next_earnings TEXT,
+    checked_at REAL NOT NULL,
+    updated_at REAL
+);
+"""
+
+# Freshness policy, in days. A company files its quarter up to REPORT_LAG days after the quarter
+# ends; until then, or until shortly before a known earnings date, the stored figures are current.
+REPORT_LAG = 45
+EARNINGS_LEAD = 1  # Start looking this long before an announced earnings date
+RECHECK = 3  # Once a new quarter is due, look again this often until it shows up
+MAX_AGE = 120  # Check anything not looked at for this long, whatever the calendar says
+EMPTY_RECHECK = 30  # Funds and trusts return no statements, look at them rarely
+
+
+def financials_path(ticker, root=FINANCIALS_ROOT):
+    return os.path.join(root, f"{ticker}_financials.csv")
+
+
+class HostRateLimiter:
+    """
+    Thread-safe request pacing per host: at most `rate` requests per `per` seconds to each host,
+    spaced evenly so a pool of workers does not hit the host in bursts.
+    """
+
+    def __init__(self, rate=2, per=1.0):
+        self.interval = per / rate
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _rate_limited(error):
+    # yfinance raises YFRateLimitError, older versions surface the HTTP 429 in the message
+    return type(error).__name__ == 'YFRateLimitError' or '429' in str(error) or 'Too Many Requests' in str(error)
+
+
+class YFinanceBackend:
+    """The two yfinance calls the fetcher needs. yfinance is only imported when this is created."""
+
+    host = 'query2.finance.yahoo.com'
+
+    def __init__(self, tz_cache='../../data/cache/'):
+        import yfinance as yf
+        os.makedirs(tz_cache, exist_ok=True)
+        yf.set_tz_cache_location(tz_cache)
+        self.yf = yf
+
+    def quarterly_financials(self, ticker):
+        """Income statement with one row per line item and one column per quarter end."""
+        return self.yf.Ticker(ticker).get_financials(freq="quarterly")
+
+    def next_earnings(self, ticker):
+        """The next announced earnings date, or None."""
+        calendar = self.yf.Ticker(ticker).calendar or {}
+        dates = calendar.get('Earnings Date') or []
+        return pd.Timestamp(min(dates)) if dates else None
+
+
+class StubFinancialsBackend:
+    """
+    Stand-in for YFinanceBackend serving given frames ({ticker: DataFrame}) and earnings dates,
+    with an optional per-call latency and failures ({ticker: exception}). Records its calls.
+    """
+
+    host = 'stub'
+
+    def __init__(self, financials, earnings=None, latency=0.0, failures=None):
+        self.financials = financials
+        self.earnings = earnings or {}
+        self.latency = latency
+        self.failures = failures or {}
+        self.calls = []
+
+    def quarterly_financials(self, ticker):
+        self.calls.append(('financials', ticker))
+        time.sleep(self.latency)
+        if ticker in self.failures:
+            raise self.failures[ticker]
+        return self.financials.get(ticker, pd.DataFrame()).copy()
+
+    def next_earnings(self, ticker):
+        self.calls.append(('earnings', ticker))
+        time.sleep(self.latency)
+        date = self.earnings.get(ticker)
+        return None if date is None else pd.Timestamp(date)
+
+
+# ----- Freshness state -----
+
+def _connect(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def load_state(path=FINANCIALS_STATE):
+    """{ticker: row dict} of everything checked so far."""
+    with closing(_connect(path)) as conn:
+        conn.row_factory = sqlite3.Row
+        return {row['ticker']: dict(row) for row in conn.execute("SELECT * FROM freshness")}
+
+
+def _save_state(rows, path):
+    with closing(_connect(path)) as conn, conn:
+        conn.executemany("INSERT OR REPLACE INTO freshness VALUES "
+                         "(:ticker, :latest_quarter, :quarters, :next_earnings, :checked_at, :updated_at)", rows)
+
+
+def _stored_quarters(ticker, root):
+    # Only the header of an existing file, for tickers fetched before there was a state table
+    try:
+        header = pd.read_csv(financials_path(ticker, root), index_col=0, nrows=0)
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return []
+    return sorted(header.columns)
+
+
+def is_due(state, today=None):
+    """Whether a ticker with this freshness row (None if never fetched) should be fetched on `today`."""
+    if state is None:
+        return True
+    today = pd.Timestamp(today or pd.Timestamp.now()).normalize()
+    checked = pd.Timestamp(state['checked_at'], unit='s').normalize()
+    age = (today - checked).days
+    if age >= MAX_AGE:
+        return True
+    if state['latest_quarter'] is None:
+        return age >= EMPTY_RECHECK
+
+    # Fiscal quarters need not end with calendar ones (e.g. November), so step three months and
+    # snap to that month's end rather than the next calendar quarter end
+    next_quarter_end = pd.Timestamp(state['latest_quarter']) + pd.DateOffset(months=3) + pd.offsets.MonthEnd(0)
+    earnings = pd.Timestamp(state['next_earnings']) if state['next_earnings'] else None
+    if earnings is not None and earnings > next_quarter_end:
+        expected = earnings - pd.Timedelta(days=EARNINGS_LEAD)
+    else:
+        # No date, or the calendar still shows the announcement of the quarter already stored
+        expected = next_quarter_end + pd.Timedelta(days=REPORT_LAG)
+    # Quiet until the report is due, then every RECHECK days until the new quarter is stored
+    return today >= expected and (checked < expected or age >= RECHECK)
+
+
+# ----- Fetching -----
+
+def merge_financials(old, new):
+    """Quarters of both frames, new figures winning. yfinance only returns the last few quarters."""
+    new = new.copy()
+    new.columns = [pd.Timestamp(c).strftime('%Y-%m-%d') for c in new.columns]
+    if old is None or old.empty:
+        merged = new
+    else:
+        merged = new.combine_first(old)
+        # Keep the line item order of the newest statement
+        merged = merged.reindex(list(new.index) + [i for i in old.index if i not in new.index])
+    return merged[sorted(merged.columns, reverse=True)]
+
+
+class FinancialsFetcher:
+    """
+    Fetches quarterly financials for many tickers on a bounded thread pool, pacing calls per host
+    and retrying rate limited ones. Only tickers whose freshness row says a new quarter may be out
+    are fetched; new quarters are merged into the stored CSV (one per ticker, quarters as
+    columns, as before) and recorded in the data manifest under the 'financials' dataset.
+    """
+
+    def __init__(self, backend=None, root=FINANCIALS_ROOT, state_path=FINANCIALS_STATE, max_workers=8,
+                 rate=2, per=1.0, manifest=MANIFEST_PATH):
+        self.backend = backend or YFinanceBackend()
+        self.root = root
+        self.state_path = state_path
+        self.max_workers = max_workers
+        self.limiter = HostRateLimiter(rate, per)
+        self.manifest = manifest
+        self.calls = 0
+        self._call_lock = threading.Lock()
+
+    def _call(self, method, ticker):
+        @retry(retry=retry_if_exception(_rate_limited), wait=wait_exponential(multiplier=2, max=60),
+               stop=stop_after_attempt(5), reraise=True)
+        def attempt():
+            self.limiter.wait(self.backend.host)
+            with self._call_lock:
+                self.calls += 1
+            return getattr(self.backend, method)(ticker)
+        return attempt()
+
+    def due(self, tickers, today=None):
+        """The tickers that need a fetch, per is_due() on the stored state."""
+        state = load_state(self.state_path)
+        return [ticker for ticker in tickers if is_due(self._bootstrap(ticker, state.get(ticker)), today)]
+
+    def _bootstrap(self, ticker, state):
+        # A CSV written before freshness tracking counts as checked when it was last written
+        if state is not None:
+            return state
+        quarters = _stored_quarters(ticker, self.root)
+        if not quarters:
+            return None
+        return {'ticker': ticker, 'latest_quarter': quarters[-1], 'quarters': len(quarters), 'next_earnings': None,
+                'checked_at': os.path.getmtime(financials_path(ticker, self.root)), 'updated_at': None}
+
+    def fetch_one(self, ticker):
+        """Fetches one ticker, stores any new quarters and returns its new freshness row."""
+        new = self._call('quarterly_financials', ticker)
+        try:
+            earnings = self._call('next_earnings', ticker)
+        except Exception:
+            earnings = None  # Nice to have, the report lag fallback covers it
+        now = time.time()
+        row = {'ticker': ticker, 'latest_quarter': None, 'quarters': 0,
+               'next_earnings': None if earnings is None else earnings.strftime('%Y-%m-%d'),
+               'checked_at': now, 'updated_at': None}
+
+        path = financials_path(ticker, self.root)
+        old = pd.read_csv(path, index_col=0) if os.path.exists(path) and os.path.getsize(path) > 3 else None
+        if new is None or new.empty:
+            if old is not None:
+                row.update(latest_quarter=max(old.columns), quarters=len(old.columns))
+            return row, 0
+
+        merged = merge_financials(old, new)
+        row.update(latest_quarter=merged.columns[0], quarters=len(merged.columns))
+        added = len(merged.columns) - (0 if old is None else len(old.columns))
+        if old is None or not merged.equals(old.reindex_like(merged)):
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f"{path}.tmp"
+            merged.to_csv(tmp)
+            os.replace(tmp, path)
+            quarter_ns = pd.DatetimeIndex(merged.columns).asi8
+            record_file('financials', ticker, 'quarterly', path, len(merged.columns), quarter_ns.min(),
+                        quarter_ns.max(), path=self.manifest)
+            row['updated_at'] = now
+        return row, added
+
+    def run(self, tickers, force=False, today=None):
+        """
+        Fetches every due ticker (all of them with force) and returns a SchedulerStats whose units
+        are new quarters stored. Freshness rows are saved as tickers finish, so an interrupted run
+        keeps its progress.
+        """
+        todo = list(tickers) if force else self.due(tickers, today)
+        stats = SchedulerStats()
+        stats.skipped = len(tickers) - len(todo)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                tqdm(total=len(todo), desc="Fetching financials") as progress:
+            pending = {}
+            todo_iter = iter(todo)
+
+            def submit():
+                # Keep at most two tickers per worker in flight rather than queueing the whole list
+                for ticker in todo_iter:
+                    pending[executor.submit(self._timed_fetch, ticker)] = ticker
+                    if len(pending) >= 2 * self.max_workers:
+                        return
+
+            submit()
+            while pending:
+                future = next(as_completed(pending))
+                ticker = pending.pop(future)
+                try:
+                    row, added, latency = future.result()
+                    _save_state([row], self.state_path)
+                    stats.record(ticker, latency, added)
+                except Exception as e:
+                    stats.errors[ticker] = e
+                    print(f"Error fetching {ticker}: {e}")
+                progress.update(1)
+                submit()
+        stats.finished = time.perf_counter()
+        stats.calls = self.calls
+        return stats
+
+    def _timed_fetch(self, ticker):
+        start = time.perf_counter()
+        row, added = self.fetch_one(ticker)
+        return row, added, time.perf_counter() - start
+
+
+def fetch_financials(tickers, force=False, **kwargs):
+    """Refreshes the stored financials of tickers and prints the throughput report."""
+    fetcher = FinancialsFetcher(**kwargs)
+    stats = fetcher.run(tickers, force=force)
+    print(f"\nSkipped {stats.skipped} fresh tickers, made {stats.calls} backend calls")
+    stats.print_report(unit_name='new quarters')
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh quarterly financials of the shortable assets")
+    parser.add_argument('tickers', nargs='*', help="Defaults to every symbol of the current asset universe")
+    parser.add_argument('--changed-since', help="Only symbols added or changed since this universe snapshot version")
+    parser.add_argument('--force', action='store_true', help="Fetch every ticker whatever its freshness")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=2, help="Requests per second to Yahoo")
+    args = parser.parse_args()
+    tickers = args.tickers or universe_symbols(changed_since=args.changed_since)
+    fetch_financials(tickers, force=args.force, max_workers=args.workers, rate=args.rate)
@@ -0,0 +1,196 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from financials_fetcher import FINANCIALS_ROOT
+
+# Every statement in FINANCIALS_ROOT as one long table: ticker, quarter end, factor, value
+FUNDAMENTALS_PATH = os.environ.get('FUNDAMENTALS_PATH', '../../data/fundamentals.parquet')
+
+# The income statement items the screener looks at
+FACTORS = [
+    "TaxEffectOfUnusualItems", "TaxRateForCalcs", "NormalizedEBITDA", "TotalUnusualItems",
+    "TotalUnusualItemsExcludingGoodwill", "NetIncomeFromContinuingOperationNetMinorityInterest",
+    "ReconciledDepreciation", "ReconciledCostOfRevenue", "EBITDA", "EBIT", "NetInterestIncome",
+    "InterestExpense", "InterestIncome", "NormalizedIncome", "NetIncomeFromContinuingAndDiscontinuedOperation",
+    "TotalExpenses", "TotalOperatingIncomeAsReported", "DilutedAverageShares", "BasicAverageShares",
+    "DilutedEPS", "BasicEPS", "DilutedNIAvailtoComStockholders", "NetIncomeCommonStockholders", "NetIncome",
+    "NetIncomeIncludingNoncontrollingInterests", "NetIncomeContinuousOperations", "TaxProvision",
+    "PretaxIncome", "OtherIncomeExpense", "OtherNonOperatingIncomeExpenses", "SpecialIncomeCharges",
+    "OtherSpecialCharges", "ImpairmentOfCapitalAssets", "NetNonOperatingInterestIncomeExpense",
+    "InterestExpenseNonOperating", "InterestIncomeNonOperating", "OperatingIncome", "OperatingExpense",
+    "DepreciationAmortizationDepletionIncomeStatement", "DepreciationAndAmortizationInIncomeStatement",
+    "ResearchAndDevelopment", "SellingGeneralAndAdministration", "GrossProfit", "CostOfRevenue",
+    "TotalRevenue", "OperatingRevenue",
+]
+
+
+def parse_financials(path):
+    """
+    One {ticker}_financials.csv as (ticker, quarter end ns, factor names, values) with values a
+    (factors, quarters) float64 array. Empty files (funds, trusts) give zero quarters.
+    """
+    ticker = os.path.basename(path)[:-len('_financials.csv')]
+    try:
+        df = pd.read_csv(path, index_col=0)
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame()
+    if df.empty or len(df.columns) == 0:
+        return ticker, np.empty(0, dtype=np.int64), [], np.empty((0, 0))
+    quarters = pd.to_datetime(df.columns).as_unit('ns').asi8
+    return ticker, quarters, df.index.astype(str).tolist(), df.to_numpy(dtype=np.float64)
+
+
+def _parse_many(paths):
+    # Files are tiny, a worker parses a batch of them per task to keep the pickling overhead down
+    return [parse_financials(path) for path in paths]
+
+
+def build_fundamentals(root=FINANCIALS_ROOT, path=FUNDAMENTALS_PATH, max_workers=None, batch_size=64):
+    """
+    Parses every statement under root on a process pool into one long table (ticker and factor as
+    categoricals, quarter as datetime, value float64, missing values dropped) sorted by ticker,
+    factor and quarter, and writes it to path as Parquet. Returns the table.
+    """
+    files = sorted(os.path.join(root, name) for name in os.listdir(root) if name.endswith('_financials.csv'))
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parsed = [result for batch in executor.map(_parse_many, batches) for result in batch]
+
+    tickers, quarters, factors, values = [], [], [], []
+    for ticker, quarter_ns, names, matrix in parsed:
+        if not len(quarter_ns):
+            continue
+        n_factors, n_quarters = matrix.shape
+        tickers.append(np.full(n_factors * n_quarters, ticker, dtype=object))
+        quarters.append(np.tile(quarter_ns, n_factors))
+        factors.append(np.repeat(np.array(names, dtype=object), n_quarters))
+        values.append(matrix.ravel())
+
+    if tickers:
+        ticker, quarter, factor, value = (np.concatenate(parts) for parts in (tickers, quarters, factors, values))
+    else:
+        ticker, quarter, factor, value = (np.empty(0, dtype=t) for t in (object, np.int64, object, np.float64))
+    keep = ~np.isnan(value)
+    df = pd.DataFrame({
+        'ticker': pd.Categorical(ticker[keep]),
+        'quarter': pd.to_datetime(quarter[keep], unit='ns'),
+        'factor': pd.Categorical(factor[keep]),
+        'value': value[keep],
+    })
+    df = df.sort_values(['ticker', 'factor', 'quarter'], kind='stable', ignore_index=True)
+    if path is not None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        df.to_parquet(path, index=False)
+    return df
+
+
+def load_fundamentals(path=FUNDAMENTALS_PATH, root=FINANCIALS_ROOT, rebuild=False):
+    """The long table, rebuilt from the CSVs when missing, older than any of them or on request."""
+    if not rebuild and os.path.exists(path):
+        built = os.path.getmtime(path)
+        rebuild = any(entry.stat().st_mtime > built for entry in os.scandir(root) if entry.is_file())
+    if rebuild or not os.path.exists(path):
+        return build_fundamentals(root, path)
+    return pd.read_parquet(path)
+
+
+class FundamentalsMatrix:
+    """
+    The long table as a dense float64 array values[ticker, quarter, factor] (NaN where missing).
+    Fiscal quarters end on different dates, so the quarter axis counts back per ticker: 0 is the
+    newest quarter a ticker reported, 1 the one before and so on, with the actual end dates in
+    period_end[ticker, quarter]. Cross-sectional questions become array expressions over all
+    tickers at once, e.g. m.growth('EBITDA') > 0.1.
+    """
+
+    def __init__(self, tickers, factors, period_end, values):
+        self.tickers = pd.Index(tickers, name='ticker')
+        self.factors = pd.Index(factors, name='factor')
+        self.period_end = period_end
+        self.values = values
+
+    @classmethod
+    def from_long(cls, df, factors=None):
+        if factors is not None:
+            df = df[df['factor'].isin(factors)]
+        ticker_codes, tickers = pd.factorize(df['ticker'], sort=True)
+        factor_codes, factor_names = pd.factorize(df['factor'], sort=True)
+        quarter_ns = df['quarter'].to_numpy('datetime64[ns]').astype(np.int64)
+
+        # Slot of each row: position of its quarter among its ticker's quarters, newest first
+        order = np.lexsort((-quarter_ns, ticker_codes))
+        ticker_sorted, quarter_sorted = ticker_codes[order], quarter_ns[order]
+        new_pair = np.ones(len(order), dtype=bool)
+        new_pair[1:] = (ticker_sorted[1:] != ticker_sorted[:-1]) | (quarter_sorted[1:] != quarter_sorted[:-1])
+        pair_ticker, pair_quarter = ticker_sorted[new_pair], quarter_sorted[new_pair]
+        pair_slot = np.arange(len(pair_ticker)) - np.searchsorted(pair_ticker, pair_ticker)
+        slots = np.empty(len(order), dtype=np.int64)
+        slots[order] = pair_slot[np.cumsum(new_pair) - 1]
+
+        n_slots = int(pair_slot.max()) + 1 if len(pair_slot) else 0
+        values = np.full((len(tickers), n_slots, len(factor_names)), np.nan)
+        values[ticker_codes, slots, factor_codes] = df['value'].to_numpy(dtype=np.float64)
+        period_end = np.full((len(tickers), n_slots), np.datetime64('NaT'), dtype='datetime64[ns]')
+        period_end[pair_ticker, pair_slot] = pair_quarter.astype('datetime64[ns]')
+        return cls(np.asarray(tickers, dtype=object), np.asarray(factor_names, dtype=object), period_end, values)
+
+    @classmethod
+    def load(cls, path=FUNDAMENTALS_PATH, factors=None, **kwargs):
+        return cls.from_long(load_fundamentals(path, **kwargs), factors)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def factor(self, name, lag=0):
+        """The factor for every ticker, `lag` quarters back from each ticker's newest one."""
+        if name not in self.factors or lag >= self.values.shape[1]:
+            return np.full(len(self.tickers), np.nan)
+        return self.values[:, lag, self.factors.get_loc(name)]
+
+    def growth(self, name, periods=1, lag=0):
+        """Relative change of a factor over `periods` quarters, NaN where either value is missing or zero."""
+        now, before = self.factor(name, lag), self.factor(name, lag + periods)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(before != 0, (now - before) / np.abs(before), np.nan)
+
+    def trailing(self, name, quarters=4):
+        """Sum over the newest `quarters` quarters (trailing twelve months by default), NaN if any is missing."""
+        if name not in self.factors or quarters > self.values.shape[1]:
+            return np.full(len(self.tickers), np.nan)
+        return self.values[:, :quarters, self.factors.get_loc(name)].sum(axis=1)
+
+    def latest(self, names=None, lag=0):
+        """DataFrame of the given factors (all by default), one row per ticker."""
+        names = list(self.factors) if names is None else list(names)
+        return pd.DataFrame({name: self.factor(name, lag) for name in names}, index=self.tickers)
+
+    def history(self, name):
+        """DataFrame ticker x quarter slot of one factor."""
+        if name not in self.factors:
+            return pd.DataFrame(index=self.tickers)
+        return pd.DataFrame(self.values[:, :, self.factors.get_loc(name)], index=self.tickers)
+
+    def select(self, mask):
+        """The tickers where a boolean array over tickers is true."""
+        return self.tickers[np.asarray(mask, dtype=bool)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the fundamentals table from data/financials")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--min-ebitda-growth', type=float, default=0.1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    df = build_fundamentals(max_workers=args.workers)
+    print(f"Built {len(df):,} values of {df['ticker'].nunique()} tickers in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    m = FundamentalsMatrix.from_long(df)
+    print(f"Matrix {m.values.shape} in {time.perf_counter() - start:.3f}s")
+    start = time.perf_counter()
+    picks = m.select(m.growth('EBITDA') > args.min_ebitda_growth)
+    print(f"{len(picks)} tickers with EBITDA growth > {args.min_ebitda_growth:.0%} "
+          f"in {(time.perf_counter() - start) * 1e3:.2f}ms: {list(picks[:20])}")
@@ -1,4 +1,3 @@
-from api_keys import paper_key, paper_secret
 from datetime import datetime, timezone
 import pandas as pd
 from requests.exceptions import HTTPError
@@ -13,6 +12,15 @@ from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import traceback
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from asset_universe import universe_symbols
+from bar_store import BarStoreWriter, list_partitions, next_bar_start
+from helper_functions import load_api_keys
+
+paper_key, paper_secret = load_api_keys()
+
+# Point at mock_alpaca_server.py with ALPACA_DATA_URL=http://127.0.0.1:8765
+ALPACA_DATA_URL = os.environ.get('ALPACA_DATA_URL', 'https://data.alpaca.markets')
+
 
 class CachedLimiterSession(CacheMixin,Session):
     pass
@@ -35,17 +43,8 @@ session = CachedLimiterSession(
     )
 
 
-# Function to save data to CSV
-def save_to_csv(data, ticker):
-    directory = f"data/bars/{ticker}"
-    os.makedirs(directory, exist_ok=True)
-    file_path = os.path.join(directory, "2y_5m.csv")
-    df = pd.DataFrame(data)
-    df.to_csv(file_path, index=False)
-
 def file_exists(ticker):
-    file_path = f"data/bars/{ticker}/2y_5m.csv"
-    return os.path.exists(file_path)
+    return len(list_partitions(ticker)) > 0
 @retry(retry=retry_if_exception_type(HTTPError), wait=wait_fixed(30))
 def process_ticker(ticker, timeframe):
 
@@ -53,11 +52,16 @@ def process_ticker(ticker, timeframe):
     # if file_exists(ticker):
     #     print(f"Data for {ticker} already exists. Skipping.")
     #     return
-    # Iterate through all tickers with a progress bar
-    all_bars = []
+    # In incremental mode only request the bars after the newest one already stored
+    start = next_bar_start(ticker, timeframe, formatted_start_time) if incremental else formatted_start_time
+    if start is None:
+        return
+
+    # Each page is written to the bar store as it arrives instead of being held in memory
+    writer = BarStoreWriter(ticker)
     params = {
         'timeframe': timeframe,
-        'start': formatted_start_time,
+        'start': start,
         'adjustment': 'all'
     }
     # Clearing page_token at the start of each ticker
@@ -67,7 +71,7 @@ def process_ticker(ticker, timeframe):
         'APCA-API-KEY-ID': paper_key,
         'APCA-API-SECRET-KEY': paper_secret
     }
-    ALPACA_BARS_URL = f"https://data.alpaca.markets/v2/stocks/{ticker}/bars"
+    ALPACA_BARS_URL = f"{ALPACA_DATA_URL}/v2/stocks/{ticker}/bars"
 
     while True:
         try:
@@ -77,7 +81,7 @@ def process_ticker(ticker, timeframe):
             data = response.json()
 
             if 'bars' in data:
-                all_bars.extend(data['bars'])
+                writer.append(data['bars'] or [])
 
                 next_page_token = data.get('next_page_token')
                 if next_page_token and next_page_token != params.get('page_token'):
@@ -96,13 +100,14 @@ def process_ticker(ticker, timeframe):
             print(f"General error for {ticker}: {err}")
             break
 
-    save_to_csv(all_bars, ticker)
+    writer.close()
 
 
 # Main execution block
 if __name__ == "__main__":
-    all_tickers = pd.read_csv("../../data/shortable_assets.csv")['symbol'].tolist()
+    all_tickers = universe_symbols()
     timeframe = '5Min'
+    incremental = True  # Set to False to re-download the full two years for every ticker
     start_time = (datetime.now() - relativedelta(years=2)).replace(hour=0, minute=0, second=0, microsecond=0)
     formatted_start_time = start_time.astimezone(timezone.utc).isoformat()
 
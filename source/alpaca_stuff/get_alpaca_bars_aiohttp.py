@@ -1,106 +1,141 @@
 import asyncio
-import time
 import cProfile
 import aiohttp
 from aiohttp import ClientSession, TCPConnector
-from api_keys import paper_key, paper_secret
 import pandas as pd
 import os
 from datetime import datetime, timezone
 from dateutil.relativedelta import relativedelta
 from tenacity import retry, wait_fixed, retry_if_exception_type
 from aiolimiter import AsyncLimiter
-from tqdm.asyncio import tqdm
-import aiofiles
+from asset_universe import universe_symbols
+from bar_store import BarStoreWriter, next_bar_start
+from async_scheduler import RateLimitPacer, run_worker_pool
+from helper_functions import load_api_keys
+
+paper_key, paper_secret = load_api_keys()
+
+# Point at mock_alpaca_server.py with ALPACA_DATA_URL=http://127.0.0.1:8765
+ALPACA_DATA_URL = os.environ.get('ALPACA_DATA_URL', 'https://data.alpaca.markets')
+
 
 class RateLimitedSession:
     def __init__(self):
         self.session = ClientSession(connector=TCPConnector(limit_per_host=10))
         self.rate_limiter = AsyncLimiter(200, 70)  # Adjust the rate limits as needed
+        self.pacer = RateLimitPacer()
 
     async def close(self):
         await self.session.close()
 
     async def get(self, url, **kwargs):
+        await self.pacer.wait()
         async with self.rate_limiter:
-            return await self.session.get(url, **kwargs)
-
-async def save_to_csv(data, ticker):
-    if not data:
-        return
-
-    directory = f"data/bars/{ticker}"
-    os.makedirs(directory, exist_ok=True)
-    file_path = os.path.join(directory, "2y_5m.csv")
-    df = pd.DataFrame(data)
-
-    async with aiofiles.open(file_path, mode='w') as f:
-        await f.write(df.to_csv(index=False))
+            response = await self.session.get(url, **kwargs)
+        self.pacer.update(response.headers)
+        return response
+
+def group_tickers_by_start(tickers, timeframe, formatted_start_time, incremental=True, tolerance='1D'):
+    """
+    Groups tickers by their request start time so each group can share multi-symbol requests.
+    A ticker joins the group of the earliest start up to `tolerance` before its own, so tickers a
+    few bars apart still share requests; the bars fetched again are deduplicated by the bar store.
+    """
+    starts = []
+    for ticker in tickers:
+        start = next_bar_start(ticker, timeframe, formatted_start_time) if incremental else formatted_start_time
+        if start is not None:
+            starts.append((pd.Timestamp(start), start, ticker))
+
+    tolerance = pd.Timedelta(tolerance)
+    groups, group_ts, group_start = {}, None, None
+    for ts, start, ticker in sorted(starts):
+        if group_ts is None or ts - group_ts > tolerance:
+            group_ts, group_start = ts, start
+        groups.setdefault(group_start, []).append(ticker)
+    return groups
 
 @retry(retry=retry_if_exception_type(aiohttp.ClientError), wait=wait_fixed(5))
-async def process_ticker(rate_limited_session, ticker, formatted_start_time, paper_key, paper_secret):
-    all_bars = []
+async def process_symbol_batch(rate_limited_session, tickers, start, paper_key, paper_secret, timeframe='5Min'):
+    """
+    Fetches bars for several tickers through the multi-symbol endpoint.
+    Pages are ordered by symbol, so a ticker is closed out as soon as a page moves past it.
+    """
+    writers = {}
+    bar_count = 0
     params = {
-        'timeframe': '5Min',
-        'start': formatted_start_time,
-        'adjustment': 'all'
+        'symbols': ','.join(tickers),
+        'timeframe': timeframe,
+        'start': start,
+        'adjustment': 'all',
+        'limit': 10000,
     }
     headers = {
         'APCA-API-KEY-ID': paper_key,
         'APCA-API-SECRET-KEY': paper_secret
     }
-    ALPACA_BARS_URL = f"https://data.alpaca.markets/v2/stocks/{ticker}/bars"
+    ALPACA_BARS_URL = f"{ALPACA_DATA_URL}/v2/stocks/bars"
 
-    while True:
-        try:
+    try:
+        while True:
             response = await rate_limited_session.get(ALPACA_BARS_URL, headers=headers, params=params)
             response.raise_for_status()
 
             data = await response.json()
-            if 'bars' in data and data['bars']:
-                all_bars.extend(data['bars'])
-                next_page_token = data.get('next_page_token')
-                if next_page_token and (next_page_token != params.get('page_token')):
-                    params['page_token'] = next_page_token
-                else:
-                    break
+            page = data.get('bars') or {}
+            for symbol in sorted(page):
+                writer = writers.setdefault(symbol, BarStoreWriter(symbol))
+                bar_count += await asyncio.to_thread(writer.append, page[symbol])
+
+            # Every symbol ordered before the last one on this page has no more pages coming
+            if page:
+                last_symbol = max(page)
+                for symbol in [s for s in writers if s < last_symbol]:
+                    await asyncio.to_thread(writers.pop(symbol).close)
+
+            next_page_token = data.get('next_page_token')
+            if page and next_page_token and (next_page_token != params.get('page_token')):
+                params['page_token'] = next_page_token
             else:
                 break
 
-            # Handle rate limiting
-            rate_limit_remaining = int(response.headers.get('X-RateLimit-Remaining', 0))
-            rate_limit_reset = int(response.headers.get('X-RateLimit-Reset', time.time()))
-            current_time = int(time.time())
-            if rate_limit_remaining <= 10 and rate_limit_remaining > 0:
-                wait_time = max((rate_limit_reset - current_time) / rate_limit_remaining, 1)
-                await asyncio.sleep(wait_time)
-            else:
-                await asyncio.sleep(5)
-
-        except aiohttp.ClientError as http_err:
-            print(f"HTTP error for {ticker}: {http_err}")
-            raise
-        except Exception as err:
-            print(f"General error for {ticker}: {err}")
-            continue
-
-    if all_bars:
-        await save_to_csv(all_bars, ticker)
+    except aiohttp.ClientError as http_err:
+        print(f"HTTP error for batch starting {tickers[0]}: {http_err}")
+        raise
+    except Exception as err:
+        # Raised on so run_worker_pool counts the batch as an error instead of a complete download
+        print(f"General error for batch starting {tickers[0]} after {bar_count} bars: {err}")
+        raise RuntimeError(f"batch incomplete after {bar_count} bars: {err}") from err
+    finally:
+        # Keep the pages that did arrive, an incremental rerun picks up after them
+        for writer in writers.values():
+            await asyncio.to_thread(writer.close)
+    return bar_count
 
 async def main():
-    all_tickers = pd.read_csv("../../data/shortable_assets.csv")['symbol'].tolist()
+    all_tickers = universe_symbols()
     start_time = (datetime.now() - relativedelta(years=2)).replace(hour=0, minute=0, second=0, microsecond=0)
     formatted_start_time = start_time.astimezone(timezone.utc).isoformat()
 
     rate_limited_session = RateLimitedSession()
-    batch_size = 10  # Adjust this number based on your requirements
+    n_workers = 10  # Number of requests in flight at once
+    symbols_per_request = 50  # Symbols packed into one multi-symbol request
+
+    # Tickers with nearby start times share requests
+    symbol_batches = []
+    for start, tickers in group_tickers_by_start(all_tickers, '5Min', formatted_start_time).items():
+        for j in range(0, len(tickers), symbols_per_request):
+            symbol_batches.append((start, tuple(tickers[j:j + symbols_per_request])))
+
+    async def handle_batch(batch):
+        start, tickers = batch
+        return await process_symbol_batch(rate_limited_session, list(tickers), start, paper_key, paper_secret)
 
     try:
         async with rate_limited_session.session:
-            for i in tqdm(range(0, len(all_tickers), batch_size), desc="Processing batches"):
-                batch = all_tickers[i:i + batch_size]
-                tasks = [asyncio.ensure_future(process_ticker(rate_limited_session, ticker, formatted_start_time, paper_key, paper_secret)) for ticker in batch]
-                await asyncio.gather(*tasks)
+            stats = await run_worker_pool(symbol_batches, handle_batch, n_workers=n_workers,
+                                          desc="Processing batches", key=lambda b: f"{b[1][0]}..{b[1][-1]}")
+            stats.print_report(unit_name='bars')
     finally:
         await rate_limited_session.close()
 
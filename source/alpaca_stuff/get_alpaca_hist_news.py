@@ -1,28 +1,36 @@
 import asyncio
-import time
 import aiohttp
 from aiohttp import ClientSession, TCPConnector
-from api_keys import paper_key, paper_secret
 import pandas as pd
 import os
 from tenacity import retry, wait_fixed, retry_if_exception_type
 from aiolimiter import AsyncLimiter
-from tqdm.asyncio import tqdm
 import aiofiles
+from data_manifest import list_tickers, rebuild_bars, record_file, ticker_info
+from async_scheduler import RateLimitPacer, run_worker_pool
+from helper_functions import load_api_keys
 
+paper_key, paper_secret = load_api_keys()
+
+# Point at mock_alpaca_server.py with ALPACA_DATA_URL=http://127.0.0.1:8765
+ALPACA_DATA_URL = os.environ.get('ALPACA_DATA_URL', 'https://data.alpaca.markets')
 
 
 class RateLimitedSession:
     def __init__(self):
         self.session = ClientSession(connector=TCPConnector(limit_per_host=1))
         self.rate_limiter = AsyncLimiter(200, 120)  # Adjust the rate limits as needed
+        self.pacer = RateLimitPacer()
 
     async def close(self):
         await self.session.close()
 
     async def get(self, url, **kwargs):
+        await self.pacer.wait()
         async with self.rate_limiter:
-            return await self.session.get(url, **kwargs)
+            response = await self.session.get(url, **kwargs)
+        self.pacer.update(response.headers)
+        return response
 
 async def save_to_csv(data, ticker):
     try:
@@ -36,6 +44,10 @@ async def save_to_csv(data, ticker):
 
         async with aiofiles.open(file_path, mode='w', encoding='utf-8') as f:
             await f.write(df.to_csv(index=False))
+
+        created_at = pd.to_datetime(df['created_at'], utc=True).dt.as_unit('ns').astype('int64')
+        await asyncio.to_thread(record_file, 'news', ticker, 'TickerNewsSummary', file_path,
+                                len(df), created_at.min(), created_at.max())
     except Exception as e:
         print(f"Error saving data for {ticker}: {e}")
 
@@ -51,7 +63,7 @@ async def process_ticker(rate_limited_session, ticker, start_time, end_time, pap
         'APCA-API-KEY-ID': paper_key,
         'APCA-API-SECRET-KEY': paper_secret
     }
-    ALPACA_BARS_URL = "https://data.alpaca.markets/v1beta1/news"
+    ALPACA_BARS_URL = f"{ALPACA_DATA_URL}/v1beta1/news"
 
     while True:
         try:
@@ -69,16 +81,6 @@ async def process_ticker(rate_limited_session, ticker, start_time, end_time, pap
             else:
                 break
 
-            # Handle rate limiting
-            rate_limit_remaining = int(response.headers.get('X-RateLimit-Remaining', 0))
-            rate_limit_reset = int(response.headers.get('X-RateLimit-Reset', time.time()))
-            current_time = int(time.time())
-            if rate_limit_remaining <= 10 and rate_limit_remaining > 0:
-                wait_time = max((rate_limit_reset - current_time) / rate_limit_remaining, 1)
-                await asyncio.sleep(wait_time)
-            else:
-                await asyncio.sleep(5)
-
         except aiohttp.ClientError as http_err:
             print(f"HTTP error for {ticker}: {http_err}")
             raise
@@ -88,40 +90,38 @@ async def process_ticker(rate_limited_session, ticker, start_time, end_time, pap
 
     if all_bars:
         await save_to_csv(all_bars, ticker)
+    return len(all_bars)
 
 async def main():
     #all_tickers = pd.read_csv("data/shortable_assets.csv")['symbol'].tolist()[0:1]
-    directory_path = "../../data/bars"
-    folder_names = os.listdir(directory_path)
-    all_tickers = [folder_name for folder_name in folder_names if os.path.isdir(os.path.join(directory_path, folder_name))]
+    # The bar time range per ticker comes from the manifest, built once from the Parquet footers if missing
+    all_tickers = list_tickers('bars')
+    if not all_tickers:
+        rebuild_bars()
+        all_tickers = list_tickers('bars')
     start_time = {}
     end_time = {}
     for ticker in all_tickers:
-        file_path = os.path.join(directory_path, ticker, "2y_5m.csv")
-        df = pd.read_csv(file_path)
-        start_time[ticker] = df['t'].min()
-        end_time[ticker] = df['t'].max()
+        info = ticker_info('bars', ticker)
+        start_time[ticker] = pd.Timestamp(info['min_t'], tz='UTC').strftime('%Y-%m-%dT%H:%M:%SZ')
+        end_time[ticker] = pd.Timestamp(info['max_t'], tz='UTC').strftime('%Y-%m-%dT%H:%M:%SZ')
 
     rate_limited_session = RateLimitedSession()
-    batch_size = 2
+    n_workers = 2
+
+    async def handle_ticker(ticker):
+        return await process_ticker(
+            rate_limited_session,
+            ticker,
+            start_time[ticker],  # pass a single timestamp
+            end_time[ticker],  # pass a single timestamp
+            paper_key,
+            paper_secret
+        )
 
     try:
-        for i in tqdm(range(0, len(all_tickers), batch_size), desc="Processing batches"):
-            batch = all_tickers[i:i + batch_size]
-            tasks = [
-                asyncio.create_task(
-                    process_ticker(
-                        rate_limited_session,
-                        ticker,
-                        start_time[ticker],  # pass a single timestamp
-                        end_time[ticker],  # pass a single timestamp
-                        paper_key,
-                        paper_secret
-                    )
-                ) for ticker in batch
-            ]
-
-            await asyncio.gather(*tasks)
+        stats = await run_worker_pool(all_tickers, handle_ticker, n_workers=n_workers, desc="Processing tickers")
+        stats.print_report(unit_name='articles')
     finally:
         await rate_limited_session.close()
 
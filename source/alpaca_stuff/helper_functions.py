@@ -1,3 +1,4 @@
+import os
 import time
 
 # A simple decorator to measure the time a function takes to execute
@@ -8,4 +9,16 @@ def time_it(func):
         end_time = time.time()  # Time after function execution
         print(f"Executing {func.__name__} took {end_time - start_time} seconds.")
         return result
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def load_api_keys(kind='paper'):
+    """
+    (key, secret) from api_keys.py ({kind}_key and {kind}_secret), or from APCA_API_KEY_ID and
+    APCA_API_SECRET_KEY without a key file, e.g. when running against mock_alpaca_server.py.
+    """
+    try:
+        import api_keys
+        return getattr(api_keys, f"{kind}_key"), getattr(api_keys, f"{kind}_secret")
+    except (ImportError, AttributeError):
+        return os.environ.get('APCA_API_KEY_ID', ''), os.environ.get('APCA_API_SECRET_KEY', '')
@@ -0,0 +1,309 @@
+import math
+from collections import deque
+import numpy as np
+
+# Every indicator comes twice: a batch function over whole arrays and a streaming class updated
+# one bar at a time in O(1). Both run the same floating point operations in the same order
+# (blocked cumulative sums for windows, the same recurrence for smoothing), so they agree to
+# the last bit. Values are NaN until an indicator has enough bars.
+#
+# NaN inputs: a window is NaN while it holds a NaN and recovers once the NaN leaves it. An EMA
+# skips NaNs while it collects its seed, and a NaN after seeding makes it NaN and starts a new
+# seed from the values that follow. Running `python indicators.py` checks both forms agree on a
+# series with gaps.
+
+
+# ----- Batch -----
+
+def ema(values, period, alpha=None):
+    """
+    Exponential moving average seeded with the mean of the first period values, as backtrader does.
+    alpha defaults to 2 / (period + 1); 1 / period gives Wilder's smoothing. NaNs are skipped while
+    seeding; a NaN after that restarts the seed (see the note at the top).
+    """
+    alpha = 2.0 / (1.0 + period) if alpha is None else alpha
+    alpha1 = 1.0 - alpha
+    # The recurrence is sequential, plain floats are faster than NumPy scalars here. Same steps as
+    # EMA.update, value != value is the NaN test.
+    prev = math.nan
+    seed = []
+    result = []
+    for value in np.asarray(values, dtype=np.float64).tolist():
+        if prev == prev:
+            prev = prev * alpha1 + value * alpha
+        elif value == value:
+            seed.append(value)
+            if len(seed) == period:
+                prev = math.fsum(seed) / period
+                seed = []
+        result.append(prev)
+    return np.array(result, dtype=np.float64)
+
+
+def _window_sums(values, period):
+    # Sum of each trailing window, NaN until the first full window. The series is cut into blocks of
+    # period values and a window is the tail of one block (a suffix sum) plus the head of the next
+    # (a prefix sum). No sum runs past a block, so a NaN only reaches the windows it is in and
+    # rounding error does not build up over a long series.
+    n = len(values)
+    out = np.full(n, np.nan)
+    if n < period:
+        return out
+    blocks = np.zeros((-(-n // period), period))
+    blocks.ravel()[:n] = values
+    prefix = np.cumsum(blocks, axis=1).ravel()
+    suffix = np.cumsum(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    end = np.arange(period - 1, n)
+    # Windows ending on a block's last value are that whole block
+    out[period - 1:] = np.where((end + 1) % period == 0, prefix[end], suffix[end - period + 1] + prefix[end])
+    return out
+
+
+def sma(values, period):
+    """Simple moving average over the last period values."""
+    return _window_sums(np.asarray(values, dtype=np.float64), period) / period
+
+
+def macd(close, fast=12, slow=26, signal=9):
+    """MACD line, signal line and histogram, as bt.indicators.MACD computes them."""
+    line = ema(close, fast) - ema(close, slow)
+    signal_line = ema(line, signal)
+    return line, signal_line, line - signal_line
+
+
+def rolling_vwap(price, volume, period):
+    """Volume weighted average of price over the last period bars (NaN while the window has no volume)."""
+    price = np.asarray(price, dtype=np.float64)
+    volume = np.asarray(volume, dtype=np.float64)
+    weighted = _window_sums(price * volume, period)
+    total = _window_sums(volume, period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, weighted / total, np.nan)
+
+
+def true_range(high, low, close):
+    """max(high, previous close) - min(low, previous close), from the second bar on."""
+    high, low, close = (np.asarray(a, dtype=np.float64) for a in (high, low, close))
+    out = np.full(len(close), np.nan)
+    out[1:] = np.maximum(high[1:], close[:-1]) - np.minimum(low[1:], close[:-1])
+    return out
+
+
+def atr(high, low, close, period=14):
+    """Average true range with Wilder's smoothing, as bt.indicators.ATR computes it."""
+    return ema(true_range(high, low, close), period, alpha=1.0 / period)
+
+
+def rolling_volatility(close, period=20, periods_per_year=None):
+    """
+    Sample standard deviation of simple returns over the last period returns, annualised with
+    sqrt(periods_per_year) when given.
+    """
+    close = np.asarray(close, dtype=np.float64)
+    returns = close[1:] / close[:-1] - 1.0
+    sums = _window_sums(returns, period)
+    squares = _window_sums(returns * returns, period)
+    variance = np.maximum((squares - sums * sums / period) / (period - 1), 0.0)
+    out = np.full(len(close), np.nan)
+    out[1:] = np.sqrt(variance)
+    return out * math.sqrt(periods_per_year) if periods_per_year else out
+
+
+# ----- Streaming -----
+
+class StreamingIndicator:
+    """
+    Base of the streaming indicators. state() returns the whole state as plain Python values (JSON
+    friendly) and load_state() restores it into an indicator built with the same parameters.
+    """
+
+    def state(self):
+        out = {}
+        for name, value in vars(self).items():
+            if isinstance(value, (deque, list)):
+                out[name] = list(value)
+            elif isinstance(value, StreamingIndicator):
+                out[name] = value.state()
+            else:
+                out[name] = value
+        return out
+
+    def load_state(self, state):
+        for name, value in state.items():
+            current = getattr(self, name)
+            if isinstance(current, deque):
+                current.clear()
+                current.extend(value)
+            elif isinstance(current, StreamingIndicator):
+                current.load_state(value)
+            else:
+                setattr(self, name, list(value) if isinstance(value, list) else value)
+        return self
+
+
+class EMA(StreamingIndicator):
+    def __init__(self, period, alpha=None):
+        self.period = period
+        self.alpha = 2.0 / (1.0 + period) if alpha is None else alpha
+        self.seed = []
+        self.value = math.nan
+
+    def update(self, value):
+        if not math.isnan(self.value):
+            self.value = self.value * (1.0 - self.alpha) + value * self.alpha
+        elif not math.isnan(value):
+            # Collect the first period values for the seed mean
+            self.seed.append(value)
+            if len(self.seed) == self.period:
+                self.value = math.fsum(self.seed) / self.period
+                self.seed = []
+        return self.value
+
+
+class _WindowSum(StreamingIndicator):
+    # Streaming form of _window_sums: the prefix sum of the current block plus the suffix sums of
+    # the previous one, which are computed once per block when it completes
+    def __init__(self, period):
+        self.period = period
+        self.count = 0
+        self.prefix = 0.0
+        self.block = []
+        self.suffix = []
+
+    def update(self, value):
+        position = self.count % self.period
+        self.prefix = value if position == 0 else self.prefix + value
+        self.block.append(value)
+        self.count += 1
+        if self.count < self.period:
+            out = math.nan
+        elif position == self.period - 1:
+            out = self.prefix
+        else:
+            out = self.suffix[position + 1] + self.prefix
+
+        if position == self.period - 1:
+            suffix = self.block[::-1]
+            for j in range(1, self.period):
+                suffix[j] = suffix[j - 1] + suffix[j]
+            self.suffix = suffix[::-1]
+            self.block = []
+        return out
+
+
+class SMA(StreamingIndicator):
+    def __init__(self, period):
+        self.period = period
+        self.window = _WindowSum(period)
+        self.value = math.nan
+
+    def update(self, value):
+        self.value = self.window.update(value) / self.period
+        return self.value
+
+
+class MACD(StreamingIndicator):
+    def __init__(self, fast=12, slow=26, signal=9):
+        self.fast = EMA(fast)
+        self.slow = EMA(slow)
+        self.signal_ema = EMA(signal)
+        self.macd = self.signal = self.histogram = math.nan
+
+    def update(self, close):
+        self.macd = self.fast.update(close) - self.slow.update(close)
+        self.signal = self.signal_ema.update(self.macd)
+        self.histogram = self.macd - self.signal
+        return self.macd, self.signal, self.histogram
+
+
+class RollingVWAP(StreamingIndicator):
+    def __init__(self, period):
+        self.weighted = _WindowSum(period)
+        self.volume = _WindowSum(period)
+        self.value = math.nan
+
+    def update(self, price, volume):
+        weighted = self.weighted.update(price * volume)
+        total = self.volume.update(float(volume))
+        self.value = weighted / total if total > 0 else math.nan
+        return self.value
+
+
+class ATR(StreamingIndicator):
+    def __init__(self, period=14):
+        self.smoothing = EMA(period, alpha=1.0 / period)
+        self.prev_close = None
+        self.value = math.nan
+
+    def update(self, high, low, close):
+        if self.prev_close is not None:
+            prev = self.prev_close
+            # NaN anywhere gives a NaN true range, as np.maximum/np.minimum do in true_range;
+            # the builtin max/min would drop it
+            if math.isnan(high) or math.isnan(low) or math.isnan(prev):
+                tr = math.nan
+            else:
+                tr = max(high, prev) - min(low, prev)
+            self.value = self.smoothing.update(tr)
+        self.prev_close = close
+        return self.value
+
+
+class RollingVolatility(StreamingIndicator):
+    def __init__(self, period=20, periods_per_year=None):
+        self.period = period
+        self.scale = math.sqrt(periods_per_year) if periods_per_year else None
+        self.sums = _WindowSum(period)
+        self.squares = _WindowSum(period)
+        self.prev_close = None
+        self.value = math.nan
+
+    def update(self, close):
+        if self.prev_close is not None:
+            # A NaN close gives NaN returns that still take their place in the window
+            r = close / self.prev_close - 1.0
+            sums, squares = self.sums.update(r), self.squares.update(r * r)
+            value = math.sqrt(max((squares - sums * sums / self.period) / (self.period - 1), 0.0))
+            self.value = value * self.scale if self.scale else value
+        self.prev_close = close
+        return self.value
+
+
+if __name__ == "__main__":
+    # Batch against streaming on a random walk with scattered NaNs and a NaN run
+    rng = np.random.default_rng(7)
+    n = 5000
+    close = 100.0 * np.cumprod(1.0 + rng.normal(0.0, 0.01, n))
+    high = close * (1.0 + rng.uniform(0.0, 0.01, n))
+    low = close * (1.0 - rng.uniform(0.0, 0.01, n))
+    volume = rng.integers(100, 10000, n).astype(np.float64)
+    for a in (close, high, low, volume):
+        a[rng.choice(n, 40, replace=False)] = np.nan
+    close[:5] = np.nan
+    close[2000:2030] = np.nan
+
+    def streamed(indicator, *columns):
+        return np.array([indicator.update(*row) for row in zip(*(c.tolist() for c in columns))])
+
+    line, signal_line, _ = macd(close)
+    stream_macd = MACD()
+    stream_line, stream_signal = [], []
+    for value in close.tolist():
+        stream_macd.update(value)
+        stream_line.append(stream_macd.macd)
+        stream_signal.append(stream_macd.signal)
+    checks = {
+        'ema': (ema(close, 20), streamed(EMA(20), close)),
+        'sma': (sma(close, 20), streamed(SMA(20), close)),
+        'macd': (line, np.array(stream_line)),
+        'macd signal': (signal_line, np.array(stream_signal)),
+        'vwap': (rolling_vwap(close, volume, 20), streamed(RollingVWAP(20), close, volume)),
+        'atr': (atr(high, low, close), streamed(ATR(), high, low, close)),
+        'volatility': (rolling_volatility(close, 20, 252), streamed(RollingVolatility(20, 252), close)),
+    }
+    failed = False
+    for name, (batch, stream) in checks.items():
+        same = np.array_equal(batch, stream, equal_nan=True)
+        failed |= not same
+        print(f"{name:12} {'ok' if same else 'MISMATCH'} ({int(np.isnan(batch).sum())} NaN)")
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,421 @@
+import asyncio
+import bisect
+import math
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+import numpy as np
+from bar_store import timeframe_to_ns, to_ns
+from indicators import MACD
+
+# Websocket reader -> bounded queues -> bar builders -> indicators/strategy -> signal callbacks.
+# The stream handlers only normalise and enqueue, so a slow strategy never stalls the reader: it
+# fills a queue, and the queue policy decides what is dropped.
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+STAGES = ['queue', 'receive_to_bar', 'bar_to_signal', 'receive_to_signal']
+
+
+def message_time_ns(t):
+    """Message timestamp as int64 ns UTC, from a datetime, a msgpack Timestamp, an int or a string."""
+    if isinstance(t, datetime) and t.tzinfo is not None:
+        # Much cheaper than going through pd.Timestamp for every message
+        return (t - EPOCH) // EPOCH.resolution * 1000 + getattr(t, 'nanosecond', 0)
+    if hasattr(t, 'to_unix_nano'):
+        return t.to_unix_nano()
+    return to_ns(t)
+
+
+def _field(msg, attr, key):
+    # Handlers get alpaca-py models, raw stream dicts (short keys) or replayed dicts
+    if isinstance(msg, dict):
+        return msg[key] if key in msg else msg[attr]
+    return getattr(msg, attr)
+
+
+def normalize_trade(msg):
+    """(symbol, t_ns, price, size) of a trade message."""
+    return (_field(msg, 'symbol', 'S'), message_time_ns(_field(msg, 'timestamp', 't')),
+            float(_field(msg, 'price', 'p')), float(_field(msg, 'size', 's')))
+
+
+def normalize_bar(msg):
+    """(symbol, bar) of a bar message, the bar as a dict in the bar store format."""
+    bar = {'t': message_time_ns(_field(msg, 'timestamp', 't'))}
+    for key, attr in (('o', 'open'), ('h', 'high'), ('l', 'low'), ('c', 'close'), ('v', 'volume'), ('vw', 'vwap')):
+        bar[key] = float(_field(msg, attr, key))
+    bar['n'] = int(_field(msg, 'trade_count', 'n'))
+    return _field(msg, 'symbol', 'S'), bar
+
+
+def normalize_quote(msg):
+    """(symbol, t_ns, bid, ask, bid_size, ask_size) of a quote message."""
+    return (_field(msg, 'symbol', 'S'), message_time_ns(_field(msg, 'timestamp', 't')),
+            float(_field(msg, 'bid_price', 'bp')), float(_field(msg, 'ask_price', 'ap')),
+            float(_field(msg, 'bid_size', 'bs')), float(_field(msg, 'ask_size', 'as')))
+
+
+class LatencyHistogram:
+    """Log spaced latency histogram (10 buckets per decade from 1us to 100s) with percentile estimates."""
+
+    def __init__(self, low=1e-6, high=100.0, per_decade=10):
+        decades = math.log10(high / low)
+        self.edges = np.logspace(math.log10(low), math.log10(high), int(decades * per_decade) + 1).tolist()
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_right(self.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the q-th percentile (an upper bound within one bucket)."""
+        if not self.count:
+            return math.nan
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_s': self.total / self.count if self.count else math.nan,
+            'p50_s': self.percentile(50),
+            'p95_s': self.percentile(95),
+            'p99_s': self.percentile(99),
+            'max_s': self.max,
+        }
+
+
+class StreamQueue:
+    """
+    Bounded queue between a stream handler and its consumer. put() never blocks the caller:
+    'drop_oldest' discards the oldest message when full, 'drop_newest' discards the new one and
+    'coalesce' keeps only the latest message per key (quotes per symbol), in first-arrival order.
+    As with asyncio.Queue, the consumer calls task_done() for every item it got and join() waits
+    until every item was processed, not just taken off the queue.
+    """
+    POLICIES = ('drop_oldest', 'drop_newest', 'coalesce')
+
+    def __init__(self, maxsize=10000, policy='drop_oldest'):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self._items = OrderedDict() if policy == 'coalesce' else deque()
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._in_flight = 0
+        self.stats = {'put': 0, 'dropped': 0, 'coalesced': 0, 'high_water': 0}
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item, key=None):
+        self.stats['put'] += 1
+        if self.policy == 'coalesce':
+            if key in self._items:
+                self._items[key] = item
+                self.stats['coalesced'] += 1
+                return
+            if len(self._items) >= self.maxsize:
+                self._items.popitem(last=False)
+                self.stats['dropped'] += 1
+            self._items[key] = item
+        else:
+            if len(self._items) >= self.maxsize:
+                self.stats['dropped'] += 1
+                if self.policy == 'drop_newest':
+                    return
+                self._items.popleft()
+            self._items.append(item)
+        self.stats['high_water'] = max(self.stats['high_water'], len(self._items))
+        self._idle.clear()
+        self._ready.set()
+
+    async def get(self):
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        self._in_flight += 1
+        if self.policy == 'coalesce':
+            return self._items.popitem(last=False)[1]
+        return self._items.popleft()
+
+    def task_done(self):
+        if self._in_flight <= 0:
+            raise ValueError("task_done() called more times than there were items")
+        self._in_flight -= 1
+        if not self._in_flight and not self._items:
+            self._idle.set()
+
+    async def join(self):
+        await self._idle.wait()
+
+
+class BarBuilder:
+    """
+    Rolls the trades of one symbol into time bars in the bar store format. A bar is complete once a
+    trade from a later bucket arrives or the pipeline's watermark passes the end of its bucket.
+    """
+
+    def __init__(self, bucket_ns):
+        self.bucket_ns = bucket_ns
+        self.bar = None
+        self.weighted = 0.0
+        self.closed_until = 0  # End of the last completed bucket
+
+    @property
+    def bucket_end(self):
+        return self.bar['t'] + self.bucket_ns if self.bar else None
+
+    def close(self):
+        """Completes and returns the open bar, if any."""
+        bar, self.bar = self.bar, None
+        if bar is not None:
+            bar['vw'] = self.weighted / bar['v'] if bar['v'] > 0 else bar['c']
+            self.closed_until = bar['t'] + self.bucket_ns
+        return bar
+
+    def is_late(self, t):
+        """Whether a trade at t belongs to a bar that has already been completed."""
+        return t < self.closed_until or (self.bar is not None and t < self.bar['t'])
+
+    def update(self, t, price, size):
+        """Adds one trade that is not late. Returns the bar it completed, or None."""
+        start = t - t % self.bucket_ns
+        done = None
+        if self.bar is not None and start != self.bar['t']:
+            done = self.close()
+        if self.bar is None:
+            self.bar = {'t': start, 'o': price, 'h': price, 'l': price, 'c': price, 'v': 0.0, 'vw': price, 'n': 0}
+            self.weighted = 0.0
+        bar = self.bar
+        if price > bar['h']:
+            bar['h'] = price
+        elif price < bar['l']:
+            bar['l'] = price
+        bar['c'] = price
+        bar['v'] += size
+        bar['n'] += 1
+        self.weighted += price * size
+        return done
+
+
+class MacdVwapSignal:
+    """
+    The entry and exit rules of bt_stuff.MyStrategy on streaming bars, one MACD per symbol: buy when
+    MACD is above its signal line and the close is entry_multiplier above the bar VWAP, sell when
+    both turn the other way. Signals are edge triggered on a per-symbol long/flat state.
+    """
+
+    def __init__(self, entry_multiplier=1.01, exit_multiplier=0.99, macd_fast=12, macd_slow=26, macd_signal=9):
+        self.entry_multiplier = entry_multiplier
+        self.exit_multiplier = exit_multiplier
+        self.periods = (macd_fast, macd_slow, macd_signal)
+        self.macd = {}
+        self.long = {}
+
+    def on_bar(self, symbol, bar):
+        """Returns 'buy', 'sell' or None for a completed bar."""
+        if symbol not in self.macd:
+            self.macd[symbol] = MACD(*self.periods)
+            self.long[symbol] = False
+        macd, signal, _ = self.macd[symbol].update(bar['c'])
+        if not self.long[symbol]:
+            if macd > signal and bar['c'] > bar['vw'] * self.entry_multiplier:
+                self.long[symbol] = True
+                return 'buy'
+        elif macd < signal and bar['c'] < bar['vw'] * self.exit_multiplier:
+            self.long[symbol] = False
+            return 'sell'
+        return None
+
+    def state(self):
+        return {symbol: {'macd': m.state(), 'long': self.long[symbol]} for symbol, m in self.macd.items()}
+
+    def load_state(self, state):
+        for symbol, s in state.items():
+            self.macd[symbol] = MACD(*self.periods).load_state(s['macd'])
+            self.long[symbol] = s['long']
+        return self
+
+
+class StreamPipeline:
+    """
+    Connects CryptoDataStream (or a replay) to a strategy. quote_handler and trade_handler are the
+    async handlers to subscribe; they only enqueue. A consumer task per queue builds bars, runs
+    strategy.on_bar(symbol, bar) and passes every non-None result to on_signal(signal), which may be
+    a plain function or a coroutine function. Latency is recorded per stage in LatencyHistograms.
+    """
+
+    def __init__(self, strategy=None, timeframe='1Min', on_signal=None, on_bar=None, quote_queue_size=10000,
+                 trade_queue_size=100000, trade_policy='drop_oldest', grace_s=2.0, signal_log_size=1000):
+        self.strategy = strategy or MacdVwapSignal()
+        self.bucket_ns = timeframe_to_ns(timeframe)
+        self.on_signal = on_signal
+        self.on_bar = on_bar
+        self.quotes_in = StreamQueue(quote_queue_size, 'coalesce')
+        self.trades_in = StreamQueue(trade_queue_size, trade_policy)
+        # Bars of quiet symbols are closed once any symbol's trades are this far past their bucket
+        self.grace_ns = int(grace_s * 10**9)
+        self.builders = {}
+        self.quotes = {}
+        self.signals = deque(maxlen=signal_log_size)
+        self.latency = {stage: LatencyHistogram() for stage in STAGES}
+        self.counts = {'quotes': 0, 'trades': 0, 'bars': 0, 'signals': 0, 'late_trades': 0, 'errors': 0}
+        self.watermark = 0
+        self._next_close = None
+        self._tasks = []
+
+    # ----- Stream handlers -----
+
+    async def quote_handler(self, msg):
+        self._ensure_started()
+        quote = normalize_quote(msg)
+        self.quotes_in.put((time.perf_counter(), quote), key=quote[0])
+
+    async def trade_handler(self, msg):
+        self._ensure_started()
+        self.trades_in.put((time.perf_counter(), self._process_trade, normalize_trade(msg)))
+
+    async def bar_handler(self, msg):
+        # Bars the stream has already built skip the bar builders, subscribe a symbol to trades or bars
+        self._ensure_started()
+        self.trades_in.put((time.perf_counter(), self._process_bar, normalize_bar(msg)))
+
+    def subscribe(self, stream, *symbols, quotes=True, trades=True, bars=False):
+        """Subscribes the handlers on a CryptoDataStream (or anything with the same subscribe_* methods)."""
+        if quotes:
+            stream.subscribe_quotes(self.quote_handler, *symbols)
+        if trades:
+            stream.subscribe_trades(self.trade_handler, *symbols)
+        if bars:
+            stream.subscribe_bars(self.bar_handler, *symbols)
+
+    # ----- Consumers -----
+
+    def _ensure_started(self):
+        # CryptoDataStream.run() owns its event loop, so the consumers start inside the first handler call
+        if not self._tasks:
+            self._tasks = [asyncio.get_running_loop().create_task(self._consume_quotes()),
+                           asyncio.get_running_loop().create_task(self._consume_trades())]
+
+    async def start(self):
+        self._ensure_started()
+
+    async def _consume_quotes(self):
+        while True:
+            received, (symbol, t, bid, ask, bid_size, ask_size) = await self.quotes_in.get()
+            self.quotes[symbol] = {'t': t, 'bid': bid, 'ask': ask, 'bid_size': bid_size, 'ask_size': ask_size}
+            self.counts['quotes'] += 1
+            self.latency['queue'].record(time.perf_counter() - received)
+            self.quotes_in.task_done()
+
+    async def _consume_trades(self):
+        while True:
+            received, process, message = await self.trades_in.get()
+            self.latency['queue'].record(time.perf_counter() - received)
+            try:
+                await process(received, *message)
+            except Exception as e:
+                self.counts['errors'] += 1
+                print(f"Error processing {message}: {e}")
+            finally:
+                self.trades_in.task_done()
+
+    async def _process_bar(self, received, symbol, bar):
+        await self._emit(symbol, bar, received)
+
+    async def _process_trade(self, received, symbol, t, price, size):
+        self.counts['trades'] += 1
+        builder = self.builders.get(symbol)
+        if builder is None:
+            builder = self.builders[symbol] = BarBuilder(self.bucket_ns)
+        if builder.is_late(t):
+            # Folding it into a later bar would be wrong, and its own bar is already out
+            self.counts['late_trades'] += 1
+            return
+        bar = builder.update(t, price, size)
+        if bar is not None:
+            await self._emit(symbol, bar, received)
+        if self._next_close is None or builder.bucket_end < self._next_close:
+            self._next_close = builder.bucket_end
+
+        if t > self.watermark:
+            self.watermark = t
+            if self._next_close is not None and self.watermark >= self._next_close + self.grace_ns:
+                await self._close_idle(received)
+
+    async def _close_idle(self, received):
+        next_close = None
+        for symbol, builder in self.builders.items():
+            end = builder.bucket_end
+            if end is None:
+                continue
+            if self.watermark >= end + self.grace_ns:
+                await self._emit(symbol, builder.close(), received)
+            elif next_close is None or end < next_close:
+                next_close = end
+        self._next_close = next_close
+
+    async def _emit(self, symbol, bar, received):
+        bar_time = time.perf_counter()
+        self.counts['bars'] += 1
+        self.latency['receive_to_bar'].record(bar_time - received)
+        if self.on_bar is not None:
+            self.on_bar(symbol, bar)
+
+        side = self.strategy.on_bar(symbol, bar)
+        signal_time = time.perf_counter()
+        self.latency['bar_to_signal'].record(signal_time - bar_time)
+        if side is None:
+            return
+        self.latency['receive_to_signal'].record(signal_time - received)
+        signal = {'symbol': symbol, 'side': side, 't': bar['t'], 'price': bar['c'], 'received': received,
+                  'signalled': signal_time}
+        self.counts['signals'] += 1
+        self.signals.append(signal)
+        if self.on_signal is not None:
+            result = self.on_signal(signal)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def drain(self):
+        """Waits until every queued message was processed, including signal callbacks still running."""
+        await asyncio.gather(self.quotes_in.join(), self.trades_in.join())
+
+    async def stop(self, flush=True):
+        """Drains the queues, stops the consumers and optionally emits the bars still open."""
+        if self._tasks:
+            await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if flush:
+            now = time.perf_counter()
+            for symbol, builder in self.builders.items():
+                bar = builder.close()
+                if bar is not None:
+                    await self._emit(symbol, bar, now)
+            self._next_close = None
+
+    def report(self):
+        """Counters, queue statistics and per-stage latency summaries."""
+        return {
+            'counts': dict(self.counts),
+            'queues': {'quotes': dict(self.quotes_in.stats, size=self.quotes_in.qsize()),
+                       'trades': dict(self.trades_in.stats, size=self.trades_in.qsize())},
+            'latency': {stage: hist.summary() for stage, hist in self.latency.items()},
+        }
+
@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import heapq
+import os
+import struct
+import time
+from bar_store import BAR_STORE_ROOT, read_bars
+from live_pipeline import StreamPipeline, normalize_bar, normalize_quote, normalize_trade
+
+STREAM_LOG_ROOT = '../../data/stream_logs'
+
+# Append-only message log: an 8 byte header, then fixed size little endian records. Symbols are
+# written once as 'S' records and referenced by a 2 byte id afterwards, so a trade takes 35 bytes.
+# Every record carries the exchange time and the local receive time (int ns), replay paces on
+# the receive time to reproduce the arrival pattern of the live session.
+LOG_HEADER = b'ALPLOG1\n'
+SYMBOL_RECORD = struct.Struct('<cHB')  # kind, id, name length, then the name
+RECORDS = {
+    'trade': (b'T', struct.Struct('<cHqqdd'), ('p', 's')),
+    'quote': (b'Q', struct.Struct('<cHqqdddd'), ('bp', 'ap', 'bs', 'as')),
+    'bar': (b'B', struct.Struct('<cHqqddddddq'), ('o', 'h', 'l', 'c', 'v', 'vw', 'n')),
+}
+KINDS = {code: (kind, layout, fields) for kind, (code, layout, fields) in RECORDS.items()}
+
+
+def _scan_log(path):
+    # Symbol table and end of the last complete record of an existing log
+    symbols, end = {}, len(LOG_HEADER)
+    for kind, msg, offset in _iter_records(path, symbols_only=True):
+        if kind == 'symbol':
+            symbols[msg] = len(symbols)
+        end = offset
+    return symbols, end
+
+
+def _iter_records(path, symbols_only=False, chunk_size=1 << 22):
+    # Read in chunks, a record cut by a chunk boundary is carried over into the next one, so scanning
+    # or replaying a multi-GB session only ever holds one chunk
+    with open(path, 'rb') as f:
+        if f.read(len(LOG_HEADER)) != LOG_HEADER:
+            raise ValueError(f"{path} is not a stream log")
+        names = []
+        base, data, pos = len(LOG_HEADER), b'', 0  # base is the file offset of data[0]
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return  # Anything left over was truncated by a crash while writing
+            base += pos
+            data = data[pos:] + chunk
+            pos = 0
+            while pos < len(data):
+                code = data[pos:pos + 1]
+                if code == b'S':
+                    if pos + SYMBOL_RECORD.size > len(data):
+                        break
+                    _, _, length = SYMBOL_RECORD.unpack_from(data, pos)
+                    end = pos + SYMBOL_RECORD.size + length
+                    if end > len(data):
+                        break
+                    names.append(data[pos + SYMBOL_RECORD.size:end].decode())
+                    pos = end
+                    yield 'symbol', names[-1], base + pos
+                    continue
+                if code not in KINDS:
+                    raise ValueError(f"Corrupt record at byte {base + pos} of {path}")
+                kind, layout, fields = KINDS[code]
+                if pos + layout.size > len(data):
+                    break  # The rest of the record is in the next chunk
+                if not symbols_only:
+                    _, symbol, t, received, *values = layout.unpack_from(data, pos)
+                    msg = {'S': names[symbol], 't': t, 'r': received, **dict(zip(fields, values))}
+                    yield kind, msg, base + pos + layout.size
+                else:
+                    yield kind, None, base + pos + layout.size
+                pos += layout.size
+
+
+def log_messages(path):
+    """Yields (kind, message) pairs from a stream log, messages as raw stream dicts plus 'r' (receive ns)."""
+    for kind, msg, _ in _iter_records(path):
+        if kind != 'symbol':
+            yield kind, msg
+
+
+class MessageRecorder:
+    """
+    Appends stream messages to a log. Its quote/trade/bar handlers can be subscribed directly, and
+    forward (a StreamPipeline or anything with the same handlers) gets every message after it is
+    recorded. Writes are buffered and flushed every flush_s seconds or flush_bytes bytes, so a crash
+    loses at most that much; a torn last record is cut off when the log is opened again.
+    """
+
+    def __init__(self, path, forward=None, flush_s=1.0, flush_bytes=1 << 16):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if os.path.exists(path) and os.path.getsize(path):
+            self.symbols, end = _scan_log(path)
+            self.file = open(path, 'r+b')
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.symbols = {}
+            self.file = open(path, 'wb')
+            self.file.write(LOG_HEADER)
+        self.path = path
+        self.forward = forward
+        self.flush_s = flush_s
+        self.flush_bytes = flush_bytes
+        self.buffer = bytearray()
+        self.last_flush = time.monotonic()
+        self.counts = {kind: 0 for kind in RECORDS}
+
+    def record(self, kind, symbol, t, received, values):
+        symbol_id = self.symbols.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.symbols[symbol] = len(self.symbols)
+            name = symbol.encode()
+            self.buffer += SYMBOL_RECORD.pack(b'S', symbol_id, len(name)) + name
+        code, layout, _ = RECORDS[kind]
+        self.buffer += layout.pack(code, symbol_id, t, received, *values)
+        self.counts[kind] += 1
+        if len(self.buffer) >= self.flush_bytes or time.monotonic() - self.last_flush >= self.flush_s:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.buffer.clear()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    async def trade_handler(self, msg):
+        symbol, t, price, size = normalize_trade(msg)
+        self.record('trade', symbol, t, time.time_ns(), (price, size))
+        if self.forward is not None:
+            await self.forward.trade_handler(msg)
+
+    async def quote_handler(self, msg):
+        symbol, t, *values = normalize_quote(msg)
+        self.record('quote', symbol, t, time.time_ns(), values)
+        if self.forward is not None:
+            await self.forward.quote_handler(msg)
+
+    async def bar_handler(self, msg):
+        symbol, bar = normalize_bar(msg)
+        self.record('bar', symbol, bar['t'], time.time_ns(), [bar[key] for key in RECORDS['bar'][2]])
+        if self.forward is not None:
+            await self.forward.bar_handler(msg)
+
+    def subscribe(self, stream, *symbols, quotes=True, trades=True, bars=False):
+        """Subscribes the recording handlers on a CryptoDataStream, like StreamPipeline.subscribe."""
+        if quotes:
+            stream.subscribe_quotes(self.quote_handler, *symbols)
+        if trades:
+            stream.subscribe_trades(self.trade_handler, *symbols)
+        if bars:
+            stream.subscribe_bars(self.bar_handler, *symbols)
+
+
+def bar_store_messages(tickers, start=None, end=None, root=BAR_STORE_ROOT):
+    """Yields ('bar', message) pairs of stored bars of several tickers, merged in time order."""
+    def ticker_messages(ticker):
+        bars = read_bars(ticker, start, end, as_numpy=True, root=root)
+        columns = {key: bars[key].tolist() for key in ('t', 'o', 'h', 'l', 'c', 'v', 'vw', 'n')}
+        for i in range(len(columns['t'])):
+            yield columns['t'][i], ticker, {'S': ticker, **{key: values[i] for key, values in columns.items()}}
+
+    for _, _, msg in heapq.merge(*(ticker_messages(ticker) for ticker in tickers)):
+        yield 'bar', msg
+
+
+class ReplayStats:
+    def __init__(self):
+        self.messages = {}
+        self.started = time.perf_counter()
+        self.finished = None
+        self.max_lag_s = 0.0  # How far the replay fell behind the requested pace
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def summary(self):
+        total = sum(self.messages.values())
+        return {
+            'messages': total,
+            **{f"{kind}s": n for kind, n in self.messages.items()},
+            'elapsed_s': self.elapsed,
+            'messages_per_s': total / self.elapsed if self.elapsed else 0.0,
+            'max_lag_s': self.max_lag_s,
+        }
+
+
+async def replay(messages, handlers, speed=1.0):
+    """
+    Feeds (kind, message) pairs to handlers[kind], the same async handlers CryptoDataStream calls.
+    speed=1 follows the recorded timing, N replays N times faster and None (or 0) as fast as
+    possible. Messages are paced on their receive time when recorded, otherwise their own time.
+    Returns a ReplayStats.
+    """
+    stats = ReplayStats()
+    first_t = None
+    for kind, msg in messages:
+        if speed:
+            t = msg.get('r', msg['t'])
+            if first_t is None:
+                first_t = t
+            delay = (t - first_t) / 1e9 / speed - (time.perf_counter() - stats.started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                stats.max_lag_s = max(stats.max_lag_s, -delay)
+        await handlers[kind](msg)
+        stats.messages[kind] = stats.messages.get(kind, 0) + 1
+        # Let the consumers run between messages, as they would between websocket frames
+        await asyncio.sleep(0)
+    stats.finished = time.perf_counter()
+    return stats
+
+
+async def replay_into_pipeline(pipeline, messages, speed=None):
+    """Replays messages through a StreamPipeline, drains it and returns (replay summary, pipeline report)."""
+    await pipeline.start()
+    handlers = {'trade': pipeline.trade_handler, 'quote': pipeline.quote_handler, 'bar': pipeline.bar_handler}
+    stats = await replay(messages, handlers, speed)
+    await pipeline.stop()
+    return stats.summary(), pipeline.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a stream log or the bar store through the live pipeline")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--log', help="Stream log written by MessageRecorder")
+    source.add_argument('--bars', nargs='+', metavar='TICKER', help="Replay stored 5Min bars of these tickers")
+    parser.add_argument('--start')
+    parser.add_argument('--end')
+    parser.add_argument('--speed', default='max', help="1 for real time, N for N times faster, max for no pacing")
+    parser.add_argument('--timeframe', default='1Min', help="Bar size built from replayed trades")
+    args = parser.parse_args()
+
+    messages = log_messages(args.log) if args.log else bar_store_messages(args.bars, args.start, args.end)
+    speed = None if args.speed == 'max' else float(args.speed)
+    summary, report = asyncio.run(replay_into_pipeline(StreamPipeline(timeframe=args.timeframe), messages, speed))
+
+    print(f"Replayed {summary['messages']} messages in {summary['elapsed_s']:.2f}s "
+          f"({summary['messages_per_s']:,.0f} messages/s, max lag {summary['max_lag_s']:.3f}s)")
+    print(f"Counts: {report['counts']}")
+    for stage, s in report['latency'].items():
+        print(f"  {stage}: n={s['count']} p50={s['p50_s'] * 1e6:.0f}us p99={s['p99_s'] * 1e6:.0f}us "
+              f"max={s['max_s'] * 1e6:.0f}us")
+
+
+if __name__ == "__main__":
+    main()
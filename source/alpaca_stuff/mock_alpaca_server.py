@@ -0,0 +1,563 @@
+import argparse
+import asyncio
+import base64
+import os
+import itertools
+import json
+import time
+import uuid
+import zlib
+import numpy as np
+import pandas as pd
+from aiohttp import web
+from bar_store import BAR_STORE_ROOT, CSV_ROOT, list_tickers, read_bars, to_bar_frame, to_ns
+
+WEEK_NS = 7 * 24 * 3600 * 10**9
+
+
+class MockAlpacaData:
+    """
+    Local stand-in for the Alpaca market data API used by the downloaders. Serves bars from the
+    bar store (or the legacy CSV tree) and synthetic news, with pagination via next_page_token,
+    configurable latency, X-RateLimit-* headers and 429 responses once the budget is spent.
+    """
+
+    def __init__(self, root=BAR_STORE_ROOT, csv_root=CSV_ROOT, latency=0.0, rate_limit=200, window=60,
+                 shift_to_now=True):
+        self.root = root
+        self.csv_root = csv_root
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.shift_to_now = shift_to_now
+        self._frames = {}
+        self._shift = None
+        self._window_start = 0
+        self._window_count = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'rate_limited': 0, 'bars': 0, 'news': 0, 'orders': 0, 'started': time.time()}
+
+    def symbols(self):
+        symbols = set(list_tickers(self.root))
+        if os.path.isdir(self.csv_root):
+            symbols.update(name for name in os.listdir(self.csv_root)
+                           if os.path.exists(os.path.join(self.csv_root, name, "2y_5m.csv")))
+        return sorted(symbols)
+
+    def shift(self):
+        # Move the recorded history forward by whole weeks so it ends close to now, that way a
+        # downloader asking for "the last two years" gets data and weekdays/sessions still line up
+        if self._shift is None:
+            self._shift = 0
+            if self.shift_to_now:
+                last = max((self._load(s, shifted=False)['t'][-1] for s in self.symbols()
+                            if len(self._load(s, shifted=False)['t'])), default=None)
+                if last is not None:
+                    self._shift = (pd.Timestamp.now(tz='UTC').value - last) // WEEK_NS * WEEK_NS
+        return self._shift
+
+    def _load(self, symbol, shifted=True):
+        if symbol not in self._frames:
+            df = read_bars(symbol, root=self.root)
+            csv_path = os.path.join(self.csv_root, symbol, "2y_5m.csv")
+            if df.empty and os.path.exists(csv_path):
+                df = to_bar_frame(pd.read_csv(csv_path))
+            self._frames[symbol] = {col: df[col].to_numpy() for col in df.columns}
+        frame = self._frames[symbol]
+        if not shifted:
+            return frame
+        return dict(frame, t=frame['t'] + self.shift())
+
+    def bars_page(self, symbol, start_ns, end_ns, limit):
+        """Returns (bar dicts, t of the next bar or None) for one symbol."""
+        frame = self._load(symbol)
+        if 't' not in frame or len(frame['t']) == 0:
+            return [], None
+        lo = np.searchsorted(frame['t'], start_ns, side='left')
+        hi = np.searchsorted(frame['t'], end_ns, side='right')
+        stop = min(hi, lo + limit)
+        t = np.datetime_as_string(frame['t'][lo:stop].astype('datetime64[ns]'), unit='s')
+        cols = [frame[c][lo:stop].tolist() for c in ('o', 'h', 'l', 'c', 'v', 'n', 'vw')]
+        bars = [{'t': f"{ts}Z", 'o': o, 'h': h, 'l': l, 'c': c, 'v': v, 'n': n, 'vw': vw}
+                for ts, o, h, l, c, v, n, vw in zip(t, *cols)]
+        next_t = int(frame['t'][stop]) if stop < hi else None
+        return bars, next_t
+
+    def news_for(self, symbol):
+        """Synthetic articles, one per session day with bars, at a symbol dependent time of day."""
+        frame = self._load(symbol)
+        if 't' not in frame or len(frame['t']) == 0:
+            return []
+        days = np.unique(frame['t'].astype('datetime64[ns]').astype('datetime64[D]'))
+        offset = np.timedelta64(12 * 60 + zlib.crc32(symbol.encode()) % 600, 'm')
+        created = np.datetime_as_string((days + offset).astype('datetime64[s]'), unit='s')
+        return [{
+            'id': zlib.crc32(f"{symbol}{ts}".encode()),
+            'headline': f"{symbol} headline for {ts[:10]}",
+            'summary': f"Synthetic summary for {symbol} on {ts[:10]}",
+            'author': 'mock',
+            'created_at': f"{ts}Z",
+            'updated_at': f"{ts}Z",
+            'url': '',
+            'content': '',
+            'images': [],
+            'symbols': [symbol],
+            'source': 'mock',
+        } for ts in created]
+
+    async def throttle(self):
+        """Applies latency and the fixed-window rate limit. Returns (headers, limited)."""
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        now = time.time()
+        if now >= self._window_start + self.window:
+            self._window_start = now - (now % self.window)
+            self._window_count = 0
+        self._window_count += 1
+        remaining = max(self.rate_limit - self._window_count, 0)
+        headers = {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(self._window_start + self.window)),
+        }
+        limited = self._window_count > self.rate_limit
+        if limited:
+            self.stats['rate_limited'] += 1
+        return headers, limited
+
+
+class MockAlpacaTrading:
+    """
+    Local stand-in for the parts of the Alpaca trading API the execution gateway uses: orders,
+    positions and the account, plus trade_updates over the /stream websocket. Market orders (and
+    marketable limit orders) fill fill_delay seconds after they are accepted at the symbol's last
+    stored close. Requests share the rate limit of the MockAlpacaData they quote prices from.
+    """
+
+    TERMINAL = ('filled', 'canceled', 'expired', 'rejected')
+
+    def __init__(self, data, cash=100000.0, fill_delay=0.05, default_price=100.0):
+        self.data = data
+        self.cash = cash
+        self.fill_delay = fill_delay
+        self.default_price = default_price
+        self.orders = {}
+        self.by_client_id = {}
+        self.positions = {}
+        self.listeners = set()
+        self._sequence = itertools.count(1)
+        self._assets = None
+
+    def price(self, symbol):
+        frame = self.data._load(symbol, shifted=False)
+        return float(frame['c'][-1]) if 'c' in frame and len(frame['c']) else self.default_price
+
+    def order_json(self, order):
+        out = dict(order)
+        for key in ('qty', 'notional', 'filled_qty', 'filled_avg_price', 'limit_price'):
+            if out.get(key) is not None:
+                out[key] = str(out[key])
+        return out
+
+    def position_json(self, symbol):
+        qty, cost = self.positions[symbol]
+        price = self.price(symbol)
+        return {'symbol': symbol, 'asset_class': 'us_equity', 'qty': str(qty), 'side': 'long' if qty >= 0 else 'short',
+                'avg_entry_price': str(cost / qty if qty else 0.0), 'cost_basis': str(cost),
+                'current_price': str(price), 'market_value': str(qty * price)}
+
+    def account_json(self):
+        equity = self.cash + sum(qty * self.price(s) for s, (qty, _) in self.positions.items())
+        return {'id': 'mock-account', 'status': 'ACTIVE', 'currency': 'USD', 'cash': str(self.cash),
+                'buying_power': str(self.cash), 'equity': str(equity), 'portfolio_value': str(equity)}
+
+    def submit(self, body):
+        """Validates and accepts an order. Returns (status code, response body)."""
+        symbol, side = body.get('symbol'), body.get('side')
+        order_type = body.get('type', 'market')
+        if not symbol or side not in ('buy', 'sell') or order_type not in ('market', 'limit'):
+            return 422, {'code': 40010000, 'message': 'invalid order request'}
+        if (body.get('qty') is None) == (body.get('notional') is None):
+            return 422, {'code': 40010000, 'message': 'qty or notional is required'}
+        if order_type == 'limit' and body.get('limit_price') is None:
+            return 422, {'code': 40010000, 'message': 'limit_price is required'}
+        client_id = body.get('client_order_id') or str(uuid.uuid4())
+        if client_id in self.by_client_id:
+            return 422, {'code': 40010001, 'message': 'client_order_id must be unique'}
+
+        now = pd.Timestamp.now(tz='UTC').isoformat()
+        order = {
+            'id': str(uuid.uuid4()), 'client_order_id': client_id, 'symbol': symbol, 'side': side,
+            'type': order_type, 'time_in_force': body.get('time_in_force', 'day'),
+            'qty': float(body['qty']) if body.get('qty') is not None else None,
+            'notional': float(body['notional']) if body.get('notional') is not None else None,
+            'limit_price': float(body['limit_price']) if body.get('limit_price') is not None else None,
+            'filled_qty': 0.0, 'filled_avg_price': None, 'status': 'accepted',
+            'created_at': now, 'updated_at': now, 'submitted_at': now, 'filled_at': None, 'canceled_at': None,
+        }
+        self.orders[order['id']] = order
+        self.by_client_id[client_id] = order['id']
+        self.data.stats['orders'] += 1
+        asyncio.get_running_loop().call_later(self.fill_delay, self._work, order['id'])
+        return 200, self.order_json(order)
+
+    def _work(self, order_id):
+        order = self.orders[order_id]
+        if order['status'] in self.TERMINAL:
+            return
+        order['status'] = 'new'
+        self.publish('new', order)
+        price = self.price(order['symbol'])
+        marketable = order['type'] == 'market' or (
+            price <= order['limit_price'] if order['side'] == 'buy' else price >= order['limit_price'])
+        if marketable:
+            self.fill(order, price)
+
+    def fill(self, order, price):
+        qty = order['qty'] if order['qty'] is not None else order['notional'] / price
+        signed = qty if order['side'] == 'buy' else -qty
+        held, cost = self.positions.get(order['symbol'], (0.0, 0.0))
+        if held == 0 or (held > 0) == (signed > 0):
+            cost += signed * price  # Opening or adding, average cost
+        elif abs(signed) <= abs(held):
+            cost *= (held + signed) / held  # Reducing keeps the average cost
+        else:
+            cost = (held + signed) * price  # Flipping sides starts a new position at the fill price
+        held += signed
+        if abs(held) < 1e-9:
+            self.positions.pop(order['symbol'], None)
+        else:
+            self.positions[order['symbol']] = (held, cost)
+        self.cash -= signed * price
+
+        order.update(status='filled', filled_qty=qty, filled_avg_price=price,
+                     filled_at=pd.Timestamp.now(tz='UTC').isoformat(), updated_at=pd.Timestamp.now(tz='UTC').isoformat())
+        self.publish('fill', order, price=str(price), qty=str(qty), position_qty=str(held))
+
+    def cancel(self, order_id):
+        order = self.orders.get(order_id)
+        if order is None:
+            return 404
+        if order['status'] in self.TERMINAL:
+            return 422
+        now = pd.Timestamp.now(tz='UTC').isoformat()
+        order.update(status='canceled', canceled_at=now, updated_at=now)
+        self.publish('canceled', order)
+        return 204
+
+    def assets(self):
+        """
+        {symbol: asset} for the symbols with bars. Flags are derived from a hash of the symbol so
+        every run serves the same list; tests change it with set_asset() and remove_asset().
+        """
+        if self._assets is None:
+            self._assets = {}
+            for symbol in self.data.symbols():
+                h = zlib.crc32(symbol.encode())
+                self._assets[symbol] = {
+                    'id': str(uuid.uuid5(uuid.NAMESPACE_OID, symbol)), 'class': 'us_equity',
+                    'exchange': ('NASDAQ', 'NYSE', 'ARCA')[h % 3], 'symbol': symbol, 'name': f"{symbol} Inc.",
+                    'status': 'active', 'tradable': True, 'marginable': h % 7 != 0, 'shortable': h % 5 != 0,
+                    'easy_to_borrow': h % 5 != 0 and h % 11 != 0, 'fractionable': h % 13 != 0,
+                    'maintenance_margin_requirement': 30 if h % 4 else 100,
+                }
+        return self._assets
+
+    def set_asset(self, symbol, **fields):
+        """Adds an asset or changes fields of one, e.g. set_asset('XYZ', shortable=False)."""
+        assets = self.assets()
+        base = assets.get(symbol) or {'id': str(uuid.uuid5(uuid.NAMESPACE_OID, symbol)), 'class': 'us_equity',
+                                      'exchange': 'NASDAQ', 'symbol': symbol, 'name': f"{symbol} Inc.",
+                                      'status': 'active', 'tradable': True, 'marginable': True, 'shortable': True,
+                                      'easy_to_borrow': True, 'fractionable': True,
+                                      'maintenance_margin_requirement': 30}
+        assets[symbol] = dict(base, **fields)
+
+    def remove_asset(self, symbol):
+        self.assets().pop(symbol, None)
+
+    def publish(self, event, order, **fields):
+        message = json.dumps({'stream': 'trade_updates', 'data': {
+            'event': event, 'execution_id': str(next(self._sequence)),
+            'timestamp': pd.Timestamp.now(tz='UTC').isoformat(), 'order': self.order_json(order), **fields}})
+        for ws in list(self.listeners):
+            if ws.closed:
+                self.listeners.discard(ws)
+            else:
+                asyncio.ensure_future(ws.send_str(message))
+
+
+def encode_token(*parts):
+    return base64.urlsafe_b64encode('|'.join(str(p) for p in parts).encode()).decode()
+
+
+def decode_token(token):
+    return base64.urlsafe_b64decode(token.encode()).decode().split('|')
+
+
+def parse_range(query):
+    start = to_ns(query['start']) if 'start' in query else 0
+    end = to_ns(query['end']) if 'end' in query else pd.Timestamp.now(tz='UTC').value
+    return start, end
+
+
+def parse_limit(query, default, maximum):
+    return max(1, min(int(query.get('limit', default)), maximum))
+
+
+def too_many_requests(headers):
+    return web.json_response({'code': 42910000, 'message': 'too many requests.'}, status=429, headers=headers)
+
+
+async def handle_symbol_bars(request):
+    data = request.app['data']
+    headers, limited = await data.throttle()
+    if limited:
+        return too_many_requests(headers)
+
+    symbol = request.match_info['symbol']
+    start, end = parse_range(request.query)
+    if 'page_token' in request.query:
+        start = int(decode_token(request.query['page_token'])[-1])
+    bars, next_t = data.bars_page(symbol, start, end, parse_limit(request.query, 1000, 10000))
+    data.stats['bars'] += len(bars)
+    return web.json_response({
+        'bars': bars,
+        'symbol': symbol,
+        'next_page_token': encode_token(symbol, next_t) if next_t is not None else None,
+    }, headers=headers)
+
+
+async def handle_multi_bars(request):
+    data = request.app['data']
+    headers, limited = await data.throttle()
+    if limited:
+        return too_many_requests(headers)
+
+    symbols = sorted(s for s in request.query.get('symbols', '').split(',') if s)
+    start, end = parse_range(request.query)
+    budget = parse_limit(request.query, 1000, 10000)
+    resume_symbol, resume_t = None, None
+    if 'page_token' in request.query:
+        resume_symbol, resume_t = decode_token(request.query['page_token'])
+        resume_t = int(resume_t)
+
+    # Results are ordered by symbol then time, and the limit applies across all symbols
+    page, next_token = {}, None
+    for symbol in symbols:
+        if resume_symbol is not None and symbol < resume_symbol:
+            continue
+        symbol_start = resume_t if symbol == resume_symbol else start
+        bars, next_t = data.bars_page(symbol, symbol_start, end, budget)
+        if bars:
+            page[symbol] = bars
+            budget -= len(bars)
+        if next_t is not None:
+            next_token = encode_token(symbol, next_t)
+            break
+        if budget == 0:
+            following = [s for s in symbols if s > symbol]
+            if following:
+                next_token = encode_token(following[0], start)
+            break
+
+    data.stats['bars'] += sum(len(b) for b in page.values())
+    return web.json_response({'bars': page, 'next_page_token': next_token}, headers=headers)
+
+
+async def handle_news(request):
+    data = request.app['data']
+    headers, limited = await data.throttle()
+    if limited:
+        return too_many_requests(headers)
+
+    symbols = [s for s in request.query.get('symbols', '').split(',') if s]
+    start, end = parse_range(request.query)
+    limit = parse_limit(request.query, 10, 50)
+    offset = int(decode_token(request.query['page_token'])[0]) if 'page_token' in request.query else 0
+
+    articles = [a for s in symbols for a in data.news_for(s)]
+    articles = [a for a in articles if start <= to_ns(a['created_at']) <= end]
+    articles.sort(key=lambda a: a['created_at'], reverse=request.query.get('sort', 'desc') == 'desc')
+    page = articles[offset:offset + limit]
+    next_token = encode_token(offset + limit) if offset + limit < len(articles) else None
+
+    data.stats['news'] += len(page)
+    return web.json_response({'news': page, 'next_page_token': next_token}, headers=headers)
+
+
+async def handle_submit_order(request):
+    trading = request.app['trading']
+    headers, limited = await trading.data.throttle()
+    if limited:
+        return too_many_requests(headers)
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({'code': 40010000, 'message': 'request body must be json'}, status=400)
+    status, response = trading.submit(body)
+    return web.json_response(response, status=status, headers=headers)
+
+
+async def handle_list_orders(request):
+    trading = request.app['trading']
+    headers, limited = await trading.data.throttle()
+    if limited:
+        return too_many_requests(headers)
+    status = request.query.get('status', 'open')
+    orders = [o for o in trading.orders.values()
+              if status == 'all' or (o['status'] in trading.TERMINAL) == (status == 'closed')]
+    orders.sort(key=lambda o: o['submitted_at'], reverse=request.query.get('direction', 'desc') == 'desc')
+    orders = orders[:parse_limit(request.query, 50, 500)]
+    return web.json_response([trading.order_json(o) for o in orders], headers=headers)
+
+
+async def handle_order(request):
+    trading = request.app['trading']
+    headers, limited = await trading.data.throttle()
+    if limited:
+        return too_many_requests(headers)
+    order_id = request.match_info['order_id']
+    if request.method == 'DELETE':
+        status = trading.cancel(order_id)
+        if status == 204:
+            return web.Response(status=204, headers=headers)
+        return web.json_response({'message': 'order not cancelable' if status == 422 else 'order not found'},
+                                 status=status, headers=headers)
+    order = trading.orders.get(order_id)
+    if order is None:
+        return web.json_response({'message': 'order not found'}, status=404, headers=headers)
+    return web.json_response(trading.order_json(order), headers=headers)
+
+
+async def handle_order_by_client_id(request):
+    trading = request.app['trading']
+    headers, limited = await trading.data.throttle()
+    if limited:
+        return too_many_requests(headers)
+    order_id = trading.by_client_id.get(request.query.get('client_order_id'))
+    if order_id is None:
+        return web.json_response({'message': 'order not found'}, status=404, headers=headers)
+    return web.json_response(trading.order_json(trading.orders[order_id]), headers=headers)
+
+
+async def handle_positions(request):
+    trading = request.app['trading']
+    headers, limited = await trading.data.throttle()
+    if limited:
+        return too_many_requests(headers)
+    symbol = request.match_info.get('symbol')
+    if symbol is None:
+        return web.json_response([trading.position_json(s) for s in sorted(trading.positions)], headers=headers)
+    if symbol not in trading.positions:
+        return web.json_response({'code': 40410000, 'message': 'position does not exist'}, status=404, headers=headers)
+    return web.json_response(trading.position_json(symbol), headers=headers)
+
+
+async def handle_account(request):
+    trading = request.app['trading']
+    headers, limited = await trading.data.throttle()
+    if limited:
+        return too_many_requests(headers)
+    return web.json_response(trading.account_json(), headers=headers)
+
+
+async def handle_trade_stream(request):
+    """The trading websocket: auth, then listen to trade_updates."""
+    trading = request.app['trading']
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    async for message in ws:
+        if message.type != web.WSMsgType.TEXT:
+            continue
+        try:
+            body = json.loads(message.data)
+        except ValueError:
+            continue
+        if body.get('action') in ('auth', 'authenticate'):
+            await ws.send_json({'stream': 'authorization', 'data': {'status': 'authorized', 'action': 'authenticate'}})
+        elif body.get('action') == 'listen':
+            streams = body.get('data', {}).get('streams', [])
+            if 'trade_updates' in streams:
+                trading.listeners.add(ws)
+            else:
+                trading.listeners.discard(ws)
+            await ws.send_json({'stream': 'listening', 'data': {'streams': streams}})
+    trading.listeners.discard(ws)
+    return ws
+
+
+async def handle_assets(request):
+    trading = request.app['trading']
+    headers, limited = await trading.data.throttle()
+    if limited:
+        return too_many_requests(headers)
+    symbol = request.match_info.get('symbol')
+    if symbol is not None:
+        asset = trading.assets().get(symbol)
+        if asset is None:
+            return web.json_response({'code': 40410000, 'message': 'asset not found'}, status=404, headers=headers)
+        return web.json_response(asset, headers=headers)
+    status = request.query.get('status')
+    asset_class = request.query.get('asset_class')
+    assets = [a for _, a in sorted(trading.assets().items())
+              if (status is None or a['status'] == status) and (asset_class is None or a['class'] == asset_class)]
+    return web.json_response(assets, headers=headers)
+
+
+async def handle_stats(request):
+    data = request.app['data']
+    if request.method == 'POST':
+        data.reset_stats()
+    return web.json_response(dict(data.stats, elapsed=time.time() - data.stats['started']))
+
+
+def build_app(data, trading=None):
+    app = web.Application()
+    app['data'] = data
+    app['trading'] = trading or MockAlpacaTrading(data)
+    app.router.add_get('/v2/stocks/bars', handle_multi_bars)
+    app.router.add_get('/v2/stocks/{symbol}/bars', handle_symbol_bars)
+    app.router.add_get('/v1beta1/news', handle_news)
+    app.router.add_post('/v2/orders', handle_submit_order)
+    app.router.add_get('/v2/orders', handle_list_orders)
+    app.router.add_get('/v2/orders:by_client_order_id', handle_order_by_client_id)
+    app.router.add_route('GET', '/v2/orders/{order_id}', handle_order)
+    app.router.add_route('DELETE', '/v2/orders/{order_id}', handle_order)
+    app.router.add_get('/v2/positions', handle_positions)
+    app.router.add_get('/v2/positions/{symbol}', handle_positions)
+    app.router.add_get('/v2/account', handle_account)
+    app.router.add_get('/v2/assets', handle_assets)
+    app.router.add_get('/v2/assets/{symbol}', handle_assets)
+    app.router.add_get('/stream', handle_trade_stream)
+    app.router.add_route('*', '/stats', handle_stats)
+    return app
+
+
+async def start_mock_server(data, host='127.0.0.1', port=8765, trading=None):
+    """Starts the mock server on the running loop and returns its AppRunner (call runner.cleanup() to stop)."""
+    runner = web.AppRunner(build_app(data, trading))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the Alpaca market data API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--rate-limit', type=int, default=200, help="Requests allowed per window")
+    parser.add_argument('--window', type=int, default=60, help="Rate limit window in seconds")
+    parser.add_argument('--no-shift', action='store_true', help="Serve timestamps as recorded")
+    parser.add_argument('--fill-delay', type=float, default=0.05, help="Seconds from order acceptance to fill")
+    args = parser.parse_args()
+
+    mock_data = MockAlpacaData(latency=args.latency, rate_limit=args.rate_limit, window=args.window,
+                               shift_to_now=not args.no_shift)
+    mock_trading = MockAlpacaTrading(mock_data, fill_delay=args.fill_delay)
+    web.run_app(build_app(mock_data, mock_trading), host=args.host, port=args.port)
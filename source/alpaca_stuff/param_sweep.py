@@ -0,0 +1,170 @@
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import backtrader as bt
+from tqdm import tqdm
+from asset_universe import universe_symbols
+from bar_resampler import BASE_TIMEFRAME, data_version, get_bars
+from bt_stuff import (ArrayStockData, BarBuffers, EquityCurve, MyStrategy, BuyDipsStrategy, FractionalSizer,
+                      collect_analysis, strategy_params)
+from results_store import ResultsStore, daily_equity, run_key
+
+STRATEGIES = {
+    'MyStrategy': MyStrategy,
+    'BuyDipsStrategy': BuyDipsStrategy,
+}
+# Rows of the shared bar block: time in epoch seconds (exact in float64) then the bar columns
+SHARED_ROWS = ['t', 'o', 'h', 'l', 'c', 'v', 'vw']
+
+# The grid from the commented out cerebro.optstrategy(MyStrategy, ...) in alpaca_stuff.py
+MY_STRATEGY_GRID = {
+    'stop_loss': [0.01, 0.025, 0.05],
+    'entry_multiplier': [1.00, 1.01, 1.02],
+    'exit_multiplier': [0.98, 0.99, 1.00],
+    'macd_fast': [10, 12, 15],
+    'macd_slow': [24, 26, 30],
+    'macd_signal': [7, 9, 11],
+}
+BUY_DIPS_GRID = {
+    'dip_percentage': [0.05, 5.0, 7.0, 10.0],
+    'buy_amount': [0.05, 0.03, 0.06],
+}
+
+
+def expand_grid(grid):
+    """Turns {'param': [values]} into the list of every parameter combination."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# ----- Shared bar data -----
+
+def share_bars(symbols, timeframe=BASE_TIMEFRAME):
+    """
+    Copies each symbol's bars once into a shared memory block. Workers map the blocks instead of
+    receiving pickled frames with every job. Returns ({symbol: (block name, n)}, blocks to unlink).
+    """
+    descriptors, blocks = {}, []
+    for symbol in symbols:
+        bars = get_bars(symbol, timeframe, as_numpy=True)
+        n = len(bars['t'])
+        if n == 0:
+            continue
+        block = shared_memory.SharedMemory(create=True, size=len(SHARED_ROWS) * n * 8)
+        data = np.ndarray((len(SHARED_ROWS), n), dtype=np.float64, buffer=block.buf)
+        data[0] = bars['t'] // 10**9
+        for i, col in enumerate(SHARED_ROWS[1:], start=1):
+            data[i] = bars[col]
+        descriptors[symbol] = (block.name, n)
+        blocks.append(block)
+    return descriptors, blocks
+
+
+_worker_blocks = {}
+_worker_buffers = {}
+
+
+def _attach_worker(descriptors):
+    # Runs once per worker process, the blocks stay mapped for every job the worker picks up
+    for symbol, (name, n) in descriptors.items():
+        block = shared_memory.SharedMemory(name=name)
+        _worker_blocks[symbol] = (block, np.ndarray((len(SHARED_ROWS), n), dtype=np.float64, buffer=block.buf))
+
+
+def _symbol_buffers(symbol):
+    # Line buffers are built on a worker's first job for the symbol and reused by all later ones
+    if symbol not in _worker_buffers:
+        data = _worker_blocks[symbol][1]
+        _worker_buffers[symbol] = BarBuffers(data[0].astype(np.int64) * 10**9, *data[1:])
+    return _worker_buffers[symbol]
+
+
+def run_backtest(strategy_name, params, data, starting_cash=1000.0, with_equity=False):
+    """
+    Runs one strategy/parameter set on one data feed with the same analyzers as build_analysis_cerebro.
+    with_equity also returns the per bar account value as (int64 ns times, values).
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.addstrategy(STRATEGIES[strategy_name], **params)
+    cerebro.adddata(data)
+    cerebro.addsizer(FractionalSizer)
+    cerebro.broker.setcash(starting_cash)
+    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name="ta")
+    cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name="sharpe")
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name="drawdown")
+    cerebro.addanalyzer(bt.analyzers.Returns, _name="returns")
+    if with_equity:
+        cerebro.addanalyzer(EquityCurve, _name="equity")
+
+    strat = cerebro.run()[0]
+    result = collect_analysis(strat)
+    result['start_value'] = starting_cash
+    result['final_value'] = cerebro.broker.getvalue()
+    result['pnl'] = result['final_value'] - starting_cash
+    if with_equity:
+        return result, strat.analyzers.equity.get_analysis()
+    return result
+
+
+def _run_job(job, starting_cash):
+    strategy_name, symbol, params = job
+    start = time.perf_counter()
+    result, equity = run_backtest(strategy_name, params, ArrayStockData(buffers=_symbol_buffers(symbol)),
+                                  starting_cash, with_equity=True)
+    # Only the daily closes of the curve go back through the pipe
+    return job, result, daily_equity(*equity), time.perf_counter() - start
+
+
+# ----- Sweep runner -----
+
+def run_sweep(strategy_name, grid, symbols, store=None, max_workers=None, starting_cash=1000.0,
+              timeframe=BASE_TIMEFRAME):
+    """
+    Fans every parameter combination x symbol out over a process pool. Finished runs go to the
+    results store as they complete, keyed on the full parameters and the version of the symbol's
+    data, so a crashed or interrupted sweep resumes where it stopped and a rerun only recomputes
+    symbols whose bars changed. Bars other than 5Min come from the resampling cache.
+    Returns the stored rows of the whole grid.
+    """
+    store = store or ResultsStore()
+    strategy = STRATEGIES[strategy_name]
+    versions = {symbol: data_version(symbol, timeframe) for symbol in symbols}
+    keyed = [(run_key(strategy_name, symbol, timeframe, strategy_params(strategy, params), versions[symbol],
+                      starting_cash), (strategy_name, symbol, params))
+             for params in expand_grid(grid) for symbol in symbols if versions[symbol] is not None]
+    keys = [key for key, _ in keyed]
+    done = store.done_keys(keys)
+    jobs = [(key, job) for key, job in keyed if key not in done]
+    if not jobs:
+        return store.load(keys=keys)
+
+    descriptors, blocks = share_bars(sorted({job[1] for _, job in jobs}), timeframe)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_attach_worker,
+                                 initargs=(descriptors,)) as executor:
+            futures = {executor.submit(_run_job, job, starting_cash): key for key, job in jobs
+                       if job[1] in descriptors}
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"Sweeping {strategy_name}"):
+                try:
+                    job, result, equity, elapsed = future.result()
+                except Exception as e:
+                    print(f"Backtest failed: {e}")
+                    continue
+                name, symbol, params = job
+                store.record(run_key=futures[future], strategy=name, symbol=symbol, timeframe=timeframe,
+                             data_version=versions[symbol], starting_cash=starting_cash,
+                             params=strategy_params(strategy, params), metrics=result, engine='backtrader',
+                             elapsed_s=elapsed, equity=equity)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return store.load(keys=keys)
+
+
+if __name__ == "__main__":
+    tickers = universe_symbols()[0:10]
+    run_sweep('MyStrategy', MY_STRATEGY_GRID, tickers)
+    print(ResultsStore().best('sharpe_ratio', 10, strategy='MyStrategy', symbols=tickers))
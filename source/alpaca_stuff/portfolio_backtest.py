@@ -0,0 +1,349 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from asset_universe import universe_symbols
+from bar_aggregation import group_bounds
+from bar_resampler import BASE_TIMEFRAME, BarResampler
+from bar_store import to_ns
+from trading_calendar import MARKET_TZ
+from vector_backtest import SIZER_BUY_AMOUNT, _value_metrics
+
+# One backtest over many symbols with one cash balance. All symbols' bars are merged into a single
+# time sorted event stream, and each timestamp is handled as one cross-sectional step over arrays
+# of the symbols that have a bar at it, so the cost grows with the number of bars and not with
+# symbols x timestamps as it does when backtrader synchronises every feed on every bar.
+
+EVENT_COLUMNS = ['t', 'o', 'h', 'l', 'c', 'vw']
+
+
+def event_chunks(symbols, timeframe=BASE_TIMEFRAME, start=None, end=None, resampler=None):
+    """
+    Yields the merged bars of all symbols one market-time month at a time, as dicts of arrays
+    sorted by time then symbol, with 'sym' holding the position of each bar's symbol in symbols.
+    Only one month of the universe is in memory at once.
+    """
+    resampler = resampler or BarResampler()
+    months = sorted({m for symbol in symbols for m in resampler.months(symbol, timeframe)})
+    if not months:
+        return
+    # Base partitions are UTC months, whose first evening belongs to the previous market month
+    first = pd.Period(months[0], 'M') - 1
+    starts = pd.period_range(first, months[-1], freq='M').to_timestamp().tz_localize(MARKET_TZ)
+    bounds = [(s, (s + pd.offsets.MonthBegin(1)).as_unit('ns') - pd.Timedelta(1, 'ns')) for s in starts]
+    start_ns = to_ns(start) if start is not None else None
+    end_ns = to_ns(end) if end is not None else None
+
+    for chunk_start, chunk_end in bounds:
+        if (start_ns is not None and chunk_end.value < start_ns) or (end_ns is not None and chunk_start.value > end_ns):
+            continue
+        lo = max(chunk_start.value, start_ns) if start_ns is not None else chunk_start
+        hi = min(chunk_end.value, end_ns) if end_ns is not None else chunk_end
+        parts, ids = [], []
+        for i, symbol in enumerate(symbols):
+            # months() above brought the derived bars up to date
+            bars = resampler.read_range(symbol, timeframe, lo, hi, refresh=False)
+            if len(bars['t']):
+                parts.append(bars)
+                ids.append(np.full(len(bars['t']), i, dtype=np.int64))
+        if not parts:
+            continue
+        events = {col: np.concatenate([p[col] for p in parts]) for col in EVENT_COLUMNS}
+        events['sym'] = np.concatenate(ids)
+        # Each symbol's run is already sorted, a stable sort merges them and keeps symbol order within a timestamp
+        order = np.argsort(events['t'], kind='stable')
+        yield {col: values[order] for col, values in events.items()}
+
+
+class CashLedger:
+    """
+    The shared account: one cash balance, a position per symbol marked at the symbol's last close,
+    and the list of closed trades. Holdings value is kept up to date incrementally per bar.
+    """
+
+    def __init__(self, n_symbols, starting_cash):
+        self.starting_cash = float(starting_cash)
+        self.cash = float(starting_cash)
+        self.pos = np.zeros(n_symbols)
+        self.entry_price = np.zeros(n_symbols)
+        self.last_close = np.zeros(n_symbols)
+        self.holdings = 0.0
+        self.opened = 0
+        self.trades = []  # (exit time ns, symbol, pnl) arrays per step
+
+    @property
+    def value(self):
+        return self.cash + self.holdings
+
+    def buy(self, syms, sizes, prices):
+        """
+        Fills buys in the given order, each checked against the cash left after the ones before it;
+        an order that cash cannot pay for is rejected and later, cheaper ones may still fill, as in
+        backtrader's broker. Returns the filled mask.
+        """
+        cost = sizes * prices
+        if cost.sum() <= self.cash:
+            filled = np.ones(len(cost), dtype=bool)
+        else:
+            filled = np.zeros(len(cost), dtype=bool)
+            cash = self.cash
+            for i, c in enumerate(cost.tolist()):
+                if c <= cash:
+                    filled[i] = True
+                    cash -= c
+        if filled.any():
+            s, size = syms[filled], sizes[filled]
+            pos = self.pos[s]
+            # A buy into a held symbol adds to its open trade at the size weighted average price,
+            # as in backtrader's TradeAnalyzer and Position
+            self.opened += int((pos == 0.0).sum())
+            self.cash -= cost[filled].sum()
+            self.entry_price[s] = (pos * self.entry_price[s] + cost[filled]) / (pos + size)
+            self.pos[s] = pos + size
+            self.holdings += (size * self.last_close[s]).sum()
+        return filled
+
+    def close(self, t, syms, prices):
+        """Sells the whole position of each symbol at prices and records the trades."""
+        pos = self.pos[syms]
+        self.cash += (pos * prices).sum()
+        self.holdings -= (pos * self.last_close[syms]).sum()
+        self.trades.append((np.full(len(syms), t), syms, pos * (prices - self.entry_price[syms])))
+        self.pos[syms] = 0.0
+
+    def mark(self, syms, close):
+        self.holdings += (self.pos[syms] * (close - self.last_close[syms])).sum()
+        self.last_close[syms] = close
+
+    def resync(self):
+        # Bounds the rounding drift of the incremental holdings value
+        self.holdings = float(self.pos @ self.last_close)
+
+    def trade_frame(self, symbols):
+        if not self.trades:
+            return pd.DataFrame({'t': pd.Series(dtype='int64'), 'symbol': pd.Series(dtype=object),
+                                 'pnl': pd.Series(dtype='float64')})
+        t, syms, pnl = (np.concatenate(parts) for parts in zip(*self.trades))
+        return pd.DataFrame({'t': t, 'symbol': np.asarray(symbols, dtype=object)[syms], 'pnl': pnl})
+
+
+class _EmaBank:
+    # One EMA per symbol, updated for the symbols of a step at once. Same recurrence as indicators.EMA,
+    # seeded with the mean of each symbol's first period values.
+    def __init__(self, n_symbols, period):
+        self.period = period
+        self.alpha = 2.0 / (1.0 + period)
+        self.value = np.full(n_symbols, np.nan)
+        self.count = np.zeros(n_symbols, dtype=np.int64)
+        self.seed = np.zeros(n_symbols)
+
+    def update(self, syms, x):
+        value = self.value[syms]
+        ready = ~np.isnan(value)
+        seeding = ~ready
+        count = self.count[syms] + seeding
+        seed = self.seed[syms] + np.where(seeding, x, 0.0)
+        seeded = seeding & (count == self.period)
+        value = np.where(ready, value * (1.0 - self.alpha) + x * self.alpha, np.where(seeded, seed / self.period, np.nan))
+        self.value[syms], self.count[syms], self.seed[syms] = value, count, seed
+        return value
+
+
+class PortfolioBuyDips:
+    """
+    BuyDipsStrategy on every symbol against the shared cash: a close dip_percentage below the
+    symbol's previous close places a buy of buy_amount x cash / close, filled at the next open.
+    """
+
+    def __init__(self, n_symbols, dip_percentage=0.001, buy_amount=0.05):
+        self.dip_percentage = dip_percentage
+        self.buy_amount = buy_amount
+        self.prev_close = np.full(n_symbols, np.nan)
+        self.pending = np.zeros(n_symbols)
+
+    def step(self, ledger, t, syms, o, h, l, c, vw):
+        size = self.pending[syms]
+        waiting = size > 0
+        if waiting.any():
+            ledger.buy(syms[waiting], size[waiting], o[waiting])
+            self.pending[syms] = 0.0
+
+        with np.errstate(invalid='ignore'):
+            dip = (c - self.prev_close[syms]) / self.prev_close[syms] * 100 <= -self.dip_percentage
+        # Every symbol sizes from the cash as it stands at the signal, like get_cash() in next()
+        self.pending[syms[dip]] = ledger.cash * self.buy_amount / c[dip]
+        self.prev_close[syms] = c
+
+
+class PortfolioMacdVwap:
+    """
+    MyStrategy(long_only=True) on every symbol against the shared cash. Entries of one timestamp
+    are ranked by how far the close is above VWAP and capped by max_positions; each is sized by
+    FractionalSizer as buy_amount x cash / close and fills at the next open while the cash lasts.
+    """
+
+    def __init__(self, n_symbols, stop_loss=0.02, entry_multiplier=1.01, exit_multiplier=0.99, macd_fast=12,
+                 macd_slow=26, macd_signal=9, buy_amount=SIZER_BUY_AMOUNT, max_positions=None):
+        self.stop_loss = stop_loss
+        self.entry_multiplier = entry_multiplier
+        self.exit_multiplier = exit_multiplier
+        self.buy_amount = buy_amount
+        self.max_positions = max_positions
+        self.fast = _EmaBank(n_symbols, macd_fast)
+        self.slow = _EmaBank(n_symbols, macd_slow)
+        self.signal = _EmaBank(n_symbols, macd_signal)
+        self.stop = np.full(n_symbols, -np.inf)  # -inf when there is no live trailing stop
+        self.pending_buy = np.zeros(n_symbols)
+        self.pending_exit = np.zeros(n_symbols, dtype=bool)
+        self.n_open = 0
+
+    def step(self, ledger, t, syms, o, h, l, c, vw):
+        # Same order as the single symbol engine: entry fill, stop check, exit fill, stop trail, signals
+        filled = np.zeros(len(syms), dtype=bool)
+        size = self.pending_buy[syms]
+        waiting = size > 0
+        if waiting.any():
+            filled[waiting] = ledger.buy(syms[waiting], size[waiting], o[waiting])
+            self.pending_buy[syms] = 0.0
+            self.n_open += int(filled.sum())
+
+        stop = self.stop[syms]
+        live = stop > -np.inf
+        out = np.zeros(len(syms), dtype=bool)
+        if live.any():
+            hit = live & (l <= stop)
+            out = hit | (live & self.pending_exit[syms])
+            if out.any():
+                price = np.where(hit & (o > stop), stop, o)
+                ledger.close(t, syms[out], price[out])
+                self.n_open -= int(out.sum())
+            stop = np.where(live & ~out, np.maximum(stop, c - c * self.stop_loss), np.where(out, -np.inf, stop))
+        self.pending_exit[syms] = False
+        # notify_order places the trailing stop once the entry is filled
+        self.stop[syms] = np.where(filled, c - c * self.stop_loss, stop)
+
+        macd = self.fast.update(syms, c) - self.slow.update(syms, c)
+        valid = ~np.isnan(macd)
+        signal = np.full(len(syms), np.nan)
+        signal[valid] = self.signal.update(syms[valid], macd[valid])
+
+        flat = ledger.pos[syms] == 0.0
+        with np.errstate(invalid='ignore'):
+            entry = flat & (macd > signal) & (c > vw * self.entry_multiplier)
+            self.pending_exit[syms] = ~flat & (macd < signal) & (c < vw * self.exit_multiplier)
+        if entry.any():
+            picks = np.flatnonzero(entry)
+            if self.max_positions is not None:
+                # Strongest breakouts first, within the slots left
+                picks = picks[np.argsort(-(c[picks] / vw[picks]), kind='stable')]
+                picks = np.sort(picks[:max(self.max_positions - self.n_open, 0)])
+            self.pending_buy[syms[picks]] = self.buy_amount * ledger.cash / c[picks]
+
+
+PORTFOLIO_STRATEGIES = {
+    'MyStrategy': PortfolioMacdVwap,
+    'BuyDipsStrategy': PortfolioBuyDips,
+}
+
+
+def _trade_stats(trades):
+    pnl = trades['pnl'].to_numpy()
+    won = pnl >= 0.0
+    # Longest runs of wins and losses in exit order
+    runs = group_bounds(won)
+    lengths = runs[1] - runs[0] + 1
+    kinds = won[runs[0]]
+    return {
+        'closed_trades': len(pnl),
+        'won_trades': int(won.sum()),
+        'lost_trades': int((~won).sum()),
+        'winning_streak': int(lengths[kinds].max(initial=0)),
+        'losing_streak': int(lengths[~kinds].max(initial=0)),
+        'pnl_net_total': float(pnl.sum()),
+        'pnl_net_average': float(pnl.mean()) if len(pnl) else 0.0,
+    }
+
+
+def run_portfolio_backtest(strategy_name, symbols, params=None, starting_cash=100000.0, timeframe=BASE_TIMEFRAME,
+                           start=None, end=None, resampler=None):
+    """
+    Runs one strategy over all symbols with a shared cash ledger. Returns a dict with 'metrics'
+    (the analyzer figures of collect_analysis for the whole account), 'equity' (account value per
+    timestamp), 'trades' (one row per closed trade) and 'throughput' (bars, timestamps, bars/s).
+    """
+    symbols = list(symbols)
+    strategy = PORTFOLIO_STRATEGIES[strategy_name](len(symbols), **(params or {}))
+    ledger = CashLedger(len(symbols), starting_cash)
+    times, values = [], []
+    n_bars = 0
+    read_s = 0.0
+    started = time.perf_counter()
+
+    chunks = event_chunks(symbols, timeframe, start, end, resampler)
+    while True:
+        read_start = time.perf_counter()
+        events = next(chunks, None)
+        read_s += time.perf_counter() - read_start
+        if events is None:
+            break
+        starts, ends = group_bounds(events['t'])
+        t_all, sym_all = events['t'], events['sym']
+        o_all, h_all, l_all, c_all, vw_all = (events[col] for col in ('o', 'h', 'l', 'c', 'vw'))
+        chunk_values = np.empty(len(starts))
+        for j, (a, b) in enumerate(zip(starts.tolist(), (ends + 1).tolist())):
+            syms, c = sym_all[a:b], c_all[a:b]
+            strategy.step(ledger, t_all[a], syms, o_all[a:b], h_all[a:b], l_all[a:b], c, vw_all[a:b])
+            ledger.mark(syms, c)
+            chunk_values[j] = ledger.value
+        ledger.resync()
+        times.append(t_all[starts])
+        values.append(chunk_values)
+        n_bars += len(t_all)
+
+    elapsed = time.perf_counter() - started
+    t = np.concatenate(times) if times else np.array([], dtype=np.int64)
+    equity = np.concatenate(values) if values else np.array([])
+    trades = ledger.trade_frame(symbols)
+
+    metrics = {'total_trades': ledger.opened, **_trade_stats(trades)}
+    if len(equity):
+        metrics.update({k: v[0].item() for k, v in _value_metrics(equity[:, None], t, starting_cash).items()})
+    return {
+        'metrics': metrics,
+        'equity': pd.Series(equity, index=pd.DatetimeIndex(t).tz_localize('UTC'), name='value'),
+        'trades': trades,
+        'throughput': {
+            'symbols': len(symbols),
+            'bars': n_bars,
+            'timestamps': len(t),
+            'elapsed_s': elapsed,
+            'read_s': read_s,
+            'bars_per_s': n_bars / elapsed if elapsed else 0.0,
+            'simulated_bars_per_s': n_bars / (elapsed - read_s) if elapsed > read_s else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Portfolio backtest of one strategy over many symbols")
+    parser.add_argument('--strategy', default='MyStrategy', choices=sorted(PORTFOLIO_STRATEGIES))
+    parser.add_argument('--symbols', type=int, default=None, help="First N symbols of the current universe")
+    parser.add_argument('--timeframe', default=BASE_TIMEFRAME)
+    parser.add_argument('--cash', type=float, default=100000.0)
+    parser.add_argument('--start')
+    parser.add_argument('--end')
+    args = parser.parse_args()
+
+    symbols = universe_symbols()[:args.symbols]
+    result = run_portfolio_backtest(args.strategy, symbols, starting_cash=args.cash, timeframe=args.timeframe,
+                                    start=args.start, end=args.end)
+    for name, value in result['metrics'].items():
+        print(f"{name}: {value}")
+    tp = result['throughput']
+    print(f"\n{tp['bars']:,} bars of {tp['symbols']} symbols over {tp['timestamps']:,} timestamps in "
+          f"{tp['elapsed_s']:.1f}s ({tp['bars_per_s']:,.0f} bars/s, {tp['simulated_bars_per_s']:,.0f} bars/s "
+          f"excluding {tp['read_s']:.1f}s of reads)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+import numpy as np
+import pandas as pd
+from bar_aggregation import day_keys, group_bounds
+from trading_calendar import MARKET_TZ
+
+# Every backtest run, from param_sweep or vector_backtest, lands in one SQLite file: parameters,
+# symbol, the version of the data it ran on, all analyzer figures, timing and a daily equity curve.
+RESULTS_PATH = os.environ.get('BACKTEST_RESULTS', '../../data/backtest_results.sqlite')
+
+# Metrics kept in their own columns so best-N queries can sort in SQL, the rest live in the JSON
+INDEXED_METRICS = ['sharpe_ratio', 'rnorm100', 'pnl', 'final_value', 'max_drawdown', 'total_trades']
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    run_key TEXT PRIMARY KEY,
+    strategy TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    timeframe TEXT NOT NULL,
+    data_version TEXT NOT NULL,
+    starting_cash REAL NOT NULL,
+    params TEXT NOT NULL,
+    metrics TEXT NOT NULL,
+    {', '.join(f'{name} REAL' for name in INDEXED_METRICS)},
+    engine TEXT NOT NULL,
+    elapsed_s REAL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_strategy ON runs (strategy, timeframe, symbol);
+CREATE TABLE IF NOT EXISTS equity (
+    run_key TEXT PRIMARY KEY,
+    t BLOB NOT NULL,
+    value BLOB NOT NULL
+);
+"""
+
+
+def run_key(strategy, symbol, timeframe, params, data_version, starting_cash):
+    """
+    Identity of a backtest: same strategy, full parameter set, symbol, timeframe, data version and
+    starting cash give the same figures, whichever engine ran it.
+    """
+    payload = json.dumps([strategy, symbol, timeframe, params, data_version, float(starting_cash)],
+                         sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def daily_equity(t, values, tz=MARKET_TZ):
+    """Last account value of every market day, which is all a stored curve needs. values may be (n,) or (n, k)."""
+    t = np.asarray(t, dtype=np.int64)
+    if len(t) == 0:
+        return t, np.asarray(values)
+    _, ends = group_bounds(day_keys(t, tz))
+    return t[ends], np.asarray(values)[ends]
+
+
+def _json_value(value):
+    # Analyzer figures arrive as NumPy scalars or plain values; json keeps inf and NaN as Infinity/NaN
+    return value.item() if hasattr(value, 'item') else value
+
+
+class ResultsStore:
+    """
+    Structured backtest results. Sweeps ask done_keys() which runs already exist for the current
+    data and only compute the rest, so rerunning a sweep is free and extending a grid only pays for
+    the new combinations. load() and best() return frames with a column per parameter and metric.
+    """
+
+    def __init__(self, path=RESULTS_PATH):
+        self.path = path
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def done_keys(self, keys):
+        """The subset of keys that already have a stored run."""
+        keys = list(keys)
+        done = set()
+        with closing(self.connect()) as conn:
+            # Stay under SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                done.update(k for k, in conn.execute(
+                    f"SELECT run_key FROM runs WHERE run_key IN ({','.join('?' * len(chunk))})", chunk))
+        return done
+
+    def record_many(self, runs):
+        """
+        Stores runs in one transaction. Each run is a dict with run_key, strategy, symbol, timeframe,
+        data_version, starting_cash, params, metrics, engine and optionally elapsed_s and equity
+        (a (t, values) pair, stored as given).
+        """
+        now = time.time()
+        rows, curves = [], []
+        for run in runs:
+            metrics = {name: _json_value(value) for name, value in run['metrics'].items()}
+            indexed = [metrics.get(name) for name in INDEXED_METRICS]
+            rows.append((run['run_key'], run['strategy'], run['symbol'], run['timeframe'], run['data_version'],
+                         float(run['starting_cash']), json.dumps(run['params'], sort_keys=True, default=_json_value),
+                         json.dumps(metrics), *indexed, run['engine'], run.get('elapsed_s'), now))
+            if run.get('equity') is not None:
+                t, values = run['equity']
+                curves.append((run['run_key'], np.asarray(t, dtype=np.int64).tobytes(),
+                               np.asarray(values, dtype=np.float64).tobytes()))
+        with closing(self.connect()) as conn, conn:
+            conn.executemany(f"INSERT OR REPLACE INTO runs VALUES ({','.join('?' * (11 + len(INDEXED_METRICS)))})", rows)
+            conn.executemany("INSERT OR REPLACE INTO equity VALUES (?, ?, ?)", curves)
+
+    def record(self, **run):
+        self.record_many([run])
+
+    def _query(self, strategy=None, timeframe=None, keys=None, order_by=None, limit=None):
+        clauses, args = [], []
+        for column, value in (('strategy', strategy), ('timeframe', timeframe)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                args.append(value)
+        if keys is not None:
+            clauses.append(f"run_key IN ({','.join('?' * len(keys))})")
+            args.extend(keys)
+        sql = ("SELECT run_key, strategy, symbol, timeframe, data_version, starting_cash, params, metrics, engine, "
+               "elapsed_s, finished_at FROM runs")
+        if clauses:
+            sql += f" WHERE {' AND '.join(clauses)}"
+        if order_by is not None:
+            sql += f" ORDER BY {order_by}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with closing(self.connect()) as conn:
+            return conn.execute(sql, args).fetchall()
+
+    def load(self, strategy=None, symbols=None, timeframe=None, keys=None):
+        """Stored runs matching the filters, one row per run with the parameters and metrics spread into columns."""
+        if keys is not None:
+            keys = list(keys)
+            rows = [row for start in range(0, len(keys), 500)
+                    for row in self._query(strategy, timeframe, keys[start:start + 500])]
+        else:
+            rows = self._query(strategy, timeframe)
+        if symbols is not None:
+            symbols = set(symbols)
+            rows = [r for r in rows if r[2] in symbols]
+        return self._frame(rows)
+
+    def _frame(self, rows):
+        records = []
+        for key, strat, symbol, tf, version, cash, params, metrics, engine, elapsed, finished in rows:
+            records.append({'run_key': key, 'strategy': strat, 'symbol': symbol, 'timeframe': tf,
+                            **json.loads(params), **json.loads(metrics), 'data_version': version,
+                            'starting_cash': cash, 'engine': engine, 'elapsed_s': elapsed, 'finished_at': finished})
+        return pd.DataFrame(records)
+
+    def best(self, metric='sharpe_ratio', n=10, strategy=None, symbols=None, timeframe=None, keys=None,
+             per_symbol=False, ascending=False):
+        """The n best runs by metric (undefined values last), overall or per symbol."""
+        if metric in INDEXED_METRICS and symbols is None and keys is None and not per_symbol:
+            # Sorted and cut in SQLite, only n rows are decoded
+            order = f"{metric} IS NULL, {metric} {'ASC' if ascending else 'DESC'}"
+            return self._frame(self._query(strategy, timeframe, order_by=order, limit=n))
+        df = self.load(strategy, symbols, timeframe, keys)
+        if df.empty:
+            return df
+        df[metric] = pd.to_numeric(df[metric], errors='coerce')
+        df = df.sort_values(metric, ascending=ascending, na_position='last', kind='stable')
+        if per_symbol:
+            return df.groupby('symbol', sort=True).head(n).reset_index(drop=True)
+        return df.head(n).reset_index(drop=True)
+
+    def equity(self, key):
+        """The stored equity curve of a run as a Series indexed by UTC time, or None."""
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT t, value FROM equity WHERE run_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        index = pd.DatetimeIndex(np.frombuffer(row[0], dtype=np.int64)).tz_localize('UTC')
+        return pd.Series(np.frombuffer(row[1], dtype=np.float64), index=index, name=key)
+
+    def export_parquet(self, path, **filters):
+        """Writes load(**filters) to a Parquet file for analysis elsewhere."""
+        df = self.load(**filters)
+        df.to_parquet(path, index=False)
+        return path
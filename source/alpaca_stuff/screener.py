@@ -0,0 +1,456 @@
+import argparse
+import ast
+import math
+import os
+import time
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from asset_universe import current_assets
+from bar_resampler import data_version, get_bars
+from bar_store import BAR_STORE_ROOT, list_tickers
+from fundamentals import FUNDAMENTALS_PATH, FundamentalsMatrix
+
+# Per ticker statistics of the latest daily bars, recomputed only for tickers whose bars changed
+BAR_STATS_PATH = os.environ.get('BAR_STATS_PATH', '../../data/bar_stats.parquet')
+STATS_DAYS = 20
+TRADING_DAYS = 252
+ASSET_FLAGS = ['tradable', 'marginable', 'shortable', 'easy_to_borrow', 'fractionable']
+
+
+# ----- Universe columns -----
+
+def bar_statistics(bars, days=STATS_DAYS):
+    """
+    Liquidity and risk figures from daily bars (read_bars(as_numpy=True) format): last close,
+    average daily share and dollar volume and annualized volatility of log returns over the last
+    `days` sessions, the latest gap (open against the previous close) and the `days` session return.
+    """
+    t, o, c, v, vw = bars['t'], bars['o'], bars['c'], bars['v'], bars['vw']
+    n = len(t)
+    recent = slice(max(n - days, 0), n)
+    returns = np.diff(np.log(c[max(n - days - 1, 0):]))
+    return {
+        'close': c[-1],
+        'adv': v[recent].mean(),
+        'dollar_adv': (vw[recent] * v[recent]).mean(),
+        'volatility': returns.std(ddof=1) * math.sqrt(TRADING_DAYS) if len(returns) > 1 else np.nan,
+        'gap_pct': (o[-1] / c[-2] - 1.0) * 100.0 if n > 1 else np.nan,
+        'return_pct': (c[-1] / c[-days - 1] - 1.0) * 100.0 if n > days else np.nan,
+        'last_day': pd.Timestamp(t[-1]),
+        'days': n,
+    }
+
+
+def refresh_bar_stats(tickers=None, path=BAR_STATS_PATH, days=STATS_DAYS):
+    """
+    Brings the bar statistics table up to date: tickers whose base bars have the same data version
+    as when their row was computed are kept, the rest are recomputed from the daily bar cache.
+    Returns the table, one row per ticker.
+    """
+    tickers = list_tickers(BAR_STORE_ROOT) if tickers is None else list(tickers)
+    old = pd.read_parquet(path).set_index('symbol') if os.path.exists(path) else pd.DataFrame()
+    known = old['data_version'].to_dict() if len(old) else {}
+
+    rows, kept = [], []
+    for ticker in tqdm(tickers, desc="Bar statistics"):
+        version = data_version(ticker)
+        if version is None:
+            continue
+        if known.get(ticker) == version:
+            kept.append(ticker)
+            continue
+        bars = get_bars(ticker, '1Day', as_numpy=True)
+        if len(bars['t']):
+            rows.append({'symbol': ticker, 'data_version': version, **bar_statistics(bars, days)})
+
+    df = pd.concat([old.loc[kept].reset_index(), pd.DataFrame(rows)], ignore_index=True) if kept else pd.DataFrame(rows)
+    if len(df):
+        df = df.sort_values('symbol', ignore_index=True)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        df.to_parquet(path, index=False)
+    return df
+
+
+def load_assets(path=None):
+    """The current asset universe (a CSV in the shortable_assets.csv layout with path), one row per symbol."""
+    df = current_assets() if path is None else pd.read_csv(path, index_col=0)
+    df = df.drop_duplicates('symbol').set_index('symbol')
+    for flag in ASSET_FLAGS:
+        if flag in df:
+            df[flag] = df[flag].astype(bool)
+    return df
+
+
+# ----- Expressions -----
+
+class Expr:
+    """
+    A lazily evaluated column expression. Combine with comparisons, arithmetic, & | ~ and the
+    methods below; Universe.evaluate() turns it into one NumPy array over the whole universe.
+    """
+
+    def evaluate(self, universe):
+        raise NotImplementedError
+
+    def _op(self, name, func, *others):
+        return Op(name, func, self, *(o if isinstance(o, Expr) else Const(o) for o in others))
+
+    def __gt__(self, other): return self._op('>', np.greater, other)
+    def __ge__(self, other): return self._op('>=', np.greater_equal, other)
+    def __lt__(self, other): return self._op('<', np.less, other)
+    def __le__(self, other): return self._op('<=', np.less_equal, other)
+    def __eq__(self, other): return self._op('==', np.equal, other)
+    def __ne__(self, other): return self._op('!=', _not_equal, other)
+    def __and__(self, other): return self._op('&', _and, other)
+    def __or__(self, other): return self._op('|', _or, other)
+    def __invert__(self): return self._op('~', _not)
+    def __add__(self, other): return self._op('+', np.add, other)
+    def __sub__(self, other): return self._op('-', np.subtract, other)
+    def __mul__(self, other): return self._op('*', np.multiply, other)
+    def __truediv__(self, other): return self._op('/', _divide, other)
+    def __neg__(self): return self._op('neg', np.negative)
+    def __abs__(self): return self._op('abs', np.abs)
+    __hash__ = object.__hash__
+
+    def between(self, low, high):
+        return (self >= low) & (self <= high)
+
+    def isin(self, values):
+        return self._op('isin', _isin, tuple(values))
+
+    def notnull(self):
+        return self._op('notnull', lambda a: ~pd.isna(a))
+
+    def log(self):
+        return self._op('log', _log)
+
+    def rank(self, ascending=True):
+        """Percentile rank in [0, 1] over the universe, NaN stays NaN."""
+        return self._op(f'rank{ascending}', lambda a: pd.Series(a).rank(pct=True, ascending=ascending).to_numpy())
+
+    def zscore(self):
+        """Cross-sectional z-score, NaN stays NaN."""
+        return self._op('zscore', _zscore)
+
+
+class Col(Expr):
+    def __init__(self, name):
+        self.name = name
+
+    def evaluate(self, universe):
+        return universe.column(self.name)
+
+    def __repr__(self):
+        return self.name
+
+
+class Const(Expr):
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, universe):
+        return self.value
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class Op(Expr):
+    def __init__(self, name, func, *args):
+        self.name = name
+        self.func = func
+        self.args = args
+
+    def evaluate(self, universe):
+        return self.func(*(universe.evaluate(arg) for arg in self.args))
+
+    def __invert__(self):
+        # Negate by flipping the operator rather than the result: NaN > 5 and NaN <= 5 are both
+        # false, so rows with NaN keep failing. & and | go through De Morgan.
+        if self.name in _COMPLEMENTS:
+            name, func = _COMPLEMENTS[self.name]
+            return Op(name, func, *self.args)
+        if self.name == '&':
+            return ~self.args[0] | ~self.args[1]
+        if self.name == '|':
+            return ~self.args[0] & ~self.args[1]
+        if self.name == '~':
+            return self.args[0]
+        return super().__invert__()
+
+    def __repr__(self):
+        return f"{self.name}({', '.join(map(repr, self.args))})"
+
+
+class Fundamental(Expr):
+    """A FundamentalsMatrix figure per ticker: kind is 'factor' (with lag), 'growth' or 'ttm'."""
+
+    def __init__(self, kind, factor, n=None):
+        self.kind, self.factor, self.n = kind, factor, n
+
+    def evaluate(self, universe):
+        return universe.fundamental(self.kind, self.factor, self.n)
+
+    def __repr__(self):
+        return f"{self.kind}({self.factor}, {self.n})"
+
+
+def _truthy(a):
+    # NaN is neither true nor false in a filter, it just fails it
+    a = np.asarray(a)
+    return a.astype(bool) if a.dtype == bool else np.nan_to_num(a.astype(np.float64), nan=0.0) != 0
+
+
+def _not(a):
+    # A NaN value is not false either
+    return ~_truthy(a) & ~pd.isna(a)
+
+
+def _not_equal(a, b):
+    return np.not_equal(a, b) & ~pd.isna(a) & ~pd.isna(b)
+
+
+def _isin(a, values):
+    return np.isin(a, values)
+
+
+def _notin(a, values):
+    return ~np.isin(a, values) & ~pd.isna(a)
+
+
+_COMPLEMENTS = {
+    '>': ('<=', np.less_equal), '<=': ('>', np.greater),
+    '<': ('>=', np.greater_equal), '>=': ('<', np.less),
+    '==': ('!=', _not_equal), '!=': ('==', np.equal),
+    'isin': ('notin', _notin), 'notin': ('isin', _isin),
+}
+
+
+def _and(a, b):
+    return _truthy(a) & _truthy(b)
+
+
+def _or(a, b):
+    return _truthy(a) | _truthy(b)
+
+
+def _divide(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(np.asarray(b) != 0, np.divide(a, b), np.nan)
+
+
+def _log(a):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(np.asarray(a) > 0, np.log(a), np.nan)
+
+
+def _zscore(a):
+    a = np.asarray(a, dtype=np.float64)
+    deviation = np.nanstd(a)
+    return (a - np.nanmean(a)) / deviation if deviation > 0 else np.full_like(a, np.nan)
+
+
+def col(name):
+    return Col(name)
+
+
+def growth(factor, periods=1):
+    """Quarter over quarter (or over `periods` quarters) relative change of a fundamentals factor."""
+    return Fundamental('growth', factor, periods)
+
+
+def ttm(factor, quarters=4):
+    """Sum of a fundamentals factor over the last `quarters` quarters."""
+    return Fundamental('ttm', factor, quarters)
+
+
+def lag(factor, quarters=1):
+    """A fundamentals factor `quarters` quarters before the newest report."""
+    return Fundamental('factor', factor, quarters)
+
+
+# ----- Universe -----
+
+class Universe:
+    """
+    The columnar table screens run over: asset flags, bar statistics and, by name, any factor of
+    the fundamentals matrix (newest quarter), all aligned on one symbol index. Columns are NumPy
+    arrays pulled out once; every evaluated expression is cached by its repr, so a sub-expression
+    used by several filters or by the ranking is computed once.
+    """
+
+    def __init__(self, table, fundamentals=None):
+        self.table = table
+        self.symbols = table.index
+        self.fundamentals = fundamentals
+        if fundamentals is not None:
+            self._fund_rows = fundamentals.tickers.get_indexer(self.symbols)
+        self._cache = {}
+
+    @classmethod
+    def load(cls, assets_path=None, stats_path=BAR_STATS_PATH, fundamentals_path=FUNDAMENTALS_PATH):
+        """Joins the stored asset table, bar statistics and fundamentals, whichever of them exist."""
+        table = load_assets(assets_path)
+        if os.path.exists(stats_path):
+            stats = pd.read_parquet(stats_path).set_index('symbol').drop(columns='data_version')
+            table = table.join(stats, how='left')
+        fundamentals = FundamentalsMatrix.load(fundamentals_path) if os.path.exists(fundamentals_path) else None
+        return cls(table, fundamentals)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def column(self, name):
+        key = ('column', name)
+        if key not in self._cache:
+            if name in self.table:
+                values = self.table[name].to_numpy()
+            elif self.fundamentals is not None and name in self.fundamentals.factors:
+                values = self.fundamental('factor', name, 0)
+            else:
+                raise KeyError(f"Unknown column {name!r}")
+            self._cache[key] = values
+        return self._cache[key]
+
+    def fundamental(self, kind, factor, n):
+        key = (kind, factor, n)
+        if key not in self._cache:
+            if self.fundamentals is None:
+                raise KeyError("No fundamentals table, build it with fundamentals.py")
+            m = self.fundamentals
+            values = {'factor': m.factor, 'growth': m.growth, 'ttm': m.trailing}[kind](factor, n)
+            rows = self._fund_rows
+            self._cache[key] = np.where(rows >= 0, values[np.maximum(rows, 0)] if len(values) else np.nan, np.nan)
+        return self._cache[key]
+
+    def evaluate(self, expr):
+        if not isinstance(expr, Expr):
+            return expr
+        key = repr(expr)
+        if key not in self._cache:
+            self._cache[key] = expr.evaluate(self)
+        return self._cache[key]
+
+    def mask(self, *filters):
+        """Boolean mask of the symbols passing every filter."""
+        mask = np.ones(len(self.symbols), dtype=bool)
+        for f in filters:
+            mask &= _truthy(self.evaluate(f))
+        return mask
+
+    def screen(self, *filters, rank=None, ascending=False, top=None, columns=None):
+        """
+        Symbols passing every filter as a DataFrame with the requested columns (expressions or
+        names) and, with rank, a 'score' column sorted best first and cut to the top N.
+        """
+        mask = self.mask(*filters)
+        out = {}
+        for c in columns or []:
+            expr = parse(c) if isinstance(c, str) else c
+            out[repr(expr) if not isinstance(c, str) else c] = np.broadcast_to(self.evaluate(expr), mask.shape)[mask]
+        df = pd.DataFrame(out, index=self.symbols[mask])
+        if rank is not None:
+            rank = parse(rank) if isinstance(rank, str) else rank
+            df['score'] = np.broadcast_to(self.evaluate(rank), mask.shape)[mask]
+            df = df.sort_values('score', ascending=ascending, na_position='last', kind='stable')
+        return df.head(top) if top else df
+
+
+# ----- Expression strings -----
+
+FUNCTIONS = {
+    'growth': growth,
+    'ttm': ttm,
+    'lag': lag,
+    'rank': lambda e, ascending=True: e.rank(ascending),
+    'zscore': lambda e: e.zscore(),
+    'log': lambda e: e.log(),
+    'abs': abs,
+    'between': lambda e, low, high: e.between(low, high),
+    'isin': lambda e, *values: e.isin(values),
+    'notnull': lambda e: e.notnull(),
+}
+_COMPARE = {ast.Gt: '__gt__', ast.GtE: '__ge__', ast.Lt: '__lt__', ast.LtE: '__le__', ast.Eq: '__eq__',
+            ast.NotEq: '__ne__'}
+_BINARY = {ast.Add: '__add__', ast.Sub: '__sub__', ast.Mult: '__mul__', ast.Div: '__truediv__',
+           ast.BitAnd: '__and__', ast.BitOr: '__or__'}
+
+
+def parse(text):
+    """
+    Turns an expression string such as "shortable and dollar_adv > 5e6 and growth(EBITDA) > 0.1"
+    into an Expr. Only names, numbers, strings, comparisons, arithmetic, and/or/not and the
+    FUNCTIONS are accepted, nothing is passed to eval().
+    """
+    return _convert(ast.parse(text, mode='eval').body)
+
+
+def _convert(node, raw=False):
+    if isinstance(node, ast.Constant):
+        return node.value if raw else Const(node.value)
+    if isinstance(node, ast.Name):
+        # Inside growth()/ttm()/lag() a bare name is the factor itself
+        return node.id if raw else Col(node.id)
+    if isinstance(node, ast.BoolOp):
+        values = [_convert(v) for v in node.values]
+        result = values[0]
+        for v in values[1:]:
+            result = result & v if isinstance(node.op, ast.And) else result | v
+        return result
+    if isinstance(node, ast.UnaryOp):
+        operand = _convert(node.operand)
+        if isinstance(node.op, ast.Not) or isinstance(node.op, ast.Invert):
+            return ~operand
+        if isinstance(node.op, ast.USub):
+            return Const(-operand.value) if isinstance(operand, Const) else -operand
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+        left, right = _convert(node.left), _convert(node.right)
+        return getattr(left, _BINARY[type(node.op)])(right)
+    if isinstance(node, ast.Compare):
+        result, left = None, _convert(node.left)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _convert(comparator)
+            term = getattr(left, _COMPARE[type(op)])(right)
+            result = term if result is None else result & term
+            left = right
+        return result
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS:
+        name = node.func.id
+        fundamental = name in ('growth', 'ttm', 'lag')
+        args = [_convert(a, raw=fundamental or i > 0) for i, a in enumerate(node.args)]
+        kwargs = {k.arg: _convert(k.value, raw=True) for k in node.keywords}
+        return FUNCTIONS[name](*args, **kwargs)
+    raise ValueError(f"Unsupported expression: {ast.unparse(node)}")
+
+
+def run_screen(filters, rank=None, ascending=False, top=None, columns=None, universe=None):
+    """Library entry point: parses the filter/rank strings and screens the stored universe."""
+    universe = universe or Universe.load()
+    return universe.screen(*(parse(f) if isinstance(f, str) else f for f in filters), rank=rank,
+                           ascending=ascending, top=top, columns=columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Screen the asset universe with filter and ranking expressions")
+    parser.add_argument('filters', nargs='*', help='e.g. "shortable and dollar_adv > 5e6" "growth(EBITDA) > 0.1"')
+    parser.add_argument('--rank', help='Score to sort by, e.g. "zscore(growth(TotalRevenue)) - zscore(volatility)"')
+    parser.add_argument('--ascending', action='store_true', help="Lowest score first")
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--columns', nargs='*', default=['close', 'dollar_adv', 'volatility', 'gap_pct'])
+    parser.add_argument('--refresh-stats', action='store_true', help="Recompute bar statistics of changed tickers")
+    parser.add_argument('--output', help="Write the result to this CSV")
+    args = parser.parse_args()
+
+    if args.refresh_stats:
+        refresh_bar_stats()
+    start = time.perf_counter()
+    universe = Universe.load()
+    loaded = time.perf_counter()
+    result = run_screen(args.filters, args.rank, args.ascending, args.top, args.columns, universe)
+    done = time.perf_counter()
+    print(result.to_string())
+    print(f"\n{len(result)} of {len(universe)} symbols, loaded in {loaded - start:.3f}s, "
+          f"screened in {(done - loaded) * 1e3:.1f}ms")
+    if args.output:
+        result.to_csv(args.output)
@@ -0,0 +1,73 @@
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import (AbstractHolidayCalendar, Holiday, GoodFriday, USLaborDay, USMartinLutherKingJr,
+                                    USMemorialDay, USPresidentsDay, USThanksgivingDay, nearest_workday,
+                                    sunday_to_monday)
+
+MARKET_TZ = 'US/Eastern'
+REGULAR_CLOSE = pd.Timedelta(hours=16)
+EARLY_CLOSE = pd.Timedelta(hours=13)
+
+
+class NYSEHolidayCalendar(AbstractHolidayCalendar):
+    """Full-day NYSE holidays. New Year's Day falling on a Saturday is not observed on the Friday."""
+    rules = [
+        Holiday('NewYearsDay', month=1, day=1, observance=sunday_to_monday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth', month=6, day=19, start_date='2022-01-01', observance=nearest_workday),
+        Holiday('IndependenceDay', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday('Christmas', month=12, day=25, observance=nearest_workday),
+    ]
+
+
+def _early_close_days(years):
+    """13:00 closes: July 3rd, the day after Thanksgiving and Christmas Eve when they are trading days."""
+    days = []
+    for year in years:
+        days.append(pd.Timestamp(year, 7, 3))
+        days.append(pd.Timestamp(year, 12, 24))
+        days.extend(USThanksgivingDay.dates(pd.Timestamp(year, 1, 1), pd.Timestamp(year, 12, 31)) + pd.Timedelta(days=1))
+    return pd.DatetimeIndex(days)
+
+
+@lru_cache(maxsize=8)
+def _sessions(first_year, last_year):
+    start, end = pd.Timestamp(first_year, 1, 1), pd.Timestamp(last_year, 12, 31)
+    holidays = NYSEHolidayCalendar().holidays(start, end)
+    days = pd.bdate_range(start, end)
+    days = days[~days.isin(holidays)]
+
+    close_offsets = np.where(days.isin(_early_close_days(range(first_year, last_year + 1))), EARLY_CLOSE, REGULAR_CLOSE)
+    closes = (days + pd.TimedeltaIndex(close_offsets)).tz_localize(MARKET_TZ).tz_convert('UTC')
+    return days.values.astype('datetime64[D]'), closes.as_unit('ns').asi8
+
+
+def trading_sessions(start, end):
+    """
+    Session dates and their close times (int64 ns UTC) covering start..end.
+    The index is built per whole year and cached, so repeated lookups are free.
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    # One extra year so timestamps at the end of the range still find a following session
+    return _sessions(start.year, end.year + 1)
+
+
+def next_session(timestamps):
+    """
+    Maps timestamps to the trading session they belong to: the first session whose close is after
+    the timestamp. After-close, weekend and holiday timestamps roll forward to the next session.
+    Accepts anything pd.to_datetime understands (naive values are taken as UTC) and returns
+    datetime64[D] session dates.
+    """
+    times = pd.to_datetime(timestamps, utc=True)
+    t = pd.DatetimeIndex(times).as_unit('ns').asi8
+    if len(t) == 0:
+        return np.array([], dtype='datetime64[D]')
+    days, closes = trading_sessions(pd.Timestamp(t.min()), pd.Timestamp(t.max()))
+    return days[np.searchsorted(closes, t, side='right')]
@@ -0,0 +1,363 @@
+import time
+import numpy as np
+import pandas as pd
+from bar_store import read_bars
+from asset_universe import universe_symbols
+from bar_resampler import BASE_TIMEFRAME, data_version, get_bars
+from bar_aggregation import DAY_NS, group_bounds
+from indicators import ema
+from bt_stuff import AlpacaStockData, MyStrategy, BuyDipsStrategy, FractionalSizer, strategy_params
+from param_sweep import expand_grid, run_backtest
+from results_store import daily_equity, run_key
+
+# Backtrader defaults the vectorized engine reproduces
+RISK_FREE_RATE = 0.01  # SharpeRatio riskfreerate, on yearly returns
+DAYS_PER_YEAR = 252  # Returns annualisation for daily periods
+SIZER_BUY_AMOUNT = dict(FractionalSizer.params._getitems())['buy_amount']
+
+METRICS = ['total_trades', 'closed_trades', 'won_trades', 'lost_trades', 'winning_streak', 'losing_streak',
+           'pnl_net_total', 'pnl_net_average', 'sharpe_ratio', 'max_drawdown_len', 'max_drawdown', 'max_moneydown',
+           'drawdown', 'moneydown', 'rtot', 'ravg', 'rnorm', 'rnorm100', 'start_value', 'final_value', 'pnl']
+
+
+def macd_lines(close, fast, slow, signal, cache=None):
+    """MACD and signal line as bt.indicators.MACD computes them. cache shares the price EMAs between calls."""
+    cache = {} if cache is None else cache
+    for period in (fast, slow):
+        if period not in cache:
+            cache[period] = ema(close, period)
+    macd = cache[fast] - cache[slow]
+    return macd, ema(macd, signal)
+
+
+# ----- Simulation -----
+
+def _simulate_macd_vwap(bars, entry, exit_, stop_loss, starting_cash, buy_amount):
+    """
+    Steps MyStrategy(long_only=True) through the bars for k parameter sets at once, every state
+    variable is a length k vector. Per bar, in backtrader's order: the pending entry fills at the
+    open, then the trailing stop is checked (open gap fills at the open, otherwise at the stop
+    price) and trails the close, then a pending exit fills at the open, then new orders are placed
+    from the bar's signals. Returns the (n, k) portfolio values and the trade statistics.
+    """
+    o, l, c = bars['o'], bars['l'], bars['c']
+    n, k = entry.shape
+    cash = np.full(k, float(starting_cash))
+    pos = np.zeros(k)
+    entry_price = np.zeros(k)
+    stop = np.full(k, -np.inf)  # -inf when there is no live stop
+    pending_buy = np.zeros(k)  # size of the entry order placed on the previous bar
+    pending_exit = np.zeros(k, dtype=bool)
+    values = np.empty((n, k))
+
+    opened = np.zeros(k, dtype=np.int64)
+    closed = np.zeros(k, dtype=np.int64)
+    won = np.zeros(k, dtype=np.int64)
+    won_streak, lost_streak = np.zeros(k, dtype=np.int64), np.zeros(k, dtype=np.int64)
+    longest_won, longest_lost = np.zeros(k, dtype=np.int64), np.zeros(k, dtype=np.int64)
+    pnl_total = np.zeros(k)
+
+    for i in range(n):
+        oi, li, ci = o[i], l[i], c[i]
+
+        filled = None
+        if pending_buy.any():
+            cost = pending_buy * oi
+            filled = (pending_buy > 0) & (cost <= cash)  # backtrader rejects orders it cannot pay for
+            cash = np.where(filled, cash - cost, cash)
+            pos = np.where(filled, pending_buy, pos)
+            entry_price = np.where(filled, oi, entry_price)
+            opened += filled
+            pending_buy = np.zeros(k)
+
+        live = stop > -np.inf
+        if live.any():
+            hit = live & (li <= stop)
+            by_exit = pending_exit & ~hit
+            out = hit | by_exit
+            if out.any():
+                price = np.where(hit & (oi > stop), stop, oi)
+                pnl = np.where(out, pos * (price - entry_price), 0.0)
+                win = out & (pnl >= 0.0)
+                loss = out & ~win
+                cash = np.where(out, cash + pos * price, cash)
+                pos = np.where(out, 0.0, pos)
+                closed += out
+                won += win
+                pnl_total += pnl
+                won_streak = np.where(out, (won_streak + 1) * win, won_streak)
+                lost_streak = np.where(out, (lost_streak + 1) * loss, lost_streak)
+                np.maximum(longest_won, won_streak, out=longest_won)
+                np.maximum(longest_lost, lost_streak, out=longest_lost)
+            stop = np.where(live & ~out, np.maximum(stop, ci - ci * stop_loss), np.where(out, -np.inf, stop))
+        pending_exit = np.zeros(k, dtype=bool)
+
+        if filled is not None:
+            # notify_order places the trailing stop once the entry is filled
+            stop = np.where(filled, ci - ci * stop_loss, stop)
+
+        values[i] = cash + pos * ci
+
+        flat = pos == 0.0
+        pending_buy = np.where(flat & entry[i], buy_amount * cash / ci, 0.0)
+        pending_exit = ~flat & exit_[i]
+
+    trades = {
+        'total_trades': opened,
+        'closed_trades': closed,
+        'won_trades': won,
+        'lost_trades': closed - won,
+        'winning_streak': longest_won,
+        'losing_streak': longest_lost,
+        'pnl_net_total': pnl_total,
+        'pnl_net_average': np.where(closed > 0, pnl_total / np.maximum(closed, 1), 0.0),
+    }
+    return values, trades
+
+
+def _simulate_buy_dips(bars, dip_percentage, buy_amount, starting_cash):
+    """
+    BuyDipsStrategy without a time loop. A buy signalled on bar i fills at the next open and spends
+    buy_amount * cash * open / close of the cash, so cash is a cumulative product of per-bar factors
+    and the position a cumulative sum of the bought sizes.
+    """
+    o, c = bars['o'], bars['c']
+    n, k = len(c), len(dip_percentage)
+    change = np.full(n, np.nan)
+    change[1:] = (c[1:] - c[:-1]) / c[:-1] * 100
+    signal = change[:, None] <= -dip_percentage[None, :]
+    signal[-1] = False  # an order placed on the last bar never fills
+
+    # Factor applied to the cash by a fill on bar j for a buy placed on bar j - 1
+    spend = np.zeros((n, k))
+    spend[1:] = buy_amount[None, :] * o[1:, None] / c[:-1, None]
+    fills = np.zeros((n, k), dtype=bool)
+    fills[1:] = signal[:-1] & (spend[1:] <= 1.0)
+    cash = starting_cash * np.cumprod(np.where(fills, 1.0 - spend, 1.0), axis=0)
+
+    sizes = np.zeros((n, k))
+    sizes[1:] = np.where(fills[1:], cash[:-1] * buy_amount[None, :] / c[:-1, None], 0.0)
+    values = cash + np.cumsum(sizes, axis=0) * c[:, None]
+
+    zeros = np.zeros(k, dtype=np.int64)
+    trades = {
+        # Buys only ever add to the one open trade
+        'total_trades': fills.any(axis=0).astype(np.int64),
+        'closed_trades': zeros,
+        'won_trades': zeros,
+        'lost_trades': zeros,
+        'winning_streak': zeros,
+        'losing_streak': zeros,
+        'pnl_net_total': np.zeros(k),
+        'pnl_net_average': np.zeros(k),
+    }
+    return values, trades
+
+
+# ----- Metrics -----
+
+def _value_metrics(values, t, starting_cash):
+    """DrawDown, SharpeRatio (yearly, 1% risk free) and Returns (daily periods) from the (n, k) value paths."""
+    n, k = values.shape
+    peak = np.maximum.accumulate(values, axis=0)
+    moneydown = peak - values
+    drawdown = 100.0 * moneydown / peak
+
+    # Length of the drawdown run each bar is part of
+    idx = np.arange(n)[:, None]
+    last_flat = np.maximum.accumulate(np.where(drawdown == 0, idx, -1), axis=0)
+
+    _, year_ends = group_bounds(pd.DatetimeIndex(t).year.to_numpy())
+    year_values = values[year_ends]
+    year_starts = np.vstack([np.full((1, k), float(starting_cash)), year_values[:-1]])
+    excess = year_values / year_starts - 1.0 - RISK_FREE_RATE
+    deviation = excess.std(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(deviation > 0, excess.mean(axis=0) / deviation, np.nan)
+
+    n_days = len(np.unique(np.asarray(t, dtype=np.int64) // DAY_NS))
+    final = values[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rtot = np.where(final / starting_cash >= 0, np.log(final / starting_cash), -np.inf)
+    ravg = rtot / n_days
+    rnorm = np.where(np.isfinite(ravg), np.expm1(ravg * DAYS_PER_YEAR), ravg)
+
+    return {
+        'sharpe_ratio': sharpe,
+        'max_drawdown_len': (idx - last_flat).max(axis=0),
+        'max_drawdown': drawdown.max(axis=0),
+        'max_moneydown': moneydown.max(axis=0),
+        'drawdown': drawdown[-1],
+        'moneydown': moneydown[-1],
+        'rtot': rtot,
+        'ravg': ravg,
+        'rnorm': rnorm,
+        'rnorm100': rnorm * 100.0,
+        'start_value': np.full(k, float(starting_cash)),
+        'final_value': final,
+        'pnl': final - starting_cash,
+    }
+
+
+def _results_frame(param_sets, trades, metrics):
+    df = pd.DataFrame(param_sets)
+    for name in METRICS:
+        df[name] = trades[name] if name in trades else metrics[name]
+    # Backtrader reports an undefined Sharpe ratio as None
+    df['sharpe_ratio'] = df['sharpe_ratio'].astype(object).where(df['sharpe_ratio'].notna(), None)
+    return df
+
+
+# ----- Backtests -----
+
+def _with_curves(frames, curves, t, with_equity):
+    df = pd.concat(frames, ignore_index=True)
+    if not with_equity:
+        return df
+    return df, daily_equity(t, np.hstack(curves))
+
+
+def backtest_my_strategy(bars, param_sets, starting_cash=1000.0, buy_amount=SIZER_BUY_AMOUNT, chunk_size=128,
+                         with_equity=False):
+    """
+    MyStrategy(long_only=True) with FractionalSizer for every parameter set on one symbol's bars
+    (dict of arrays as read_bars(as_numpy=True) returns). One row per parameter set with the
+    figures analyze_bt_results prints. with_equity also returns the daily account values as
+    (times, (days, parameter sets) values).
+    """
+    param_sets = [strategy_params(MyStrategy, dict(params, long_only=True)) for params in param_sets]
+    close, vwap = bars['c'], bars['vw']
+    cache, frames, curves = {}, [], []
+    for start in range(0, len(param_sets), chunk_size):
+        chunk = param_sets[start:start + chunk_size]
+        entry = np.empty((len(close), len(chunk)), dtype=bool)
+        exit_ = np.empty_like(entry)
+        lines = {}
+        for j, p in enumerate(chunk):
+            periods = (p['macd_fast'], p['macd_slow'], p['macd_signal'])
+            if periods not in lines:
+                lines[periods] = macd_lines(close, *periods, cache=cache)
+            macd, signal = lines[periods]
+            # NaN compares false, so nothing fires before the MACD warm-up like in backtrader
+            entry[:, j] = (macd > signal) & (close > vwap * p['entry_multiplier'])
+            exit_[:, j] = (macd < signal) & (close < vwap * p['exit_multiplier'])
+
+        stop_loss = np.array([p['stop_loss'] for p in chunk], dtype=np.float64)
+        values, trades = _simulate_macd_vwap(bars, entry, exit_, stop_loss, starting_cash, buy_amount)
+        frames.append(_results_frame(chunk, trades, _value_metrics(values, bars['t'], starting_cash)))
+        if with_equity:
+            curves.append(values)
+    return _with_curves(frames, curves, bars['t'], with_equity)
+
+
+def backtest_buy_dips(bars, param_sets, starting_cash=1000.0, chunk_size=128, with_equity=False):
+    """BuyDipsStrategy for every parameter set on one symbol's bars, see backtest_my_strategy."""
+    param_sets = [strategy_params(BuyDipsStrategy, params) for params in param_sets]
+    frames, curves = [], []
+    for start in range(0, len(param_sets), chunk_size):
+        chunk = param_sets[start:start + chunk_size]
+        dip = np.array([p['dip_percentage'] for p in chunk], dtype=np.float64)
+        amount = np.array([p['buy_amount'] for p in chunk], dtype=np.float64)
+        values, trades = _simulate_buy_dips(bars, dip, amount, starting_cash)
+        frames.append(_results_frame(chunk, trades, _value_metrics(values, bars['t'], starting_cash)))
+        if with_equity:
+            curves.append(values)
+    return _with_curves(frames, curves, bars['t'], with_equity)
+
+
+VECTOR_BACKTESTS = {
+    'MyStrategy': backtest_my_strategy,
+    'BuyDipsStrategy': backtest_buy_dips,
+}
+
+
+def _engine_params(strategy_name, params):
+    # The full parameter set the vectorized engine actually runs, as stored with the results
+    if strategy_name == 'MyStrategy':
+        return strategy_params(MyStrategy, dict(params, long_only=True))
+    return strategy_params(BuyDipsStrategy, params)
+
+
+def run_vector_sweep(strategy_name, grid, symbols, starting_cash=1000.0, timeframe=BASE_TIMEFRAME, store=None):
+    """
+    The whole grid on each symbol, one row per (symbol, parameter set). With a ResultsStore, runs
+    already stored for the symbol's current data are not recomputed and new ones are recorded
+    with their daily equity curves.
+    """
+    param_sets = expand_grid(grid)
+    if store is None:
+        frames = []
+        for symbol in symbols:
+            bars = get_bars(symbol, timeframe, as_numpy=True)
+            if len(bars['t']) == 0:
+                continue
+            df = VECTOR_BACKTESTS[strategy_name](bars, param_sets, starting_cash)
+            df.insert(0, 'symbol', symbol)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    full_params = [_engine_params(strategy_name, params) for params in param_sets]
+    all_keys = []
+    for symbol in symbols:
+        version = data_version(symbol, timeframe)
+        if version is None:
+            continue
+        keys = [run_key(strategy_name, symbol, timeframe, params, version, starting_cash) for params in full_params]
+        all_keys += keys
+        done = store.done_keys(keys)
+        todo = [i for i, key in enumerate(keys) if key not in done]
+        if not todo:
+            continue
+        start = time.perf_counter()
+        df, (days, curves) = VECTOR_BACKTESTS[strategy_name](get_bars(symbol, timeframe, as_numpy=True),
+                                                             [param_sets[i] for i in todo], starting_cash,
+                                                             with_equity=True)
+        # One pass prices the whole remaining grid, its time is shared out evenly
+        elapsed = (time.perf_counter() - start) / len(todo)
+        store.record_many(dict(run_key=keys[i], strategy=strategy_name, symbol=symbol, timeframe=timeframe,
+                               data_version=version, starting_cash=starting_cash, params=full_params[i],
+                               metrics={name: row[name] for name in METRICS}, engine='vector',
+                               elapsed_s=elapsed, equity=(days, curves[:, j]))
+                          for j, (i, row) in enumerate(zip(todo, df.to_dict('records'))))
+    return store.load(keys=all_keys)
+
+
+def cross_check(symbol, strategy_name, params, n_bars=5000, starting_cash=1000.0, rtol=1e-6):
+    """
+    Runs one parameter set through backtrader and through the vectorized engine on the last n_bars
+    bars of symbol. Returns the metrics side by side with a column telling whether they agree.
+    """
+    bars = {col: values[-n_bars:] for col, values in read_bars(symbol, as_numpy=True).items()}
+    bars_df = pd.DataFrame({
+        'timestamp': pd.to_datetime(bars['t'], unit='ns'),
+        'open': bars['o'],
+        'high': bars['h'],
+        'low': bars['l'],
+        'close': bars['c'],
+        'volume': bars['v'],
+        'vwap': bars['vw'],
+    })
+    bt_params = dict(params, long_only=True) if strategy_name == 'MyStrategy' else params
+    expected = run_backtest(strategy_name, bt_params, AlpacaStockData(dataname=bars_df), starting_cash)
+    actual = VECTOR_BACKTESTS[strategy_name](bars, [params], starting_cash).iloc[0]
+
+    rows = []
+    for name in METRICS:
+        a, b = expected[name], actual[name]
+        if a is None or b is None:
+            match = a is None and b is None
+        else:
+            match = bool(np.isclose(float(a), float(b), rtol=rtol, atol=1e-9))
+        rows.append({'metric': name, 'backtrader': a, 'vectorized': b, 'match': match})
+    return pd.DataFrame(rows).set_index('metric')
+
+
+if __name__ == "__main__":
+    from param_sweep import MY_STRATEGY_GRID, BUY_DIPS_GRID
+    tickers = universe_symbols()[0:10]
+    print(cross_check(tickers[0], 'MyStrategy', {}))
+    print(cross_check(tickers[0], 'BuyDipsStrategy', {}))
+    results = run_vector_sweep('MyStrategy', MY_STRATEGY_GRID, tickers)
+    print(results.sort_values('sharpe_ratio', ascending=False, na_position='last').head(10))
+    results = run_vector_sweep('BuyDipsStrategy', BUY_DIPS_GRID, tickers)
+    print(results.sort_values('sharpe_ratio', ascending=False, na_position='last').head(10))